@@ -34,7 +34,7 @@ else
 fi
 
 ### geocode
-if [ ! -z ${USE_GEOLITE2+x} ] && [ ! -z ${DATABASE_URL+x} ]; then
+if [ ! -z ${USE_GEOLITE2+x} ]; then
     URL=http://geolite.maxmind.com/download/geoip/database/GeoLite2-Country-CSV_20170404.zip
     MD5SUM="5b7d4cd3955a8e773cc71deff71a4155"
     FILENAME=GeoLite2-Country-CSV_20170404.zip
@@ -46,18 +46,32 @@ if [ ! -z ${USE_GEOLITE2+x} ] && [ ! -z ${DATABASE_URL+x} ]; then
         CHKSUM=$(eval $MD5 $FILENAME | grep --only-matching -m 1 '^[0-9a-f]*')
     fi
     if [ $CHKSUM == $MD5SUM ]; then
-        echo "IMPORTING GeoLite2 DB"
+        # the csv files are kept in geolite2/ so they can be loaded by
+        # the in process index (GEOLITE2_CSV_DIR=geolite2) or used
+        # through the compiled database file
+        # (GEOIP_DATABASE_FILE=geolite2/GeoLite2-Country.bin)
         unzip -o -j $FILENAME -d geolite2
-        sed \
-             -e "s@:ipv4_csv@${PWD}/geolite2/GeoLite2-Country-Blocks-IPv4.csv@g" \
-             -e "s@:ipv6_csv@${PWD}/geolite2/GeoLite2-Country-Blocks-IPv6.csv@g" \
-             -e "s@:country_csv@${PWD}/geolite2/GeoLite2-Country-Locations-en.csv@g" \
-             sql/import_geolite2.sql \
-            | psql $DATABASE_URL
-        rm -r geolite2/
+        if command -v python3 &>/dev/null; then
+            echo "COMPILING GeoIP database"
+            python3 -m toshirep.geoip compile geolite2 geolite2/GeoLite2-Country.bin
+        fi
+        if [ ! -z ${DATABASE_URL+x} ]; then
+            echo "IMPORTING GeoLite2 DB"
+            # psql is used as the python requirements aren't installed
+            # yet, the script swaps in the new tables like
+            # toshirep.geoimport does
+            sed \
+                 -e "s@:ipv4_csv@${PWD}/geolite2/GeoLite2-Country-Blocks-IPv4.csv@g" \
+                 -e "s@:ipv6_csv@${PWD}/geolite2/GeoLite2-Country-Blocks-IPv6.csv@g" \
+                 -e "s@:country_csv@${PWD}/geolite2/GeoLite2-Country-Locations-en.csv@g" \
+                 sql/import_geolite2.sql \
+                | psql $DATABASE_URL
+        else
+            echo "SKIPPING GeoLite2 database import"
+        fi
     else
         echo "ERROR: md5sum of GeoLite2 download did not match!"
     fi
 else
-    echo "SKIPPING GeoLite2 database import"
+    echo "SKIPPING GeoLite2 download"
 fi
@@ -1,6 +1,13 @@
 \set ON_ERROR_STOP on
 
-CREATE TABLE IF NOT EXISTS geolite2_ip_addresses (
+-- loads the csv files into staging tables which are indexed and then
+-- swapped with the live tables in a single transaction, so lookups see
+-- either the old or the new data but never empty or partial tables.
+-- This mirrors `toshirep.geoimport`, which can be used when the python
+-- requirements are installed.
+
+DROP TABLE IF EXISTS geolite2_ip_addresses_new;
+CREATE TABLE geolite2_ip_addresses_new (
     network CIDR,
     geoname_id INT,
     registered_country_geoname_id INT,
@@ -9,9 +16,8 @@ CREATE TABLE IF NOT EXISTS geolite2_ip_addresses (
     is_satellite_provider BOOLEAN
 );
 
-CREATE INDEX IF NOT EXISTS geolite2_ip_addresses_network_idx ON geolite2_ip_addresses (network);
-
-CREATE TABLE IF NOT EXISTS geolite2_countries (
+DROP TABLE IF EXISTS geolite2_countries_new;
+CREATE TABLE geolite2_countries_new (
     geoname_id INT,
     locale_code VARCHAR,
     continent_code VARCHAR,
@@ -20,14 +26,48 @@ CREATE TABLE IF NOT EXISTS geolite2_countries (
     country_name VARCHAR
 );
 
-CREATE INDEX IF NOT EXISTS geolite2_ip_countries_geoname_id_idx ON geolite2_countries (geoname_id);
-
--- clear the existing data
-DELETE FROM geolite2_ip_addresses;
-DELETE FROM geolite2_countries;
+DROP TABLE IF EXISTS geolite2_lookup_new;
+CREATE TABLE geolite2_lookup_new (
+    range_start INET NOT NULL,
+    range_end INET NOT NULL,
+    country_iso_code VARCHAR
+);
 
 -- import csv
-\COPY geolite2_ip_addresses FROM :ipv4_csv DELIMITER ',' CSV HEADER;
-\COPY geolite2_ip_addresses FROM :ipv6_csv DELIMITER ',' CSV HEADER;
+\COPY geolite2_ip_addresses_new FROM :ipv4_csv DELIMITER ',' CSV HEADER;
+\COPY geolite2_ip_addresses_new FROM :ipv6_csv DELIMITER ',' CSV HEADER;
+
+\COPY geolite2_countries_new FROM :country_csv DELIMITER ',' CSV HEADER;
+
+-- build the lookup table
+INSERT INTO geolite2_lookup_new (range_start, range_end, country_iso_code)
+SELECT set_masklen(ips.network, CASE family(ips.network) WHEN 4 THEN 32 ELSE 128 END),
+       set_masklen(broadcast(ips.network), CASE family(ips.network) WHEN 4 THEN 32 ELSE 128 END),
+       cs.country_iso_code
+FROM geolite2_ip_addresses_new ips
+JOIN geolite2_countries_new cs ON ips.geoname_id = cs.geoname_id;
+
+CREATE INDEX geolite2_ip_addresses_network_idx_new ON geolite2_ip_addresses_new USING GIST (network inet_ops);
+CREATE INDEX geolite2_ip_countries_geoname_id_idx_new ON geolite2_countries_new (geoname_id);
+CREATE INDEX geolite2_lookup_range_start_idx_new ON geolite2_lookup_new (range_start);
+
+ANALYZE geolite2_ip_addresses_new;
+ANALYZE geolite2_countries_new;
+ANALYZE geolite2_lookup_new;
+
+-- swap in the new tables
+BEGIN;
+
+DROP TABLE IF EXISTS geolite2_ip_addresses CASCADE;
+ALTER TABLE geolite2_ip_addresses_new RENAME TO geolite2_ip_addresses;
+ALTER INDEX geolite2_ip_addresses_network_idx_new RENAME TO geolite2_ip_addresses_network_idx;
+
+DROP TABLE IF EXISTS geolite2_countries CASCADE;
+ALTER TABLE geolite2_countries_new RENAME TO geolite2_countries;
+ALTER INDEX geolite2_ip_countries_geoname_id_idx_new RENAME TO geolite2_ip_countries_geoname_id_idx;
+
+DROP TABLE IF EXISTS geolite2_lookup CASCADE;
+ALTER TABLE geolite2_lookup_new RENAME TO geolite2_lookup;
+ALTER INDEX geolite2_lookup_range_start_idx_new RENAME TO geolite2_lookup_range_start_idx;
 
-\COPY geolite2_countries FROM :country_csv DELIMITER ',' CSV HEADER;
+COMMIT;
@@ -0,0 +1,72 @@
+-- per reviewee aggregate of the reviews table, kept up to date by
+-- triggers on reviews so reading a user's reputation is a single
+-- primary key lookup rather than a scan over all of their reviews.
+CREATE TABLE IF NOT EXISTS reviewee_reputation (
+    reviewee_id VARCHAR PRIMARY KEY,
+
+    review_count BIGINT NOT NULL DEFAULT 0,
+    rating_sum DECIMAL NOT NULL DEFAULT 0,
+
+    stars_1 BIGINT NOT NULL DEFAULT 0,
+    stars_2 BIGINT NOT NULL DEFAULT 0,
+    stars_3 BIGINT NOT NULL DEFAULT 0,
+    stars_4 BIGINT NOT NULL DEFAULT 0,
+    stars_5 BIGINT NOT NULL DEFAULT 0
+);
+
+-- adds (direction = 1) or removes (direction = -1) a single rating from
+-- the reviewee's aggregate
+CREATE OR REPLACE FUNCTION reviewee_reputation_apply(reviewee VARCHAR, rating DECIMAL, direction INTEGER)
+RETURNS VOID AS $$
+BEGIN
+    IF rating IS NULL THEN
+        RETURN;
+    END IF;
+    INSERT INTO reviewee_reputation AS rr
+        (reviewee_id, review_count, rating_sum, stars_1, stars_2, stars_3, stars_4, stars_5)
+    VALUES (
+        reviewee, direction, direction * rating,
+        CASE WHEN rating < 2.0 THEN direction ELSE 0 END,
+        CASE WHEN rating >= 2.0 AND rating < 3.0 THEN direction ELSE 0 END,
+        CASE WHEN rating >= 3.0 AND rating < 4.0 THEN direction ELSE 0 END,
+        CASE WHEN rating >= 4.0 AND rating < 5.0 THEN direction ELSE 0 END,
+        CASE WHEN rating >= 5.0 THEN direction ELSE 0 END)
+    ON CONFLICT (reviewee_id) DO UPDATE SET
+        review_count = rr.review_count + EXCLUDED.review_count,
+        rating_sum = rr.rating_sum + EXCLUDED.rating_sum,
+        stars_1 = rr.stars_1 + EXCLUDED.stars_1,
+        stars_2 = rr.stars_2 + EXCLUDED.stars_2,
+        stars_3 = rr.stars_3 + EXCLUDED.stars_3,
+        stars_4 = rr.stars_4 + EXCLUDED.stars_4,
+        stars_5 = rr.stars_5 + EXCLUDED.stars_5;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION reviews_maintain_reputation() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' OR TG_OP = 'UPDATE' THEN
+        PERFORM reviewee_reputation_apply(OLD.reviewee_id, OLD.rating, -1);
+    END IF;
+    IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+        PERFORM reviewee_reputation_apply(NEW.reviewee_id, NEW.rating, 1);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_reviews_maintain_reputation ON reviews;
+CREATE TRIGGER trg_reviews_maintain_reputation
+    AFTER INSERT OR UPDATE OF reviewee_id, rating OR DELETE ON reviews
+    FOR EACH ROW EXECUTE PROCEDURE reviews_maintain_reputation();
+
+-- populate from the existing reviews
+INSERT INTO reviewee_reputation
+    (reviewee_id, review_count, rating_sum, stars_1, stars_2, stars_3, stars_4, stars_5)
+SELECT reviewee_id, COUNT(rating), COALESCE(SUM(rating), 0),
+    COUNT(rating) FILTER (WHERE rating < 2.0),
+    COUNT(rating) FILTER (WHERE rating >= 2.0 AND rating < 3.0),
+    COUNT(rating) FILTER (WHERE rating >= 3.0 AND rating < 4.0),
+    COUNT(rating) FILTER (WHERE rating >= 4.0 AND rating < 5.0),
+    COUNT(rating) FILTER (WHERE rating >= 5.0)
+FROM reviews GROUP BY reviewee_id
+ON CONFLICT (reviewee_id) DO NOTHING;
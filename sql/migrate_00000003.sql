@@ -0,0 +1,6 @@
+-- add the tie breaking column to the sorted indexes so keyset pagination
+-- in the review search can seek directly to the start of the next page
+DROP INDEX IF EXISTS idx_review_reviewer_sorted;
+DROP INDEX IF EXISTS idx_review_reviewee_sorted;
+CREATE INDEX IF NOT EXISTS idx_review_reviewer_sorted ON reviews (reviewer_id, updated DESC, reviewee_id DESC);
+CREATE INDEX IF NOT EXISTS idx_review_reviewee_sorted ON reviews (reviewee_id, updated DESC, reviewer_id DESC);
@@ -0,0 +1,27 @@
+-- denormalized GeoLite2 lookup table, one row per network with the
+-- first and last address of the network and the country inlined, so
+-- a lookup is a single index probe for the greatest range_start <= ip
+-- rather than a containment scan of geolite2_ip_addresses joined to
+-- geolite2_countries
+CREATE TABLE IF NOT EXISTS geolite2_lookup (
+    range_start INET NOT NULL,
+    range_end INET NOT NULL,
+    country_iso_code VARCHAR
+);
+
+CREATE INDEX IF NOT EXISTS geolite2_lookup_range_start_idx ON geolite2_lookup (range_start);
+
+-- populate from already imported GeoLite2 data
+DO $$
+BEGIN
+    IF to_regclass('geolite2_ip_addresses') IS NOT NULL AND to_regclass('geolite2_countries') IS NOT NULL THEN
+        INSERT INTO geolite2_lookup (range_start, range_end, country_iso_code)
+        SELECT set_masklen(ips.network, CASE family(ips.network) WHEN 4 THEN 32 ELSE 128 END),
+               set_masklen(broadcast(ips.network), CASE family(ips.network) WHEN 4 THEN 32 ELSE 128 END),
+               cs.country_iso_code
+        FROM geolite2_ip_addresses ips
+        JOIN geolite2_countries cs ON ips.geoname_id = cs.geoname_id;
+        ANALYZE geolite2_lookup;
+    END IF;
+END
+$$;
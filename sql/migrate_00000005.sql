@@ -0,0 +1,7 @@
+-- the starsort score is calculated from the star counts when reading a
+-- reputation (see tasks.starsort), so the copy cached on the aggregate
+-- by a trigger was never read
+DROP TRIGGER IF EXISTS trg_reviewee_reputation_score ON reviewee_reputation;
+DROP FUNCTION IF EXISTS reviewee_reputation_set_score();
+DROP FUNCTION IF EXISTS starsort(BIGINT, BIGINT, BIGINT, BIGINT, BIGINT);
+ALTER TABLE reviewee_reputation DROP COLUMN IF EXISTS reputation_score;
@@ -0,0 +1,3 @@
+-- matches the ORDER BY of review exports (see reviews.build_export_query),
+-- so a full export streams in index order instead of sorting the table
+CREATE INDEX IF NOT EXISTS idx_reviews_export_order ON reviews (updated, reviewer_id, reviewee_id);
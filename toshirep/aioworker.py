@@ -0,0 +1,210 @@
+"""Long lived asyncio worker for the reputation jobs.
+
+usage: python -m toshirep.aioworker
+
+Pulls the same rq jobs as `toshirep/worker.py` from the `high`, `default`
+and `low` queues, but instead of forking a process per job it runs them
+as coroutines on a single event loop. All jobs share an asyncpg pool and
+a keep-alive http session per push host, and at most
+`WORKER_CONCURRENCY` jobs run at the same time.
+"""
+import asyncio
+import asyncpg
+import logging
+import os
+import signal
+import sys
+import traceback
+import redis
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+from rq.queue import Queue, get_failed_queue
+from rq.registry import StartedJobRegistry
+
+from toshirep.metrics import InstrumentedPool
+from toshirep.tasks import TaskResources, ASYNC_TASKS, run_job
+from toshirep.worker import listen, get_redis_url
+
+log = logging.getLogger("worker.log")
+
+# rq's default job timeout
+DEFAULT_JOB_TIMEOUT = 180
+# how often the job stats are written to redis
+JOB_STATS_FLUSH_INTERVAL = 5
+
+class PooledTaskResources(TaskResources):
+    """Task resources shared between every job run by the worker"""
+
+    def __init__(self, pool, redis_connection):
+        super().__init__(None, redis_connection, batch_pushes=True)
+        self.pool = pool
+        self.instrumented_pool = InstrumentedPool(pool, slow_queries=self.slow_queries)
+        self.addresses = {}
+
+    def connection(self):
+        return self.instrumented_pool.acquire()
+
+    def explain_connection(self):
+        return self.pool.acquire()
+
+    def address(self, signing_key):
+        if signing_key not in self.addresses:
+            self.addresses[signing_key] = super().address(signing_key)
+        return self.addresses[signing_key]
+
+    async def close(self):
+        await super().close()
+        await self.pool.close()
+
+class AsyncWorker:
+
+    def __init__(self, redis_connection, resources, queues=listen, concurrency=50, poll_timeout=5):
+        self.redis = redis_connection
+        self.resources = resources
+        self.queues = [Queue(name, connection=redis_connection) for name in queues]
+        self.concurrency = concurrency
+        self.poll_timeout = poll_timeout
+        self.running = False
+        self.tasks = set()
+        # blocking redis calls are run in a separate thread so they
+        # don't stall the jobs running on the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # the stats are written from their own thread so they don't wait
+        # behind a blocking pop
+        self.stats_executor = ThreadPoolExecutor(max_workers=1)
+
+    def stop(self):
+        log.info("Stopping worker, waiting for {} running jobs".format(len(self.tasks)))
+        self.running = False
+
+    def _pop_job(self):
+        # BLPOP checks the keys in order, so higher priority queues
+        # are always emptied first
+        result = self.redis.blpop([queue.key for queue in self.queues], self.poll_timeout)
+        if result is None:
+            return None
+        _, job_id = result
+        try:
+            return Job.fetch(job_id.decode('utf-8'), connection=self.redis)
+        except NoSuchJobError:
+            return None
+
+    def _start_job(self, job):
+        # like rq's worker, the job is kept in the started registry until
+        # a minute after it would have timed out, so `rq info` shows it
+        # and the registry cleanup fails it if the worker dies
+        pipe = self.redis.pipeline()
+        job.set_status(JobStatus.STARTED, pipeline=pipe)
+        StartedJobRegistry(job.origin, connection=self.redis).add(
+            job, (job.timeout or DEFAULT_JOB_TIMEOUT) + 60, pipeline=pipe)
+        pipe.execute()
+
+    def _end_job(self, job, exc_info=None):
+        job.ended_at = datetime.utcnow()
+        pipe = self.redis.pipeline()
+        if exc_info is None:
+            job.set_status(JobStatus.FINISHED, pipeline=pipe)
+            job.cleanup(job.result_ttl if job.result_ttl is not None else 500, pipeline=pipe)
+        else:
+            job.set_status(JobStatus.FAILED, pipeline=pipe)
+        StartedJobRegistry(job.origin, connection=self.redis).remove(job, pipeline=pipe)
+        pipe.execute()
+        if exc_info is not None:
+            get_failed_queue(connection=self.redis).quarantine(job, exc_info=exc_info)
+
+    async def perform(self, job):
+        # the job bookkeeping is done in the loop's default executor, the
+        # worker's own executor is kept for the blocking pops
+        loop = asyncio.get_event_loop()
+        fn = ASYNC_TASKS.get(job.func)
+        try:
+            if fn is None:
+                raise Exception("Unsupported job function: {}".format(job.func_name))
+            await loop.run_in_executor(None, self._start_job, job)
+            await asyncio.wait_for(run_job(self.resources, job, fn, *job.args, **job.kwargs),
+                                   job.timeout or DEFAULT_JOB_TIMEOUT)
+        except Exception:
+            log.exception("Error running job {}".format(job.id))
+            exc_info = traceback.format_exc()
+        else:
+            exc_info = None
+        try:
+            await loop.run_in_executor(None, self._end_job, job, exc_info)
+        except redis.exceptions.RedisError:
+            log.exception("Error updating the status of job {}".format(job.id))
+
+    async def _run(self, job, semaphore):
+        try:
+            await self.perform(job)
+        finally:
+            semaphore.release()
+
+    async def flush_job_stats(self):
+        """writes the job stats every `JOB_STATS_FLUSH_INTERVAL` seconds
+        while the worker is running. The stats are taken on the event loop
+        and written from the stats executor."""
+        loop = asyncio.get_event_loop()
+        while self.running:
+            await asyncio.sleep(JOB_STATS_FLUSH_INTERVAL)
+            stats = self.resources.job_stats.take()
+            await loop.run_in_executor(self.stats_executor, self.resources.job_stats.write, stats)
+
+    async def work(self):
+        loop = asyncio.get_event_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        self.running = True
+        flusher = asyncio.ensure_future(self.flush_job_stats())
+
+        while self.running:
+            # only pop jobs when there is capacity to run them
+            await semaphore.acquire()
+            try:
+                job = await loop.run_in_executor(self.executor, self._pop_job)
+            except redis.exceptions.RedisError:
+                semaphore.release()
+                log.exception("Error fetching jobs")
+                await asyncio.sleep(1)
+                continue
+            if job is None:
+                semaphore.release()
+                continue
+            task = asyncio.ensure_future(self._run(job, semaphore))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+        flusher.cancel()
+
+def main():
+    if 'DATABASE_URL' not in os.environ:
+        log.error("ENVIRONMENT MISSING `DATABASE_URL`")
+        sys.exit(1)
+    url = get_redis_url()
+    if not url:
+        log.error("ENVIROMENT MISSING `REDIS_URL`")
+        sys.exit(1)
+
+    concurrency = int(os.environ.get('WORKER_CONCURRENCY', 50))
+    pool_size = int(os.environ.get('WORKER_DATABASE_POOL_SIZE', 10))
+
+    loop = asyncio.get_event_loop()
+    conn = redis.from_url(url)
+    pool = loop.run_until_complete(asyncpg.create_pool(
+        dsn=os.environ['DATABASE_URL'], min_size=1, max_size=pool_size))
+    resources = PooledTaskResources(pool, conn)
+    worker = AsyncWorker(conn, resources, concurrency=concurrency)
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+
+    try:
+        loop.run_until_complete(worker.work())
+    finally:
+        loop.run_until_complete(resources.close())
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,15 @@
 import os
+import signal
+from . import geoip
 from . import locations
 from . import handlers
+from . import metrics
+from .slowqueries import SlowQueryLog
+from .cache import ReputationCache, TTLCache
+from .scheduler import ReputationScheduler
 import toshi.web
 from toshi.handlers import GenerateTimestamp
+from tornado.ioloop import IOLoop
 from rq import Queue
 import redis
 from functools import partial
@@ -14,9 +21,18 @@ urls = [
     (r"^/v1/review/submit/?$", handlers.SubmitReviewHandler),
     (r"^/v1/review/delete/?$", handlers.DeleteReviewHandler),
     (r"^/v1/user/(?P<reviewee>[^/]+)/?$", handlers.GetUserRatingHandler),
+    (r"^/v1/users/ratings/?$", handlers.GetUsersRatingsHandler),
 
     # admin
-    (r"^/v1/admin/reprocess/?$", handlers.ReprocessReviews)
+    (r"^/v1/admin/reprocess/?$", handlers.ReprocessReviews),
+    (r"^/v1/admin/reviews/import/?$", handlers.ImportReviewsHandler),
+    (r"^/v1/admin/reviews/export/?$", handlers.ExportReviewsHandler),
+    (r"^/v1/admin/reprocess/(?P<reprocess_id>[^/]+)/?$", handlers.ReprocessStatusHandler),
+    (r"^/v1/admin/push/replay/?$", handlers.ReplayDeadPushesHandler),
+    (r"^/v1/admin/stats/?$", handlers.AdminStatsHandler),
+    (r"^/v1/admin/slow_queries/?$", handlers.SlowQueriesHandler),
+
+    (r"^/metrics/?$", handlers.MetricsHandler)
 ]
 
 class Application(toshi.web.Application):
@@ -31,6 +47,52 @@ class Application(toshi.web.Application):
             config['reputation']['signing_key'] = os.environ['REPUTATION_PUSH_SIGNING_KEY']
         if 'REPUTATION_PUSH_URL' in os.environ:
             config['reputation']['push_url'] = os.environ['REPUTATION_PUSH_URL']
+        if 'REPUTATION_PUSH_QUIET_WINDOW' in os.environ:
+            config['reputation']['push_quiet_window'] = os.environ['REPUTATION_PUSH_QUIET_WINDOW']
+        if 'REPUTATION_PUSH_MAX_DELAY' in os.environ:
+            config['reputation']['push_max_delay'] = os.environ['REPUTATION_PUSH_MAX_DELAY']
+        if 'REPUTATION_CACHE_TTL' in os.environ:
+            config['reputation']['cache_ttl'] = os.environ['REPUTATION_CACHE_TTL']
+
+        if 'search' not in config:
+            config['search'] = {}
+        if 'SEARCH_COUNT_CACHE_TTL' in os.environ:
+            config['search']['count_cache_ttl'] = os.environ['SEARCH_COUNT_CACHE_TTL']
+
+        if 'locations' not in config:
+            config['locations'] = {}
+        if 'LOCATION_CACHE_SIZE' in os.environ:
+            config['locations']['cache_size'] = os.environ['LOCATION_CACHE_SIZE']
+        if 'LOCATION_CACHE_TTL' in os.environ:
+            config['locations']['cache_ttl'] = os.environ['LOCATION_CACHE_TTL']
+        if 'LOCATION_CACHE_NEGATIVE_TTL' in os.environ:
+            config['locations']['cache_negative_ttl'] = os.environ['LOCATION_CACHE_NEGATIVE_TTL']
+        if 'IP2C_MAX_IN_FLIGHT' in os.environ:
+            config['locations']['ip2c_max_in_flight'] = os.environ['IP2C_MAX_IN_FLIGHT']
+        if 'IP2C_TIMEOUT' in os.environ:
+            config['locations']['ip2c_timeout'] = os.environ['IP2C_TIMEOUT']
+        if 'LOCATION_WRITE_BATCH_SIZE' in os.environ:
+            config['locations']['write_batch_size'] = os.environ['LOCATION_WRITE_BATCH_SIZE']
+        if 'LOCATION_WRITE_INTERVAL' in os.environ:
+            config['locations']['write_interval'] = os.environ['LOCATION_WRITE_INTERVAL']
+        if 'LOCATION_WRITE_MAX_PENDING' in os.environ:
+            config['locations']['write_max_pending'] = os.environ['LOCATION_WRITE_MAX_PENDING']
+        if 'LOCATION_WRITE_OVERFLOW' in os.environ:
+            config['locations']['write_overflow'] = os.environ['LOCATION_WRITE_OVERFLOW']
+
+        if 'metrics' not in config:
+            config['metrics'] = {}
+        if 'METRICS_TOKEN' in os.environ:
+            config['metrics']['token'] = os.environ['METRICS_TOKEN']
+
+        if 'slow_queries' not in config:
+            config['slow_queries'] = {}
+        if 'SLOW_QUERY_THRESHOLD' in os.environ:
+            config['slow_queries']['threshold'] = os.environ['SLOW_QUERY_THRESHOLD']
+        if 'SLOW_QUERY_EXPLAIN_SAMPLE_RATE' in os.environ:
+            config['slow_queries']['explain_sample_rate'] = os.environ['SLOW_QUERY_EXPLAIN_SAMPLE_RATE']
+        if 'SLOW_QUERY_LOG_SIZE' in os.environ:
+            config['slow_queries']['log_size'] = os.environ['SLOW_QUERY_LOG_SIZE']
 
         if 'push_url' in config['reputation']:
             self.rep_push_urls = config['reputation']['push_url'].split(',')
@@ -42,18 +104,99 @@ class Application(toshi.web.Application):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        if 'USE_GEOLITE2' in os.environ:
-            self.store_location = partial(
-                locations.store_review_location,
-                locations.get_location_from_geolite2, self.connection_pool)
+        # time the queries and the waits for connections of everything
+        # using the pool. Slow queries are explained on connections from
+        # the uninstrumented pool.
+        if getattr(self, 'connection_pool', None) is not None:
+            self.slow_queries = SlowQueryLog(
+                threshold=float(self.config['slow_queries'].get('threshold', 0.5)),
+                sample_rate=float(self.config['slow_queries'].get('explain_sample_rate', 0.1)),
+                maxlen=int(self.config['slow_queries'].get('log_size', 100)),
+                explain_connection=self.connection_pool.acquire)
+            self.connection_pool = metrics.InstrumentedPool(self.connection_pool, slow_queries=self.slow_queries)
+
+        count_cache_ttl = float(self.config['search'].get('count_cache_ttl', 5))
+        if count_cache_ttl > 0:
+            self.search_count_cache = TTLCache(maxsize=10000, ttl=count_cache_ttl)
+
+        if 'GEOIP_DATABASE_FILE' in os.environ:
+            backend = 'geoip_database'
+            get_location = geoip.GeoIPDatabase(os.environ['GEOIP_DATABASE_FILE']).get_location
+        elif 'GEOLITE2_CSV_DIR' in os.environ:
+            backend = 'geolite2_csv'
+            get_location = geoip.GeoLite2Index.from_csv_dir(os.environ['GEOLITE2_CSV_DIR']).get_location
+        elif 'USE_GEOLITE2' in os.environ:
+            backend = 'geolite2'
+            get_location = locations.get_location_from_geolite2
         else:
-            self.store_location = partial(
-                locations.store_review_location,
-                locations.get_location_from_ip2c, self.connection_pool)
+            backend = 'ip2c'
+            self.ip2c_client = locations.Ip2cClient(
+                max_in_flight=int(self.config['locations'].get('ip2c_max_in_flight', 10)),
+                timeout=float(self.config['locations'].get('ip2c_timeout', 5)))
+            get_location = self.ip2c_client.get_location
+        # timed before caching so only lookups that reach the backend count
+        get_location = metrics.timed_location_lookup(backend, get_location)
+
+        location_cache_size = int(self.config['locations'].get('cache_size', 10000))
+        if location_cache_size > 0:
+            self.location_cache = locations.LocationCache(
+                get_location, maxsize=location_cache_size,
+                ttl=float(self.config['locations'].get('cache_ttl', 3600)),
+                negative_ttl=float(self.config['locations'].get('cache_negative_ttl', 300)))
+            get_location = self.location_cache.get_location
+
+        write_batch_size = int(self.config['locations'].get('write_batch_size', 500))
+        if write_batch_size > 0:
+            overflow = self.config['locations'].get('write_overflow', 'drop')
+            if overflow not in ('drop', 'block'):
+                raise ValueError("Invalid location write overflow policy: {}".format(overflow))
+            self.location_writer = locations.ReviewLocationWriter(
+                self.connection_pool, batch_size=write_batch_size,
+                flush_interval=float(self.config['locations'].get('write_interval', 1)),
+                max_pending=int(self.config['locations'].get('write_max_pending', 10000)),
+                block=overflow == 'block')
+        else:
+            self.location_writer = None
+
+        self.store_location = partial(
+            locations.store_review_location,
+            get_location, self.connection_pool, writer=self.location_writer)
+
+    def log_request(self, handler):
+        super().log_request(handler)
+        metrics.observe_request(handler)
+
+    async def shutdown(self):
+        """stops the background work and writes out anything buffered
+        before stopping the ioloop"""
+        if hasattr(self, 'reputation_scheduler'):
+            self.reputation_scheduler.stop()
+        if self.location_writer is not None:
+            await self.location_writer.close()
+        if hasattr(self, 'ip2c_client'):
+            await self.ip2c_client.close()
+        if hasattr(self, 'slow_queries'):
+            await self.slow_queries.close()
+        IOLoop.current().stop()
 
 
 def main():
     app = Application(urls)
     conn = redis.from_url(app.config['redis']['url'])
     app.q = Queue(connection=conn)
+    if 'push_url' in app.config['reputation']:
+        app.reputation_scheduler = ReputationScheduler(
+            app.q, app.rep_push_urls, app.config['reputation']['signing_key'],
+            quiet_window=float(app.config['reputation'].get('push_quiet_window', 2)),
+            max_delay=float(app.config['reputation'].get('push_max_delay', 30)))
+        app.reputation_scheduler.start()
+    cache_ttl = int(app.config['reputation'].get('cache_ttl', 60))
+    if cache_ttl > 0:
+        app.reputation_cache = ReputationCache(conn, ttl=cache_ttl)
+
+    def handle_signal(sig, frame):
+        IOLoop.current().add_callback_from_signal(app.shutdown)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, handle_signal)
+
     app.start()
@@ -0,0 +1,295 @@
+"""Load test of the review submission, reputation and search endpoints.
+
+usage: python -m toshirep.benchmarks.endpoints [--users N] [--reviews-per-user N]
+           [--zipf S] [--rate R] [--duration SECONDS] [--output FILE]
+
+Starts postgres and redis with testing.postgresql and testing.redis,
+runs the app against them in a subprocess and seeds a synthetic dataset
+where the popularity of reviewees follows a zipf distribution. Each
+endpoint is then sent signed requests at the target rate in turn, and
+the latency percentiles, throughput and database queries per request
+are printed as json along with the commit being benchmarked.
+
+Requests are sent at fixed intervals whether or not earlier requests
+have finished, and latencies are measured from when a request was due
+to be sent, so a slow server shows up as higher latency rather than a
+lower request rate.
+
+Query counts need the pg_stat_statements extension and are null when
+postgres doesn't have it.
+"""
+import argparse
+import asyncio
+import aiohttp
+import asyncpg
+import bisect
+import hashlib
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+import testing.postgresql
+import testing.redis
+
+from toshi.ethereum.utils import private_key_to_address, data_encoder
+from toshi.handlers import TOSHI_TIMESTAMP_HEADER, TOSHI_SIGNATURE_HEADER, TOSHI_ID_ADDRESS_HEADER
+from toshi.redis import build_redis_url
+from toshi.request import sign_request
+
+from toshirep.benchmarks import summarize_latencies, git_commit
+
+ENDPOINTS = ['get_user_rating', 'search_reviews', 'submit_review']
+
+# the statements made by the benchmark itself are left out of the counts
+QUERY_COUNT_SQL = (
+    "SELECT query, calls FROM pg_stat_statements "
+    "WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database()) "
+    "AND query NOT LIKE '%pg_stat_statements%' ORDER BY calls DESC")
+
+class Dataset:
+    """deterministic users with zipf skewed popularity, the user with
+    rank 0 being the most reviewed"""
+
+    def __init__(self, users, zipf, seed=1234):
+        self.rng = random.Random(seed)
+        self.keys = [hashlib.sha256("{}:{}".format(seed, i).encode('utf-8')).digest() for i in range(users)]
+        self.addresses = [private_key_to_address(key) for key in self.keys]
+        self.signing_keys = [data_encoder(key) for key in self.keys]
+        total = 0
+        self.cumulative_weights = []
+        for rank in range(users):
+            total += 1 / (rank + 1) ** zipf
+            self.cumulative_weights.append(total)
+
+    def popular_user(self):
+        """index of a user picked by popularity"""
+        i = bisect.bisect(self.cumulative_weights, self.rng.random() * self.cumulative_weights[-1])
+        return min(i, len(self.addresses) - 1)
+
+    def any_user(self):
+        return self.rng.randrange(len(self.addresses))
+
+    def reviews(self, reviews_per_user):
+        """yields (reviewer_id, reviewee_id, rating, review, created, updated)
+        rows, each user reviewing `reviews_per_user` distinct users"""
+        reviews_per_user = min(reviews_per_user, len(self.addresses) - 1)
+        now = datetime.utcnow()
+        for reviewer in range(len(self.addresses)):
+            reviewees = set()
+            while len(reviewees) < reviews_per_user:
+                reviewee = self.popular_user()
+                if reviewee != reviewer:
+                    reviewees.add(reviewee)
+            for reviewee in sorted(reviewees):
+                updated = now - timedelta(seconds=self.rng.randrange(365 * 24 * 3600))
+                yield (self.addresses[reviewer], self.addresses[reviewee],
+                       self.rng.randint(0, 10) / 2, "review", updated, updated)
+
+async def seed_reviews(con, dataset, reviews_per_user, batch_size=10000):
+    insert = ("INSERT INTO reviews (reviewer_id, reviewee_id, rating, review, created, updated) "
+              "SELECT * FROM unnest($1::varchar[], $2::varchar[], $3::decimal[], $4::varchar[], "
+              "$5::timestamp[], $6::timestamp[])")
+    count = 0
+    batch = []
+    for row in dataset.reviews(reviews_per_user):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            await con.execute(insert, *[list(values) for values in zip(*batch)])
+            count += len(batch)
+            batch = []
+    if batch:
+        await con.execute(insert, *[list(values) for values in zip(*batch)])
+        count += len(batch)
+    await con.execute("ANALYZE")
+    return count
+
+def build_request(endpoint, base_url, dataset):
+    """returns the (method, url, headers, body) of a request to the endpoint"""
+
+    if endpoint == 'get_user_rating':
+        return 'GET', "{}/v1/user/{}".format(base_url, dataset.addresses[dataset.popular_user()]), {}, None
+    if endpoint == 'search_reviews':
+        return 'GET', "{}/v1/search/review?reviewee={}&limit=10".format(
+            base_url, dataset.addresses[dataset.popular_user()]), {}, None
+
+    reviewer = dataset.any_user()
+    reviewee = dataset.popular_user()
+    if reviewee == reviewer:
+        reviewee = (reviewee + 1) % len(dataset.addresses)
+    body = json.dumps({"reviewee": dataset.addresses[reviewee],
+                       "rating": dataset.rng.randint(0, 10) / 2,
+                       "review": "benchmark"}).encode('utf-8')
+    timestamp = int(time.time())
+    path = "/v1/review/submit"
+    headers = {
+        'content-type': 'application/json',
+        'X-Forwarded-For': "44.{}.{}.{}".format(*[dataset.rng.randrange(256) for _ in range(3)]),
+        TOSHI_SIGNATURE_HEADER: sign_request(dataset.signing_keys[reviewer], 'POST', path, timestamp, body),
+        TOSHI_ID_ADDRESS_HEADER: dataset.addresses[reviewer],
+        TOSHI_TIMESTAMP_HEADER: str(timestamp)
+    }
+    return 'POST', base_url + path, headers, body
+
+async def run_load(session, endpoint, base_url, dataset, rate, duration):
+    """sends requests to the endpoint at `rate` per second for `duration`
+    seconds, returning the latencies, error count and elapsed time"""
+
+    latencies = []
+    errors = []
+
+    async def send(due, method, url, headers, body):
+        try:
+            with aiohttp.Timeout(30):
+                async with session.request(method, url, headers=headers, data=body) as response:
+                    await response.read()
+                    if response.status >= 400:
+                        errors.append(response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            errors.append(None)
+        latencies.append(time.perf_counter() - due)
+
+    loop = asyncio.get_event_loop()
+    start = time.perf_counter()
+    requests = []
+    for i in range(int(rate * duration)):
+        due = start + i / rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        requests.append(loop.create_task(send(due, *build_request(endpoint, base_url, dataset))))
+    await asyncio.gather(*requests)
+    return latencies, errors, time.perf_counter() - start
+
+async def reset_query_counts(con):
+    try:
+        await con.execute("SELECT pg_stat_statements_reset()")
+        return True
+    except asyncpg.exceptions.PostgresError:
+        return False
+
+async def benchmark(database_url, base_url, args):
+    con = await asyncpg.connect(dsn=database_url)
+    try:
+        try:
+            await con.execute("CREATE EXTENSION IF NOT EXISTS pg_stat_statements")
+        except asyncpg.exceptions.PostgresError:
+            pass
+
+        dataset = Dataset(args.users, args.zipf, seed=args.seed)
+        start = time.perf_counter()
+        reviews = await seed_reviews(con, dataset, args.reviews_per_user)
+        report = {
+            'dataset': {'users': args.users, 'reviews': reviews, 'zipf': args.zipf,
+                        'seed_seconds': round(time.perf_counter() - start, 3)},
+            'endpoints': {}
+        }
+
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        with aiohttp.ClientSession(connector=connector) as session:
+            for endpoint in args.endpoints:
+                if args.warmup > 0:
+                    await run_load(session, endpoint, base_url, dataset, args.rate, args.warmup)
+                # let buffered writes from earlier requests finish first
+                await asyncio.sleep(2)
+                has_query_counts = await reset_query_counts(con)
+
+                latencies, errors, elapsed = await run_load(
+                    session, endpoint, base_url, dataset, args.rate, args.duration)
+
+                result = summarize_latencies(latencies)
+                result['errors'] = len(errors)
+                result['target_rate'] = args.rate
+                result['throughput'] = round(len(latencies) / elapsed, 2)
+                result['queries_per_request'] = None
+                result['top_queries'] = None
+                if has_query_counts:
+                    await asyncio.sleep(2)
+                    rows = await con.fetch(QUERY_COUNT_SQL)
+                    result['queries_per_request'] = round(sum(row['calls'] for row in rows) / len(latencies), 2)
+                    result['top_queries'] = [{'query': row['query'], 'calls': row['calls']} for row in rows[:5]]
+                report['endpoints'][endpoint] = result
+        return report
+    finally:
+        await con.close()
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _start_postgresql():
+    try:
+        return testing.postgresql.Postgresql(
+            postgres_args="-h 127.0.0.1 -F -c logging_collector=off "
+                          "-c shared_preload_libraries=pg_stat_statements")
+    except RuntimeError:
+        # pg_stat_statements isn't installed
+        return testing.postgresql.Postgresql()
+
+async def _wait_for_app(base_url, process, timeout=30):
+    deadline = time.time() + timeout
+    with aiohttp.ClientSession() as session:
+        while time.time() < deadline:
+            if process.poll() is not None:
+                raise Exception("The app exited with {}".format(process.returncode))
+            try:
+                async with session.get(base_url + "/v1/timestamp") as response:
+                    if response.status == 200:
+                        return
+            except (aiohttp.ClientError, OSError):
+                pass
+            await asyncio.sleep(0.2)
+    raise Exception("Timed out waiting for the app to start")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the http endpoints")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--reviews-per-user', type=int, default=10)
+    parser.add_argument('--zipf', type=float, default=1.1, help="skew of the reviewee popularity")
+    parser.add_argument('--rate', type=float, default=100, help="requests per second")
+    parser.add_argument('--duration', type=float, default=10, help="seconds per endpoint")
+    parser.add_argument('--warmup', type=float, default=2, help="seconds of unmeasured requests per endpoint")
+    parser.add_argument('--concurrency', type=int, default=100, help="maximum open connections")
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=ENDPOINTS)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--app-log', help="file to write the app's output to")
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout)
+    args = parser.parse_args(argv)
+
+    loop = asyncio.get_event_loop()
+    with _start_postgresql() as postgresql, testing.redis.RedisServer() as redis_server:
+        port = _free_port()
+        env = {key: value for key, value in os.environ.items()
+               if not key.startswith('REPUTATION_PUSH') and key not in ('GEOIP_DATABASE_FILE', 'GEOLITE2_CSV_DIR')}
+        env['DATABASE_URL'] = postgresql.url()
+        env['REDIS_URL'] = build_redis_url(**redis_server.dsn())
+        # look locations up in the (empty) local GeoLite2 tables rather
+        # than sending requests to ip2c.org
+        env['USE_GEOLITE2'] = '1'
+        app_log = open(args.app_log, 'w') if args.app_log else subprocess.DEVNULL
+        process = subprocess.Popen([sys.executable, '-m', 'toshirep', '--port={}'.format(port)],
+                                   env=env, stdout=app_log, stderr=subprocess.STDOUT)
+        try:
+            base_url = "http://127.0.0.1:{}".format(port)
+            loop.run_until_complete(_wait_for_app(base_url, process))
+            report = loop.run_until_complete(benchmark(postgresql.url(), base_url, args))
+        finally:
+            process.terminate()
+            process.wait()
+            if args.app_log:
+                app_log.close()
+
+    report['commit'] = git_commit()
+    report['config'] = {'rate': args.rate, 'duration': args.duration, 'warmup': args.warmup,
+                        'concurrency': args.concurrency, 'reviews_per_user': args.reviews_per_user,
+                        'seed': args.seed}
+    json.dump(report, args.output, indent=2)
+    args.output.write("\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Compares the containment query on geolite2_ip_addresses with the
+range lookup on geolite2_lookup.
+
+usage: python -m toshirep.benchmarks.geolite2_lookup [--samples N]
+
+Requires `DATABASE_URL` pointing at a database with the full GeoLite2
+data imported. Prints the query plans and the latency of each query
+over the same sample of ip addresses as json.
+"""
+import argparse
+import asyncio
+import asyncpg
+import ipaddress
+import json
+import os
+import random
+import sys
+import time
+
+from toshirep.benchmarks import summarize_latencies
+from toshirep.locations import GEOLITE2_LOOKUP_SQL
+
+CONTAINMENT_SQL = (
+    "SELECT cs.country_iso_code FROM geolite2_ip_addresses ips "
+    "JOIN geolite2_countries cs ON ips.geoname_id = cs.geoname_id "
+    "WHERE ips.network >> $1")
+
+QUERIES = [
+    ('containment', CONTAINMENT_SQL),
+    ('range_lookup', GEOLITE2_LOOKUP_SQL)
+]
+
+def _format_ip(value, version):
+    ip_addr = ipaddress.ip_address(value) if version == 4 else ipaddress.IPv6Address(value)
+    return "{}/{}".format(ip_addr, 32 if version == 4 else 128)
+
+async def sample_addresses(con, samples, rng):
+    """returns ip addresses from random networks, plus a quarter of
+    uniformly random IPv4 addresses which may not be in any network"""
+
+    rows = await con.fetch(
+        "SELECT range_start, range_end FROM geolite2_lookup ORDER BY random() LIMIT $1", samples)
+    addresses = []
+    for row in rows:
+        start = ipaddress.ip_interface(str(row['range_start'])).ip
+        end = ipaddress.ip_interface(str(row['range_end'])).ip
+        addresses.append(_format_ip(rng.randint(int(start), int(end)), start.version))
+    for _ in range(samples // 4):
+        addresses.append(_format_ip(rng.getrandbits(32), 4))
+    rng.shuffle(addresses)
+    return addresses
+
+async def run(con, samples, seed=1234):
+    rng = random.Random(seed)
+    addresses = await sample_addresses(con, samples, rng)
+    if not addresses:
+        raise Exception("geolite2_lookup is empty, import the GeoLite2 data first")
+
+    report = {'samples': len(addresses), 'queries': {}}
+    results = {}
+    for name, sql in QUERIES:
+        plan = await con.fetch("EXPLAIN (ANALYZE, BUFFERS) " + sql, addresses[0])
+        # warm up the cache so both queries are measured the same way
+        for ip_addr in addresses[:100]:
+            await con.fetchrow(sql, ip_addr)
+
+        latencies = []
+        results[name] = []
+        for ip_addr in addresses:
+            start = time.perf_counter()
+            row = await con.fetchrow(sql, ip_addr)
+            latencies.append(time.perf_counter() - start)
+            results[name].append(row['country_iso_code'] if row else None)
+
+        report['queries'][name] = {
+            'plan': [row[0] for row in plan],
+            'latency': summarize_latencies(latencies)
+        }
+
+    report['mismatches'] = sum(1 for a, b in zip(*results.values()) if a != b)
+    return report
+
+async def _run(database_config, samples):
+    con = await asyncpg.connect(**database_config)
+    try:
+        return await run(con, samples)
+    finally:
+        await con.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the GeoLite2 lookup queries")
+    parser.add_argument('--samples', type=int, default=10000)
+    args = parser.parse_args(argv)
+
+    if 'DATABASE_URL' not in os.environ:
+        print("ENVIRONMENT MISSING `DATABASE_URL`", file=sys.stderr)
+        sys.exit(1)
+
+    loop = asyncio.get_event_loop()
+    report = loop.run_until_complete(_run({'dsn': os.environ['DATABASE_URL']}, args.samples))
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
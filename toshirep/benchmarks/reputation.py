@@ -0,0 +1,179 @@
+"""Measures how calculating a reputation scales with the number of reviews.
+
+usage: python -m toshirep.benchmarks.reputation [--scales N [N ...]] [--iterations N] [--database-url URL]
+
+For a reviewee with each number of reviews (1, 100, 10k and 1M by
+default) this times `calculate_user_reputation`, recomputing the
+reputation from `reviews` the way `toshirep.reputation` verifies it, and
+`starsort` on the reviewee's star counts. Each is reported with the
+number of queries made per call, the latency percentiles and the memory
+allocated by a single call, as json.
+
+Runs against a temporary database started with testing.postgresql.
+`--database-url` runs it against an existing database instead, which
+should not be a production one. The reviews are inserted in a
+transaction that is rolled back at the end, but inserting them still
+fires the aggregate triggers and writes WAL.
+"""
+import argparse
+import asyncio
+import asyncpg
+import json
+import os
+import sys
+import time
+import timeit
+import tracemalloc
+
+from toshirep.benchmarks import summarize_latencies, git_commit
+from toshirep.reputation import AGGREGATE_SELECT_SQL
+from toshirep.tasks import calculate_user_reputation, starsort
+
+SCALES = [1, 100, 10000, 1000000]
+
+CREATE_TABLES_SQL = os.path.join(os.path.dirname(__file__), '..', '..', 'sql', 'create_tables.sql')
+
+# the aggregate `toshirep.reputation` verifies against, for a single reviewee
+RECOMPUTE_SQL = AGGREGATE_SELECT_SQL + "WHERE reviewee_id = $1 GROUP BY reviewee_id"
+
+class CountingConnection:
+    """forwards the query methods to the connection, counting the queries"""
+
+    def __init__(self, con):
+        self.con = con
+        self.queries = 0
+
+    async def execute(self, *args, **kwargs):
+        self.queries += 1
+        return await self.con.execute(*args, **kwargs)
+
+    async def fetch(self, *args, **kwargs):
+        self.queries += 1
+        return await self.con.fetch(*args, **kwargs)
+
+    async def fetchrow(self, *args, **kwargs):
+        self.queries += 1
+        return await self.con.fetchrow(*args, **kwargs)
+
+    async def fetchval(self, *args, **kwargs):
+        self.queries += 1
+        return await self.con.fetchval(*args, **kwargs)
+
+def reviewee_address(reviews):
+    return "0x{:040x}".format(0xbe0000000 + reviews)
+
+async def seed_reviewee(con, reviews):
+    """adds `reviews` reviews of a reviewee with a spread of ratings,
+    returning the reviewee's address"""
+
+    reviewee_id = reviewee_address(reviews)
+    await con.execute(
+        "INSERT INTO reviews (reviewer_id, reviewee_id, rating, review) "
+        "SELECT '0x' || lpad(to_hex(i), 40, '0'), $1, ((i * 7919) % 11) / 2.0, 'benchmark' "
+        "FROM generate_series(1, $2) AS i",
+        reviewee_id, reviews)
+    await con.execute("ANALYZE reviews")
+    await con.execute("ANALYZE reviewee_reputation")
+    return reviewee_id
+
+async def measure(fn, iterations):
+    """times `iterations` calls of the coroutine function, then traces the
+    memory allocated by a single call"""
+
+    # warm up the statement cache and the database's buffers
+    await fn()
+
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await fn()
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        await fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    result = summarize_latencies(latencies)
+    result['peak_allocated_bytes'] = peak
+    return result
+
+def measure_starsort(ns, iterations):
+    timer = timeit.Timer(lambda: starsort(ns))
+    seconds = min(timer.repeat(repeat=5, number=iterations)) / iterations
+
+    tracemalloc.start()
+    try:
+        starsort(ns)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'mean_us': round(seconds * 1000000, 3), 'peak_allocated_bytes': peak}
+
+async def benchmark(con, scales, iterations, recompute_iterations):
+    report = {'iterations': iterations, 'scales': {}}
+    tr = con.transaction()
+    await tr.start()
+    try:
+        for reviews in scales:
+            start = time.perf_counter()
+            reviewee_id = await seed_reviewee(con, reviews)
+            result = {'seed_seconds': round(time.perf_counter() - start, 3)}
+
+            counting = CountingConnection(con)
+            result['calculate_user_reputation'] = await measure(
+                lambda: calculate_user_reputation(counting, reviewee_id), iterations)
+            result['calculate_user_reputation']['queries_per_call'] = counting.queries / (iterations + 2)
+
+            counting = CountingConnection(con)
+            result['recompute_from_reviews'] = await measure(
+                lambda: counting.fetchrow(RECOMPUTE_SQL, reviewee_id), recompute_iterations)
+            result['recompute_from_reviews']['queries_per_call'] = counting.queries / (recompute_iterations + 2)
+
+            row = await con.fetchrow("SELECT * FROM reviewee_reputation WHERE reviewee_id = $1", reviewee_id)
+            ns = (row['stars_5'], row['stars_4'], row['stars_3'], row['stars_2'], row['stars_1'])
+            result['starsort'] = measure_starsort(ns, iterations)
+
+            report['scales'][str(reviews)] = result
+            print("{} reviews: {}ms per reputation".format(
+                reviews, result['calculate_user_reputation']['mean_ms']), file=sys.stderr)
+    finally:
+        await tr.rollback()
+    return report
+
+async def _run(database_config, args, create_tables=False):
+    con = await asyncpg.connect(**database_config)
+    try:
+        if create_tables:
+            with open(CREATE_TABLES_SQL) as f:
+                await con.execute(f.read())
+        return await benchmark(con, args.scales, args.iterations, args.recompute_iterations)
+    finally:
+        await con.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the reputation calculation")
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES, help="numbers of reviews")
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--recompute-iterations', type=int, default=20,
+                        help="iterations of the recompute from reviews, which scans every review")
+    parser.add_argument('--database-url',
+                        help="run against this existing database instead of a temporary one")
+    args = parser.parse_args(argv)
+
+    loop = asyncio.get_event_loop()
+    if args.database_url:
+        report = loop.run_until_complete(_run({'dsn': args.database_url}, args))
+    else:
+        import testing.postgresql
+        with testing.postgresql.Postgresql() as postgresql:
+            report = loop.run_until_complete(_run({'dsn': postgresql.url()}, args, create_tables=True))
+
+    report['commit'] = git_commit()
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import redis
+import time
+
+from collections import OrderedDict
+
+from toshi.log import log
+
+# returns the cached payload and the reviewee's cache generation, and
+# counts the hit/miss, in a single round trip
+_GET_SCRIPT = """
+local payload = redis.call('GET', KEYS[1])
+local generation = redis.call('GET', KEYS[2])
+if payload then
+    redis.call('HINCRBY', KEYS[3], 'hits', 1)
+else
+    redis.call('HINCRBY', KEYS[3], 'misses', 1)
+end
+return {payload or '', generation or ''}
+"""
+
+# only stores the payload if no invalidation happened since the
+# generation was read, so a read that raced with a write can never
+# put a stale value back in the cache
+_SET_SCRIPT = """
+local generation = redis.call('GET', KEYS[2]) or ''
+if generation == ARGV[1] then
+    redis.call('SETEX', KEYS[1], ARGV[2], ARGV[3])
+    return 1
+end
+return 0
+"""
+
+class ReputationCache:
+    """Read-through cache of the rendered `/v1/user/{reviewee}` payload"""
+
+    def __init__(self, connection, ttl=60, prefix="toshirep:reputation"):
+        self.redis = connection
+        self.ttl = ttl
+        self.prefix = prefix
+        self.stats_key = "{}:stats".format(prefix)
+        self._get = self.redis.register_script(_GET_SCRIPT)
+        self._set = self.redis.register_script(_SET_SCRIPT)
+
+    def _keys(self, reviewee):
+        return ["{}:user:{}".format(self.prefix, reviewee),
+                "{}:gen:{}".format(self.prefix, reviewee)]
+
+    def get(self, reviewee):
+        """returns a tuple of the cached payload (or None if it isn't cached)
+        and the generation which must be passed to `set` after a miss"""
+
+        try:
+            payload, generation = self._get(keys=self._keys(reviewee) + [self.stats_key])
+        except redis.exceptions.RedisError:
+            log.exception("Error reading reputation cache")
+            return None, None
+        return payload or None, generation
+
+    def set(self, reviewee, payload, generation):
+        if generation is None:
+            return
+        try:
+            self._set(keys=self._keys(reviewee), args=[generation, self.ttl, payload])
+        except redis.exceptions.RedisError:
+            log.exception("Error writing reputation cache")
+
+    def invalidate(self, reviewee):
+        self.invalidate_many([reviewee])
+
+    def invalidate_many(self, reviewees, batch_size=1000):
+        try:
+            for i in range(0, len(reviewees), batch_size):
+                pipe = self.redis.pipeline()
+                for reviewee in reviewees[i:i + batch_size]:
+                    key, generation_key = self._keys(reviewee)
+                    pipe.incr(generation_key)
+                    pipe.expire(generation_key, max(self.ttl * 10, 3600))
+                    pipe.delete(key)
+                pipe.hincrby(self.stats_key, 'invalidations', len(reviewees[i:i + batch_size]))
+                pipe.execute()
+        except redis.exceptions.RedisError:
+            log.exception("Error invalidating reputation cache")
+
+    def stats(self):
+        stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        for key, value in self.redis.hgetall(self.stats_key).items():
+            stats[key.decode('utf-8')] = int(value)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+class TTLCache:
+    """Bounded in process LRU cache whose entries expire after `ttl` seconds"""
+
+    def __init__(self, maxsize=1024, ttl=10, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires = entry
+            if expires > self.timer():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        self._entries[key] = (value, self.timer() + (self.ttl if ttl is None else ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,178 @@
+"""Imports the GeoLite2 Country CSV files into postgres without
+interrupting lookups.
+
+usage: python -m toshirep.geoimport CSV_DIR
+
+The CSV files are streamed into staging tables, which are indexed and
+analyzed before being swapped with the live tables in a single
+transaction, so `locations.get_location_from_geolite2` sees either the
+old or the new data but never empty or partial tables.
+"""
+import argparse
+import asyncio
+import asyncpg
+import csv
+import ipaddress
+import logging
+import os
+import sys
+import time
+
+from toshirep.geoip import IPV4_BLOCKS_CSV, IPV6_BLOCKS_CSV, LOCATIONS_CSV
+
+log = logging.getLogger("toshirep.geoimport")
+
+IP_ADDRESS_COLUMNS = ['network', 'geoname_id', 'registered_country_geoname_id',
+                      'represented_country_geoname_id', 'is_anonymous_proxy', 'is_satellite_provider']
+IP_ADDRESS_TYPES = ['cidr', 'int', 'int', 'int', 'bool', 'bool']
+COUNTRY_COLUMNS = ['geoname_id', 'locale_code', 'continent_code', 'continent_name',
+                   'country_iso_code', 'country_name']
+COUNTRY_TYPES = ['int', 'varchar', 'varchar', 'varchar', 'varchar', 'varchar']
+LOOKUP_COLUMNS = ['range_start', 'range_end', 'country_iso_code']
+LOOKUP_TYPES = ['inet', 'inet', 'varchar']
+
+# builds the denormalized lookup table from the imported tables
+LOOKUP_SQL = (
+    "INSERT INTO {lookup} (range_start, range_end, country_iso_code) "
+    "SELECT set_masklen(ips.network, CASE family(ips.network) WHEN 4 THEN 32 ELSE 128 END), "
+    "set_masklen(broadcast(ips.network), CASE family(ips.network) WHEN 4 THEN 32 ELSE 128 END), "
+    "cs.country_iso_code "
+    "FROM {ip_addresses} ips JOIN {countries} cs ON ips.geoname_id = cs.geoname_id")
+
+# tables are swapped in this order, every table has a staging version
+# with a `_new` suffix and indexes that are renamed along with it
+TABLES = [
+    ('geolite2_ip_addresses', IP_ADDRESS_COLUMNS, IP_ADDRESS_TYPES,
+     [('geolite2_ip_addresses_network_idx', "USING GIST (network inet_ops)")]),
+    ('geolite2_countries', COUNTRY_COLUMNS, COUNTRY_TYPES,
+     [('geolite2_ip_countries_geoname_id_idx', "(geoname_id)")]),
+    ('geolite2_lookup', LOOKUP_COLUMNS, LOOKUP_TYPES,
+     [('geolite2_lookup_range_start_idx', "(range_start)")])
+]
+
+def _int(value):
+    return int(value) if value else None
+
+def _bool(value):
+    return value == '1' if value else None
+
+def read_ip_addresses(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            yield (ipaddress.ip_network(row['network']),
+                   _int(row['geoname_id']),
+                   _int(row['registered_country_geoname_id']),
+                   _int(row['represented_country_geoname_id']),
+                   _bool(row['is_anonymous_proxy']),
+                   _bool(row['is_satellite_provider']))
+
+def read_countries(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            yield (int(row['geoname_id']),) + tuple(row[column] or None for column in COUNTRY_COLUMNS[1:])
+
+async def copy_rows(con, table, columns, types, rows, batch_size=10000):
+    """writes the rows to the table in batches, returning the number of rows
+    written.
+
+    Uses COPY when the connection supports it, otherwise a multi-row insert
+    of unnested arrays per batch."""
+
+    insert = "INSERT INTO {} ({}) SELECT * FROM unnest({})".format(
+        table, ", ".join(columns), ", ".join("${}::{}[]".format(i + 1, t) for i, t in enumerate(types)))
+
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            count += await _write_batch(con, table, columns, insert, batch)
+            batch = []
+    if batch:
+        count += await _write_batch(con, table, columns, insert, batch)
+    return count
+
+async def _write_batch(con, table, columns, insert, batch):
+    if hasattr(con, 'copy_records_to_table'):
+        await con.copy_records_to_table(table, records=batch, columns=columns)
+    else:
+        await con.execute(insert, *[list(values) for values in zip(*batch)])
+    return len(batch)
+
+def _create_table_sql(table, columns, types):
+    return "CREATE TABLE {} ({})".format(
+        table, ", ".join("{} {}".format(c, t.upper()) for c, t in zip(columns, types)))
+
+async def import_geolite2(con, csv_dir, batch_size=10000):
+    """imports the csv files from `csv_dir` and swaps them in, returning a
+    dict with the row counts and the time in seconds each step took"""
+
+    report = {'rows': {}, 'timings': {}}
+
+    def timed(step, start):
+        report['timings'][step] = round(time.perf_counter() - start, 3)
+        log.info("{} took {}s".format(step, report['timings'][step]))
+
+    start = time.perf_counter()
+    for table, columns, types, _ in TABLES:
+        await con.execute("DROP TABLE IF EXISTS {}_new".format(table))
+        await con.execute(_create_table_sql("{}_new".format(table), columns, types))
+
+    rows = 0
+    for filename in [IPV4_BLOCKS_CSV, IPV6_BLOCKS_CSV]:
+        path = os.path.join(csv_dir, filename)
+        if os.path.exists(path):
+            rows += await copy_rows(con, "geolite2_ip_addresses_new", IP_ADDRESS_COLUMNS, IP_ADDRESS_TYPES,
+                                    read_ip_addresses(path), batch_size=batch_size)
+    report['rows']['geolite2_ip_addresses'] = rows
+    report['rows']['geolite2_countries'] = await copy_rows(
+        con, "geolite2_countries_new", COUNTRY_COLUMNS, COUNTRY_TYPES,
+        read_countries(os.path.join(csv_dir, LOCATIONS_CSV)), batch_size=batch_size)
+    await con.execute(LOOKUP_SQL.format(
+        lookup="geolite2_lookup_new", ip_addresses="geolite2_ip_addresses_new", countries="geolite2_countries_new"))
+    row = await con.fetchrow("SELECT COUNT(*) FROM geolite2_lookup_new")
+    report['rows']['geolite2_lookup'] = row['count']
+    timed('load', start)
+
+    start = time.perf_counter()
+    for table, _, _, indexes in TABLES:
+        for index, definition in indexes:
+            await con.execute("CREATE INDEX {}_new ON {}_new {}".format(index, table, definition))
+        await con.execute("ANALYZE {}_new".format(table))
+    timed('index', start)
+
+    start = time.perf_counter()
+    async with con.transaction():
+        for table, _, _, indexes in TABLES:
+            await con.execute("DROP TABLE IF EXISTS {} CASCADE".format(table))
+            await con.execute("ALTER TABLE {0}_new RENAME TO {0}".format(table))
+            for index, _ in indexes:
+                await con.execute("ALTER INDEX {0}_new RENAME TO {0}".format(index))
+    timed('swap', start)
+
+    for table, count in report['rows'].items():
+        log.info("Imported {} rows into {}".format(count, table))
+    return report
+
+async def _run(csv_dir, database_config):
+    con = await asyncpg.connect(**database_config)
+    try:
+        return await import_geolite2(con, csv_dir)
+    finally:
+        await con.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import the GeoLite2 country csv files")
+    parser.add_argument('csv_dir')
+    args = parser.parse_args(argv)
+
+    if 'DATABASE_URL' not in os.environ:
+        log.error("ENVIRONMENT MISSING `DATABASE_URL`")
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_run(args.csv_dir, {'dsn': os.environ['DATABASE_URL']}))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+"""In process lookup of the country of an ip address from the GeoLite2
+Country CSV files, as downloaded by `configure_environment.sh`.
+
+The blocks are loaded once into sorted arrays of the integer start and
+end of every network, so lookups are a binary search instead of a
+database query per review.
+
+usage: python -m toshirep.geoip compile CSV_DIR OUTPUT
+       python -m toshirep.geoip lookup DATABASE IP [IP ...]
+
+`compile` writes the same ranges to a binary file which `GeoIPDatabase`
+memory maps, so every process shares a single copy of the data through
+the page cache and doesn't have to parse the CSV files at startup.
+"""
+import argparse
+import csv
+import ipaddress
+import logging
+import mmap
+import os
+import socket
+import struct
+import sys
+
+from array import array
+from bisect import bisect_right
+
+log = logging.getLogger("toshirep.geoip")
+
+IPV4_BLOCKS_CSV = "GeoLite2-Country-Blocks-IPv4.csv"
+IPV6_BLOCKS_CSV = "GeoLite2-Country-Blocks-IPv6.csv"
+LOCATIONS_CSV = "GeoLite2-Country-Locations-en.csv"
+
+def _parse_network(network, family, bits):
+    address, prefix = network.split('/')
+    start = int.from_bytes(socket.inet_pton(family, address), 'big')
+    size = 1 << (bits - int(prefix))
+    # clear any host bits so the range matches postgres' cidr semantics
+    start &= ~(size - 1)
+    return start, start + size - 1
+
+def read_locations(path):
+    """returns a dict mapping geoname ids to country iso codes"""
+    countries = {}
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            if row['country_iso_code']:
+                countries[int(row['geoname_id'])] = row['country_iso_code']
+    return countries
+
+def read_blocks(path, family, bits):
+    """returns a sorted list of (start, end, geoname_id) tuples for every
+    network in the blocks csv that has a geoname id"""
+    blocks = []
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            if not row['geoname_id']:
+                continue
+            start, end = _parse_network(row['network'], family, bits)
+            blocks.append((start, end, int(row['geoname_id'])))
+    blocks.sort()
+    return blocks
+
+_LOW_64 = (1 << 64) - 1
+
+def _find_ipv6(start_high, start_low, end_high, end_low, value):
+    """returns the index of the IPv6 range containing `value`, or -1.
+
+    The 128 bit starts and ends are split into parallel arrays of their
+    high and low 64 bits, and the starts are bisected on the
+    (high, low) pairs."""
+    high, low = value >> 64, value & _LOW_64
+    lo, hi = 0, len(start_high)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if high < start_high[mid] or (high == start_high[mid] and low < start_low[mid]):
+            hi = mid
+        else:
+            lo = mid + 1
+    i = lo - 1
+    if i >= 0 and (high < end_high[i] or (high == end_high[i] and low <= end_low[i])):
+        return i
+    return -1
+
+class GeoLite2Index:
+    """Sorted interval index of the GeoLite2 country blocks.
+
+    IPv4 ranges are stored in `array('I')`s. IPv6 ranges don't fit in a
+    fixed width array type, so their starts and ends are split into
+    `array('Q')`s of the high and low 64 bits. The country of every
+    range is stored as an index into `countries`."""
+
+    def __init__(self, countries, ipv4_blocks, ipv6_blocks):
+        self.countries = [None] + sorted(set(countries.values()))
+        country_index = {code: i for i, code in enumerate(self.countries)}
+
+        def build(blocks):
+            codes = array('H')
+            for _, _, geoname_id in blocks:
+                codes.append(country_index.get(countries.get(geoname_id), 0))
+            return codes
+
+        self.ipv4_starts = array('I', (start for start, _, _ in ipv4_blocks))
+        self.ipv4_ends = array('I', (end for _, end, _ in ipv4_blocks))
+        self.ipv4_countries = build(ipv4_blocks)
+        self.ipv6_start_high = array('Q', (start >> 64 for start, _, _ in ipv6_blocks))
+        self.ipv6_start_low = array('Q', (start & _LOW_64 for start, _, _ in ipv6_blocks))
+        self.ipv6_end_high = array('Q', (end >> 64 for _, end, _ in ipv6_blocks))
+        self.ipv6_end_low = array('Q', (end & _LOW_64 for _, end, _ in ipv6_blocks))
+        self.ipv6_countries = build(ipv6_blocks)
+
+    @classmethod
+    def from_csv_dir(cls, path):
+        countries = read_locations(os.path.join(path, LOCATIONS_CSV))
+        ipv4_blocks = read_blocks(os.path.join(path, IPV4_BLOCKS_CSV), socket.AF_INET, 32)
+        ipv6_path = os.path.join(path, IPV6_BLOCKS_CSV)
+        if os.path.exists(ipv6_path):
+            ipv6_blocks = read_blocks(ipv6_path, socket.AF_INET6, 128)
+        else:
+            ipv6_blocks = []
+        log.info("Loaded {} IPv4 and {} IPv6 GeoLite2 networks".format(len(ipv4_blocks), len(ipv6_blocks)))
+        return cls(countries, ipv4_blocks, ipv6_blocks)
+
+    def __len__(self):
+        return len(self.ipv4_starts) + len(self.ipv6_countries)
+
+    def lookup(self, ip_addr):
+        """returns the country iso code of the ip address, or None if the
+        address is invalid or not in any known network"""
+
+        try:
+            ip_addr = ipaddress.ip_address(ip_addr)
+        except ValueError:
+            return None
+        if ip_addr.version == 6 and ip_addr.ipv4_mapped is not None:
+            ip_addr = ip_addr.ipv4_mapped
+
+        value = int(ip_addr)
+        if ip_addr.version == 6:
+            i = _find_ipv6(self.ipv6_start_high, self.ipv6_start_low,
+                           self.ipv6_end_high, self.ipv6_end_low, value)
+            return self.countries[self.ipv6_countries[i]] if i >= 0 else None
+        i = bisect_right(self.ipv4_starts, value) - 1
+        if i >= 0 and value <= self.ipv4_ends[i]:
+            return self.countries[self.ipv4_countries[i]]
+        return None
+
+    async def get_location(self, pool, ip_addr):
+        """`locations.store_review_location` compatible lookup, the
+        pool is unused"""
+        return self.lookup(ip_addr)
+
+# binary database layout, all values in native byte order:
+#
+#   header      magic, version, byte order, country count, IPv4 count, IPv6 count
+#   countries   2 byte ascii iso code per country, index 0 is no country
+#   IPv4        u32 starts, u32 ends, u16 country indexes
+#   IPv6        u64 start high bits, u64 start low bits, u64 end high
+#               bits, u64 end low bits, u16 country indexes
+#
+# every section is padded to a multiple of 8 bytes
+DATABASE_MAGIC = b'TGEO'
+DATABASE_VERSION = 1
+_HEADER = struct.Struct('<4sHHIII')
+_BYTE_ORDERS = {'little': 1, 'big': 2}
+
+def _padding(size):
+    return -size % 8
+
+def compile_database(csv_dir, output):
+    """compiles the GeoLite2 CSV files in `csv_dir` into a binary
+    database at `output`, returning the number of networks written.
+
+    The file is written next to `output` and renamed into place, so
+    processes with the previous file mapped are unaffected."""
+
+    index = GeoLite2Index.from_csv_dir(csv_dir)
+    if len(index.countries) > 0xffff:
+        raise ValueError("Too many countries")
+
+    sections = [
+        b''.join((code or '').encode('ascii').ljust(2, b'\0') for code in index.countries),
+        index.ipv4_starts, index.ipv4_ends, index.ipv4_countries,
+        index.ipv6_start_high, index.ipv6_start_low, index.ipv6_end_high, index.ipv6_end_low,
+        index.ipv6_countries
+    ]
+
+    tmp = "{}.tmp".format(output)
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(DATABASE_MAGIC, DATABASE_VERSION, _BYTE_ORDERS[sys.byteorder],
+                             len(index.countries), len(index.ipv4_starts), len(index.ipv6_countries)))
+        f.write(b'\0' * _padding(_HEADER.size))
+        for section in sections:
+            data = section if isinstance(section, bytes) else section.tobytes()
+            f.write(data)
+            f.write(b'\0' * _padding(len(data)))
+    os.replace(tmp, output)
+    return len(index)
+
+class GeoIPDatabase:
+    """Lookups against a memory mapped database written by `compile_database`"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, byte_order, country_count, ipv4_count, ipv6_count = _HEADER.unpack_from(self._mmap)
+        if magic != DATABASE_MAGIC or version != DATABASE_VERSION:
+            raise ValueError("{} is not a version {} GeoIP database".format(path, DATABASE_VERSION))
+        if byte_order != _BYTE_ORDERS[sys.byteorder]:
+            raise ValueError("{} was compiled for a different byte order".format(path))
+
+        view = memoryview(self._mmap)
+        offset = _HEADER.size + _padding(_HEADER.size)
+
+        def section(size, fmt=None):
+            nonlocal offset
+            data = view[offset:offset + size]
+            offset += size + _padding(size)
+            return data.cast(fmt) if fmt else data
+
+        countries = section(country_count * 2)
+        self.countries = [None] + [bytes(countries[i:i + 2]).decode('ascii')
+                                   for i in range(2, country_count * 2, 2)]
+        self.ipv4_starts = section(ipv4_count * 4, 'I')
+        self.ipv4_ends = section(ipv4_count * 4, 'I')
+        self.ipv4_countries = section(ipv4_count * 2, 'H')
+        self.ipv6_start_high = section(ipv6_count * 8, 'Q')
+        self.ipv6_start_low = section(ipv6_count * 8, 'Q')
+        self.ipv6_end_high = section(ipv6_count * 8, 'Q')
+        self.ipv6_end_low = section(ipv6_count * 8, 'Q')
+        self.ipv6_countries = section(ipv6_count * 2, 'H')
+
+    def __len__(self):
+        return len(self.ipv4_starts) + len(self.ipv6_countries)
+
+    def lookup(self, ip_addr):
+        """returns the country iso code of the ip address, or None if the
+        address is invalid or not in any known network"""
+
+        try:
+            ip_addr = ipaddress.ip_address(ip_addr)
+        except ValueError:
+            return None
+        if ip_addr.version == 6 and ip_addr.ipv4_mapped is not None:
+            ip_addr = ip_addr.ipv4_mapped
+
+        value = int(ip_addr)
+        if ip_addr.version == 6:
+            i = _find_ipv6(self.ipv6_start_high, self.ipv6_start_low,
+                           self.ipv6_end_high, self.ipv6_end_low, value)
+            return self.countries[self.ipv6_countries[i]] if i >= 0 else None
+        i = bisect_right(self.ipv4_starts, value) - 1
+        if i >= 0 and value <= self.ipv4_ends[i]:
+            return self.countries[self.ipv4_countries[i]]
+        return None
+
+    async def get_location(self, pool, ip_addr):
+        """`locations.store_review_location` compatible lookup, the
+        pool is unused"""
+        return self.lookup(ip_addr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile and query GeoIP databases")
+    subparsers = parser.add_subparsers(dest='command')
+    compile_parser = subparsers.add_parser('compile', help="compile the GeoLite2 CSV files")
+    compile_parser.add_argument('csv_dir')
+    compile_parser.add_argument('output')
+    lookup_parser = subparsers.add_parser('lookup', help="look up ip addresses in a compiled database")
+    lookup_parser.add_argument('database')
+    lookup_parser.add_argument('ip', nargs='+')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'compile':
+        count = compile_database(args.csv_dir, args.output)
+        log.info("Wrote {} networks to {} ({} bytes)".format(count, args.output, os.path.getsize(args.output)))
+    elif args.command == 'lookup':
+        database = GeoIPDatabase(args.database)
+        for ip in args.ip:
+            print("{} {}".format(ip, database.lookup(ip)))
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
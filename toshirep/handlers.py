@@ -1,4 +1,8 @@
+import asyncio
 import asyncpg.exceptions
+import base64
+import binascii
+import json
 import iso8601
 import ipaddress
 import os
@@ -10,25 +14,64 @@ from toshi.log import log
 from toshi.handlers import RequestVerificationMixin
 from toshi.utils import validate_address
 from tornado.ioloop import IOLoop
-from decimal import Decimal, InvalidOperation
-from .tasks import update_user_reputation, calculate_user_reputation
-
-def render_review(review):
+from .tasks import (
+    update_user_reputation, calculate_user_reputation, calculate_users_reputation,
+    queue_user_reputation_updates, reprocess_key, push_user_reputation)
+from .push import PUSH_DEAD_LETTER_KEY, PUSH_RETRY_KEY
+from .worker import listen as QUEUE_NAMES
+from . import metrics
+from .slowqueries import published_slow_queries
+from . import jobstats
+from .reviews import (
+    ReviewValidationError, validate_review, render_review, import_reviews,
+    build_export_query, export_reviews)
+
+MAX_BATCH_REVIEWEES = 500
+MAX_REPLAY_DEAD_PUSHES = 10000
+
+def render_reputation(score, count, avg, stars):
     return {
-        "reviewer": review['reviewer_id'],
-        "reviewee": review['reviewee_id'],
-        "rating": float(review['rating']),
-        "review": review['review'],
-        "date": review['updated'].isoformat(),
-        "edited": review['created'] != review['updated']
+        # NOTE: backwards compatibility
+        "score": avg,
+        "count": count,
+        # ======
+        "reputation_score": score,
+        "review_count": count,
+        "average_rating": avg,
+        "stars": stars,
     }
 
+def encode_review_cursor(review):
+    """encodes the sort key of the given review as an opaque cursor"""
+    cursor = json.dumps([review['updated'].isoformat(), review['reviewer_id'], review['reviewee_id']])
+    return base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_review_cursor(cursor):
+    """returns the (updated, reviewer_id, reviewee_id) tuple encoded in the
+    given cursor, raising ValueError if the cursor is invalid"""
+    try:
+        cursor = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        updated, reviewer_id, reviewee_id = json.loads(cursor.decode('utf-8'))
+        updated = iso8601.parse_date(updated).replace(tzinfo=None)
+    except (binascii.Error, UnicodeDecodeError, TypeError, iso8601.ParseError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(reviewer_id, str) or not isinstance(reviewee_id, str):
+        raise ValueError("Invalid cursor")
+    return updated, reviewer_id, reviewee_id
+
 class UpdateUserMixin:
 
-    def update_user(self, user_address):
-        if (hasattr(self.application, 'q') and
+    def can_update_users(self):
+        return (hasattr(self.application, 'q') and
                 'reputation' in self.application.config and
-                'push_url' in self.application.config['reputation']):
+                'push_url' in self.application.config['reputation'])
+
+    def update_user(self, user_address):
+        if hasattr(self.application, 'reputation_cache'):
+            self.application.reputation_cache.invalidate(user_address)
+        if self.can_update_users() and hasattr(self.application, 'reputation_scheduler'):
+            self.application.reputation_scheduler.schedule_update(user_address)
+        elif self.can_update_users():
             self.application.q.enqueue(
                 update_user_reputation,
                 self.application.rep_push_urls,
@@ -40,6 +83,24 @@ class UpdateUserMixin:
                 'reputation' in self.application.config,
                 'push_url' in self.application.config['reputation'] if 'reputation' in self.application.config else None))
 
+    def update_users(self, user_addresses):
+        """queues jobs recomputing the reputation of many users in chunks
+        of `REPROCESS_CHUNK_SIZE`, returning the id that can be used to
+        track their progress (or None if pushing isn't configured).
+
+        The cached reputations aren't invalidated, callers that changed
+        the users' reviews have to do that."""
+
+        if not self.can_update_users():
+            log.warn("Not updating {} users: push is not configured".format(len(user_addresses)))
+            return None
+
+        return queue_user_reputation_updates(
+            self.application.q,
+            self.application.rep_push_urls,
+            self.application.config['reputation']['signing_key'],
+            user_addresses)
+
 class SubmitReviewHandler(RequestVerificationMixin, AnalyticsMixin, DatabaseMixin, UpdateUserMixin, BaseHandler):
 
     async def put(self):
@@ -91,32 +152,11 @@ class SubmitReviewHandler(RequestVerificationMixin, AnalyticsMixin, DatabaseMixi
         if not all(x in self.json for x in ['reviewee', 'rating']):
             raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
 
-        # validate user address
-        user = self.json['reviewee']
-        # lowercase the address
-        user = user.lower()
-        if not validate_address(user):
-            raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_address', 'message': 'Invalid User Address'}]})
-
-        if submitter == user:
-            raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_reviewee', 'message': "Cannot review yourself!"}]})
-
-        # validate the rating
-        rating = self.json['rating']
-        if isinstance(rating, (dict, list, type(None))):
-            rating = Decimal(-1)
-        else:
-            try:
-                rating = Decimal(rating)
-            except (InvalidOperation, ValueError, TypeError):
-                rating = Decimal(-1)
-        if rating.is_nan() or rating.is_infinite() or rating < 0 or rating > 5:
-            raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_rating', 'message': 'Invalid Rating'}]})
-
-        # validate the message
-        message = self.json.get('review', None)
-        if message and not isinstance(message, str):
-            raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_review', 'message': 'Invalid Review'}]})
+        try:
+            user, rating, message = validate_review(
+                submitter, self.json['reviewee'], self.json['rating'], self.json.get('review', None))
+        except ReviewValidationError as e:
+            raise JSONHTTPError(400, body={'errors': [{'id': e.id, 'message': e.message}]})
 
         for h in self.request.headers:
             print("HEADER -- {}: {}".format(h, self.request.headers[h]))
@@ -161,18 +201,55 @@ class GetUserRatingHandler(DatabaseMixin, BaseHandler):
         if not validate_address(reviewee):
             raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_toshi_id', 'message': 'Invalid Toshi Id'}]})
 
+        cache = getattr(self.application, 'reputation_cache', None)
+        if cache is not None:
+            payload, generation = cache.get(reviewee)
+            if payload is not None:
+                self.set_header("Content-Type", "application/json; charset=UTF-8")
+                self.write(payload)
+                return
+
         async with self.db:
             score, count, avg, stars = await calculate_user_reputation(self.db, reviewee)
 
+        result = render_reputation(score, count, avg, stars)
+
+        if cache is not None:
+            cache.set(reviewee, json.dumps(result), generation)
+
+        self.write(result)
+
+class GetUsersRatingsHandler(DatabaseMixin, BaseHandler):
+
+    async def get(self):
+        await self.lookup(self.get_query_arguments('reviewee'))
+
+    async def post(self):
+        if 'reviewees' not in self.json or not isinstance(self.json['reviewees'], list):
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
+        await self.lookup(self.json['reviewees'])
+
+    async def lookup(self, reviewees):
+
+        if len(reviewees) == 0:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
+        if len(reviewees) > MAX_BATCH_REVIEWEES:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'too_many_reviewees',
+                                                       'message': 'A maximum of {} reviewees can be requested at once'.format(MAX_BATCH_REVIEWEES)}]})
+
+        addresses = []
+        for reviewee in reviewees:
+            if not isinstance(reviewee, str) or not validate_address(reviewee.lower()):
+                raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_toshi_id', 'message': 'Invalid Toshi Id'}]})
+            reviewee = reviewee.lower()
+            if reviewee not in addresses:
+                addresses.append(reviewee)
+
+        async with self.db:
+            reputations = await calculate_users_reputation(self.db, addresses)
+
         self.write({
-            # NOTE: backwards compatibility
-            "score": avg,
-            "count": count,
-            # ======
-            "reputation_score": score,
-            "review_count": count,
-            "average_rating": avg,
-            "stars": stars,
+            "ratings": {reviewee: render_reputation(*reputations[reviewee]) for reviewee in addresses}
         })
 
 class SearchReviewsHandler(DatabaseMixin, BaseHandler):
@@ -182,6 +259,8 @@ class SearchReviewsHandler(DatabaseMixin, BaseHandler):
         reviewee = self.get_query_argument('reviewee', None)
         reviewer = self.get_query_argument('reviewer', None)
         oldest = self.get_query_argument('oldest', None)
+        cursor = self.get_query_argument('cursor', None)
+        include_total = self.get_query_argument('include_total', 'exact')
         try:
             offset = int(self.get_query_argument('offset', 0))
             limit = int(self.get_query_argument('limit', 10))
@@ -191,6 +270,9 @@ class SearchReviewsHandler(DatabaseMixin, BaseHandler):
         if reviewee is None and reviewer is None:
             raise JSONHTTPError(400, body={'errors': [{'id': 'bad arguments', 'message': 'Bad Arguments'}]})
 
+        if include_total not in ('exact', 'estimated', 'none'):
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid value for `include_total`'}]})
+
         wheres = []
         sql_args = []
 
@@ -223,21 +305,98 @@ class SearchReviewsHandler(DatabaseMixin, BaseHandler):
             sql_args.append(oldest)
 
         cnt_sql = "SELECT COUNT(*) FROM reviews WHERE {}".format(" AND ".join(wheres))
-        sql = "SELECT * FROM reviews WHERE {} ORDER BY updated DESC OFFSET ${} LIMIT ${}".format(
-            " AND ".join(wheres), len(wheres) + 1, len(wheres) + 2)
+        cnt_args = list(sql_args)
 
-        async with self.db:
-            reviews = await self.db.fetch(sql, *sql_args + [offset, limit])
-            stats = await self.db.fetchrow(cnt_sql, *sql_args)
+        if cursor is not None:
+            try:
+                updated, last_reviewer, last_reviewee = decode_review_cursor(cursor)
+            except ValueError:
+                raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_cursor', 'message': 'Invalid `cursor`'}]})
+            # the row comparison only includes the columns that aren't fixed
+            # by the filters so it can be used to seek in the sorted indexes
+            if reviewee is not None:
+                wheres.append("(updated, reviewer_id) < (${}, ${})".format(len(sql_args) + 1, len(sql_args) + 2))
+                sql_args.extend([updated, last_reviewer])
+            else:
+                wheres.append("(updated, reviewee_id) < (${}, ${})".format(len(sql_args) + 1, len(sql_args) + 2))
+                sql_args.extend([updated, last_reviewee])
+
+        sql = ("SELECT * FROM reviews WHERE {} "
+               "ORDER BY updated DESC, reviewer_id DESC, reviewee_id DESC OFFSET ${} LIMIT ${}").format(
+                   " AND ".join(wheres), len(sql_args) + 1, len(sql_args) + 2)
+
+        if include_total == 'exact':
+            total = self.cached_count(cnt_sql, cnt_args)
+            if total is None:
+                # the page and the count each acquire their own connection,
+                # so neither holds one while waiting for the other
+                reviews, total = await asyncio.gather(
+                    self.pool_fetch(sql, *sql_args + [offset, limit]),
+                    self.count_reviews(cnt_sql, cnt_args))
+            else:
+                reviews = await self.pool_fetch(sql, *sql_args + [offset, limit])
+        else:
+            async with self.db:
+                reviews = await self.db.fetch(sql, *sql_args + [offset, limit])
+                if include_total == 'estimated':
+                    total = await self.estimate_reviews(cnt_sql, cnt_args, reviewee, reviewer, oldest)
+                else:
+                    total = None
+
+        if limit > 0 and len(reviews) == limit:
+            next_cursor = encode_review_cursor(reviews[-1])
+        else:
+            next_cursor = None
 
         self.write({
             "query": self.request.query,
-            "total": stats['count'],
+            "total": total,
             "reviews": [render_review(r) for r in reviews],
             "offset": offset,
-            "limit": limit
+            "limit": limit,
+            "next_cursor": next_cursor
         })
 
+    async def pool_fetch(self, sql, *args):
+        async with self.application.connection_pool.acquire() as con:
+            return await con.fetch(sql, *args)
+
+    def cached_count(self, cnt_sql, cnt_args):
+        """the memoized exact count of the reviews matching the query, or
+        None if it isn't cached"""
+        cache = getattr(self.application, 'search_count_cache', None)
+        if cache is None:
+            return None
+        return cache.get((cnt_sql, tuple(cnt_args)))
+
+    async def count_reviews(self, cnt_sql, cnt_args):
+        """exact count of the reviews matching the query, memoized for a
+        short time per query signature"""
+
+        async with self.application.connection_pool.acquire() as con:
+            total = await con.fetchval(cnt_sql, *cnt_args)
+
+        cache = getattr(self.application, 'search_count_cache', None)
+        if cache is not None:
+            cache.set((cnt_sql, tuple(cnt_args)), total)
+        return total
+
+    async def estimate_reviews(self, cnt_sql, cnt_args, reviewee, reviewer, oldest):
+        """estimated count of the reviews matching the query"""
+
+        if reviewee is not None and reviewer is None and oldest is None:
+            row = await self.db.fetchrow(
+                "SELECT review_count FROM reviewee_reputation WHERE reviewee_id = $1",
+                reviewee)
+            return row['review_count'] if row else 0
+
+        # use the planner's row estimate for the count query
+        row = await self.db.fetchrow("EXPLAIN (FORMAT JSON) {}".format(cnt_sql.replace("COUNT(*)", "1")), *cnt_args)
+        plan = row[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
 class ReprocessReviews(RequestVerificationMixin, UpdateUserMixin, DatabaseMixin, BaseHandler):
     async def post(self):
 
@@ -245,11 +404,191 @@ class ReprocessReviews(RequestVerificationMixin, UpdateUserMixin, DatabaseMixin,
         if submitter != os.environ["ADMIN_ADDRESS"]:
             raise JSONHTTPError(404, body={})
 
-        # save the review, or replace an existing review
         async with self.db:
-            reviewees = await self.db.fetch("SELECT DISTINCT(reviewee_id) FROM reviews")
+            reviewees = await self.db.fetch("SELECT reviewee_id FROM reviewee_reputation ORDER BY reviewee_id")
+        reviewees = [reviewee['reviewee_id'] for reviewee in reviewees]
 
-        for reviewee in reviewees:
-            reviewee = reviewee['reviewee_id']
-            log.info("queuing review reporcessing for: {}".format(reviewee))
-            self.update_user(reviewee)
+        log.info("queuing review reprocessing for {} reviewees".format(len(reviewees)))
+        reprocess_id = self.update_users(reviewees)
+        if reprocess_id is None:
+            raise JSONHTTPError(503, body={'errors': [{'id': 'push_not_configured',
+                                                       'message': 'Reputation pushing is not configured'}]})
+
+        self.write({
+            "reprocess_id": reprocess_id,
+            "reviewees": len(reviewees)
+        })
+
+class ImportReviewsHandler(RequestVerificationMixin, UpdateUserMixin, BaseHandler):
+    async def post(self):
+
+        # the signature covers the whole body, so the import is read from
+        # the buffered request rather than streamed
+        submitter = self.verify_request()
+        if submitter != os.environ["ADMIN_ADDRESS"]:
+            raise JSONHTTPError(404, body={})
+
+        async with self.application.connection_pool.acquire() as con:
+            report = await import_reviews(con, self.request.body.splitlines())
+
+        log.info("imported {} reviews, {} invalid lines".format(report['imported'], report['invalid']))
+        reviewees = report.pop('reviewees')
+        report['reviewees'] = len(reviewees)
+        if reviewees and hasattr(self.application, 'reputation_cache'):
+            # a redis round trip per batch of reviewees, so kept off the loop
+            await asyncio.get_event_loop().run_in_executor(
+                None, self.application.reputation_cache.invalidate_many, reviewees)
+        report['reprocess_id'] = self.update_users(reviewees) if reviewees else None
+
+        self.write(report)
+
+class ExportReviewsHandler(RequestVerificationMixin, BaseHandler):
+    async def get(self):
+
+        submitter = self.verify_request()
+        if submitter != os.environ["ADMIN_ADDRESS"]:
+            raise JSONHTTPError(404, body={})
+
+        try:
+            sql, sql_args = build_export_query(
+                self.get_query_argument('reviewee', None),
+                self.get_query_argument('reviewer', None),
+                self.get_query_argument('oldest', None))
+        except ReviewValidationError as e:
+            raise JSONHTTPError(400, body={'errors': [{'id': e.id, 'message': e.message}]})
+
+        async def write(data):
+            self.write(data)
+            # waiting for each chunk to be sent keeps the memory used
+            # constant regardless of how many reviews are exported
+            await self.flush()
+
+        self.set_header("Content-Type", "application/x-ndjson")
+        async with self.application.connection_pool.acquire() as con:
+            count = await export_reviews(con, write, sql, sql_args)
+        log.info("exported {} reviews".format(count))
+
+class ReprocessStatusHandler(RequestVerificationMixin, BaseHandler):
+    def get(self, reprocess_id):
+
+        submitter = self.verify_request()
+        if submitter != os.environ["ADMIN_ADDRESS"] or not hasattr(self.application, 'q'):
+            raise JSONHTTPError(404, body={})
+
+        status = self.application.q.connection.hgetall(reprocess_key(reprocess_id))
+        if not status:
+            raise JSONHTTPError(404, body={'errors': [{'id': 'not_found', 'message': 'Not Found'}]})
+        status = {key.decode('utf-8'): int(value) for key, value in status.items()}
+        status['reprocess_id'] = reprocess_id
+        status.setdefault('failed_chunks', 0)
+        # chunks that failed count as completed, check `failed_chunks`
+        # for whether every reviewee was pushed
+        status['done'] = status['completed_chunks'] >= status['chunks']
+
+        self.write(status)
+
+class AdminStatsHandler(RequestVerificationMixin, BaseHandler):
+    def get(self):
+
+        submitter = self.verify_request()
+        if submitter != os.environ["ADMIN_ADDRESS"]:
+            raise JSONHTTPError(404, body={})
+
+        stats = {}
+        if hasattr(self.application, 'reputation_cache'):
+            stats['reputation_cache'] = self.application.reputation_cache.stats()
+        if hasattr(self.application, 'search_count_cache'):
+            stats['search_count_cache'] = self.application.search_count_cache.stats()
+        if hasattr(self.application, 'location_cache'):
+            stats['location_cache'] = self.application.location_cache.stats()
+        if hasattr(self.application, 'ip2c_client'):
+            stats['ip2c'] = self.application.ip2c_client.stats()
+        if hasattr(self.application, 'slow_queries'):
+            stats['slow_queries'] = self.application.slow_queries.stats()
+        if getattr(self.application, 'location_writer', None) is not None:
+            stats['location_writer'] = self.application.location_writer.stats()
+        if hasattr(self.application, 'q'):
+            stats['push_retries'] = self.application.q.connection.zcard(PUSH_RETRY_KEY)
+            stats['push_dead_letters'] = self.application.q.connection.llen(PUSH_DEAD_LETTER_KEY)
+
+        self.write(stats)
+
+class SlowQueriesHandler(RequestVerificationMixin, BaseHandler):
+    def get(self):
+
+        submitter = self.verify_request()
+        if submitter != os.environ["ADMIN_ADDRESS"]:
+            raise JSONHTTPError(404, body={})
+
+        self.write({
+            # the slow queries of this web process
+            "web": self.application.slow_queries.recent() if hasattr(self.application, 'slow_queries') else [],
+            # and the ones published by the workers
+            "worker": published_slow_queries(self.application.q.connection) if hasattr(self.application, 'q') else []
+        })
+
+class ReplayDeadPushesHandler(RequestVerificationMixin, UpdateUserMixin, BaseHandler):
+    def post(self):
+
+        submitter = self.verify_request()
+        if submitter != os.environ["ADMIN_ADDRESS"]:
+            raise JSONHTTPError(404, body={})
+
+        if not self.can_update_users():
+            raise JSONHTTPError(503, body={'errors': [{'id': 'push_not_configured',
+                                                       'message': 'Reputation pushing is not configured'}]})
+
+        try:
+            limit = int(self.json.get('limit', 1000)) if self.json else 1000
+        except (ValueError, TypeError):
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
+        # a limit of 0 would make the lrange below return the whole list
+        # and the ltrim remove nothing
+        if limit <= 0:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': '`limit` must be positive'}]})
+        limit = min(limit, MAX_REPLAY_DEAD_PUSHES)
+
+        # take the oldest dead letters off the end of the list
+        pipe = self.application.q.connection.pipeline()
+        pipe.lrange(PUSH_DEAD_LETTER_KEY, -limit, -1)
+        pipe.ltrim(PUSH_DEAD_LETTER_KEY, 0, -limit - 1)
+        entries, _ = pipe.execute()
+
+        for entry in reversed(entries):
+            entry = json.loads(entry.decode('utf-8'))
+            self.application.q.enqueue(
+                push_user_reputation,
+                entry['push_url'],
+                self.application.config['reputation']['signing_key'],
+                entry['reviewee_id'],
+                0)
+
+        self.write({"replayed": len(entries)})
+
+class MetricsHandler(BaseHandler):
+    def get(self):
+
+        # the token is optional so a scraper can be given access without
+        # signing requests
+        token = self.application.config['metrics'].get('token') if 'metrics' in self.application.config else None
+        if token is not None and self.request.headers.get('Authorization') != "Bearer {}".format(token):
+            raise JSONHTTPError(404, body={})
+
+        if hasattr(self.application, 'q'):
+            connection = self.application.q.connection
+            pipe = connection.pipeline()
+            for name in QUEUE_NAMES:
+                pipe.llen("rq:queue:{}".format(name))
+            pipe.zcard(PUSH_RETRY_KEY)
+            pipe.llen(PUSH_DEAD_LETTER_KEY)
+            results = pipe.execute()
+            for name, length in zip(QUEUE_NAMES, results):
+                metrics.QUEUE_LENGTH.labels(name).set(length)
+            metrics.PUSH_RETRIES.set(results[-2])
+            metrics.PUSH_DEAD_LETTERS.set(results[-1])
+
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.REGISTRY.render())
+        if hasattr(self.application, 'q'):
+            # the worker processes' job stats
+            self.write(jobstats.render_prometheus(jobstats.read_job_stats(self.application.q.connection)))
@@ -0,0 +1,205 @@
+"""Timings and counts of the worker jobs, kept in redis so every worker
+process adds to the same numbers.
+
+usage: python -m toshirep.jobstats [--minutes N] [--json]
+
+Jobs record how long they waited in the queue, how long they took, how
+long calculating reputations took and how long each push request took,
+along with counts of failed jobs, failed pushes and scheduled retries.
+They are collected in memory and written with a single pipeline per
+flush into a hash per minute, which expires after `JOB_STATS_WINDOW`
+minutes, and a hash of totals, which `/metrics` exposes.
+"""
+import argparse
+import json
+import logging
+import os
+import redis
+import sys
+import time
+
+from contextlib import contextmanager
+
+from toshirep.metrics import Counter, Histogram, Registry
+from toshirep.worker import get_redis_url
+
+log = logging.getLogger("worker.log")
+
+JOB_STATS_KEY = "toshirep:jobstats"
+JOB_STATS_WINDOW = int(os.environ.get('JOB_STATS_WINDOW', 60))
+
+# upper bounds of the timing buckets in seconds, the last bucket has no
+# upper bound
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+TIMINGS = [
+    ('queue_wait', "Time jobs waited in the queue before running"),
+    ('job', "Time taken running jobs"),
+    ('compute', "Time taken calculating reputations, including getting a database connection"),
+    ('push', "Time taken by each push request")
+]
+
+COUNTS = [
+    ('jobs_failed', "Jobs that raised an error"),
+    ('pushes', "Reputation push attempts"),
+    ('pushes_failed', "Reputation updates that failed to push"),
+    ('push_retries', "Push retries scheduled"),
+    ('push_dead_letters', "Pushes that ran out of attempts")
+]
+
+def _bucket(seconds):
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            return i
+    return len(BUCKETS)
+
+def minute_key(minute):
+    return "{}:{}".format(JOB_STATS_KEY, minute)
+
+TOTAL_KEY = "{}:total".format(JOB_STATS_KEY)
+
+class JobStats:
+    """collects job timings and counts until they are written to redis by
+    `flush`. Without a redis connection nothing is written."""
+
+    def __init__(self, redis_connection):
+        self.redis = redis_connection
+        self.pending = {}
+
+    def _add(self, field, amount):
+        self.pending[field] = self.pending.get(field, 0) + amount
+
+    def incr(self, name, amount=1):
+        self._add(name, amount)
+
+    def observe(self, name, seconds):
+        self._add("{}:count".format(name), 1)
+        self._add("{}:sum".format(name), seconds)
+        self._add("{}:bucket:{}".format(name, _bucket(seconds)), 1)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def take(self):
+        """returns the collected stats, leaving nothing pending"""
+        pending, self.pending = self.pending, {}
+        return pending
+
+    def write(self, stats, now=None):
+        """writes stats returned by `take`, this can be called from another
+        thread"""
+        if not stats or self.redis is None:
+            return
+        key = minute_key(int((time.time() if now is None else now) // 60))
+        try:
+            pipe = self.redis.pipeline()
+            for field, amount in stats.items():
+                for k in (key, TOTAL_KEY):
+                    if isinstance(amount, float):
+                        pipe.hincrbyfloat(k, field, amount)
+                    else:
+                        pipe.hincrby(k, field, amount)
+            pipe.expire(key, (JOB_STATS_WINDOW + 1) * 60)
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            log.exception("Error writing job stats")
+
+    def flush(self):
+        self.write(self.take())
+
+def _parse(hashes):
+    stats = {}
+    for values in hashes:
+        for field, value in values.items():
+            field = field.decode('utf-8')
+            stats[field] = stats.get(field, 0) + float(value)
+    return stats
+
+def read_job_stats(redis_connection, minutes=None, now=None):
+    """returns the stats of the last `minutes` minutes, or the totals if
+    `minutes` isn't given, as a dict of field names to values"""
+    if minutes is None:
+        return _parse([redis_connection.hgetall(TOTAL_KEY)])
+    current = int((time.time() if now is None else now) // 60)
+    pipe = redis_connection.pipeline()
+    for minute in range(current - minutes + 1, current + 1):
+        pipe.hgetall(minute_key(minute))
+    return _parse(pipe.execute())
+
+def _bucket_percentile(buckets, count, p):
+    """the upper bound of the bucket containing the percentile, `+Inf`
+    if it is past the last bucket"""
+    rank = p / 100 * count
+    cumulative = 0
+    for i, n in enumerate(buckets):
+        cumulative += n
+        if cumulative >= rank and n:
+            return BUCKETS[i] if i < len(BUCKETS) else '+Inf'
+    return None
+
+def summarize(stats):
+    summary = {'counts': {}, 'timings': {}}
+    for name, _ in COUNTS:
+        summary['counts'][name] = int(stats.get(name, 0))
+    for name, _ in TIMINGS:
+        count = int(stats.get("{}:count".format(name), 0))
+        buckets = [stats.get("{}:bucket:{}".format(name, i), 0) for i in range(len(BUCKETS) + 1)]
+        summary['timings'][name] = {
+            'count': count,
+            'mean_s': round(stats.get("{}:sum".format(name), 0) / count, 4) if count else None,
+            # bucket upper bounds, so these are approximate
+            'p50_s': _bucket_percentile(buckets, count, 50) if count else None,
+            'p95_s': _bucket_percentile(buckets, count, 95) if count else None,
+            'p99_s': _bucket_percentile(buckets, count, 99) if count else None
+        }
+    return summary
+
+def render_prometheus(stats):
+    """renders the totals in the Prometheus text format"""
+    registry = Registry()
+    for name, documentation in TIMINGS:
+        histogram = Histogram('toshirep_worker_{}_seconds'.format(name), documentation,
+                              buckets=BUCKETS, registry=registry)
+        child = histogram.children[()]
+        child.counts = [int(stats.get("{}:bucket:{}".format(name, i), 0)) for i in range(len(BUCKETS) + 1)]
+        child.sum = stats.get("{}:sum".format(name), 0)
+        child.count = int(stats.get("{}:count".format(name), 0))
+    for name, documentation in COUNTS:
+        counter = Counter('toshirep_worker_{}_total'.format(name), documentation, registry=registry)
+        counter.inc(int(stats.get(name, 0)))
+    return registry.render()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize the worker job stats")
+    parser.add_argument('--minutes', type=int, default=15,
+                        help="summarize the last N minutes, at most JOB_STATS_WINDOW, 0 for the totals")
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    url = get_redis_url()
+    if not url:
+        log.error("ENVIRONMENT MISSING `REDIS_URL`")
+        sys.exit(1)
+
+    summary = summarize(read_job_stats(redis.from_url(url), minutes=args.minutes or None))
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+
+    print("last {} minutes".format(args.minutes) if args.minutes else "totals")
+    for name, _ in COUNTS:
+        print("{:<20} {:>10}".format(name, summary['counts'][name]))
+    print("{:<20} {:>10} {:>10} {:>10} {:>10} {:>10}".format('timing', 'count', 'mean', 'p50', 'p95', 'p99'))
+    for name, _ in TIMINGS:
+        timing = summary['timings'][name]
+        print("{:<20} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+            name, timing['count'], *[timing[k] if timing[k] is not None else '-'
+                                     for k in ('mean_s', 'p50_s', 'p95_s', 'p99_s')]))
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,33 @@
+import aiohttp
 import asyncio
+import inspect
 import ipaddress
 import asyncpg.exceptions
+import time
+
+from collections import deque
+from datetime import datetime
 
 from toshi.log import log
 from tornado.httpclient import AsyncHTTPClient
 
+from .cache import TTLCache
+
+_MISSING = object()
+
+class LocationUnavailable(Exception):
+    """raised when a lookup couldn't be made, as opposed to the backend
+    not knowing the location, so the missing result isn't cached"""
+
+# finds the network with the greatest start address <= the ip address,
+# which is the only network that can contain it, with a single probe of
+# the range_start index
+GEOLITE2_LOOKUP_SQL = (
+    "SELECT country_iso_code FROM ("
+    "SELECT range_end, country_iso_code FROM geolite2_lookup "
+    "WHERE range_start <= $1 ORDER BY range_start DESC LIMIT 1"
+    ") l WHERE range_end >= $1")
+
 async def get_location_from_geolite2(pool, ip_addr):
 
     try:
@@ -13,10 +36,7 @@ async def get_location_from_geolite2(pool, ip_addr):
         # correctly
         ip_addr = "{}/{}".format(ip_addr, 32 if ip_addr.version == 4 else 128)
         async with pool.acquire() as con:
-            row = await con.fetchrow(
-                "SELECT cs.country_iso_code FROM geolite2_ip_addresses ips "
-                "JOIN geolite2_countries cs ON ips.geoname_id = cs.geoname_id "
-                "WHERE ips.network >> $1", ip_addr)
+            row = await con.fetchrow(GEOLITE2_LOOKUP_SQL, ip_addr)
         return row['country_iso_code'] if row else None
     except ValueError:
         return None
@@ -57,9 +77,298 @@ async def get_location_from_ip2c(pool, ip_addr):
 
     return None
 
-async def store_review_location(fn, pool, reviewer_id, ip_addr):
+class Ip2cClient:
+    """ip2c.org client sharing keep-alive connections between lookups.
+
+    At most `max_in_flight` requests are made at once, with up to
+    `max_queued` more lookups waiting for a slot and any further lookups
+    failing straight away. Lookups for an ip that is already being
+    looked up share the same request.
+
+    After `failure_threshold` failed requests in a row the circuit
+    breaker opens and lookups fail without a request for
+    `reset_timeout` seconds, after which a single request is let through
+    to check if ip2c has recovered.
+
+    Lookups that are shed, short circuited or fail raise
+    `LocationUnavailable`."""
+
+    def __init__(self, url="http://ip2c.org/{}", max_in_flight=10, max_queued=1000, timeout=5,
+                 failure_threshold=5, reset_timeout=30, timer=time.monotonic):
+        self.url = url
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timer = timer
+
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.waiting = 0
+        self.inflight = {}
+        self.latencies = deque(maxlen=1000)
+        self.counts = {'requests': 0, 'errors': 0, 'coalesced': 0, 'short_circuited': 0, 'shed': 0}
+        self._session = None
+        self._semaphore = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_in_flight))
+        return self._session
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.timer() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half_open'
+
+    def _allow_request(self):
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def _record(self, success):
+        self.probing = False
+        if success:
+            self.failures = 0
+            self.opened_at = None
+        else:
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    log.warning("ip2c failing, skipping lookups for {}s".format(self.reset_timeout))
+                self.opened_at = self.timer()
+
+    async def get_location(self, pool, ip_addr):
+        """`locations.store_review_location` compatible lookup, the
+        pool is unused"""
+
+        try:
+            ip_addr = str(ipaddress.ip_address(ip_addr))
+        except ValueError:
+            return None
+
+        fut = self.inflight.get(ip_addr)
+        if fut is not None:
+            self.counts['coalesced'] += 1
+            return await asyncio.shield(fut)
+
+        fut = asyncio.ensure_future(self._lookup(ip_addr))
+        self.inflight[ip_addr] = fut
+        fut.add_done_callback(lambda f: self.inflight.pop(ip_addr, None))
+        return await asyncio.shield(fut)
+
+    async def _lookup(self, ip_addr):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        if self._semaphore.locked() and self.waiting >= self.max_queued:
+            self.counts['shed'] += 1
+            raise LocationUnavailable("ip2c lookup queue is full")
+
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            # checked after waiting for a slot so lookups queued before
+            # the breaker opened don't all hit the failing upstream
+            if not self._allow_request():
+                self.counts['short_circuited'] += 1
+                raise LocationUnavailable("ip2c is failing")
+            return await self._fetch(ip_addr)
+        finally:
+            self._semaphore.release()
+
+    async def _fetch(self, ip_addr):
+        self.counts['requests'] += 1
+        start = time.perf_counter()
+        try:
+            with aiohttp.Timeout(self.timeout):
+                async with self.session.get(self.url.format(ip_addr)) as response:
+                    if response.status != 200:
+                        raise Exception("Status: {}".format(response.status))
+                    txt = await response.text()
+            parts = txt.split(";")
+            state, cd = parts[0], parts[1] if len(parts) > 1 else None
+        except Exception as e:
+            log.exception("Error getting ip details")
+            self.counts['errors'] += 1
+            self._record(False)
+            raise LocationUnavailable("Error getting ip details") from e
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+        self._record(True)
+        if state == '0' or state == '2':
+            log.warning("IP2C Error: {} -> {}".format(ip_addr, txt))
+        return cd or None
+
+    def stats(self):
+        stats = dict(self.counts)
+        stats['state'] = self.state
+        stats['in_flight'] = len(self.inflight)
+        stats['waiting'] = self.waiting
+        latencies = sorted(self.latencies)
+        for p in (50, 95, 99):
+            stats['p{}_ms'.format(p)] = (round(latencies[min(len(latencies) - 1, len(latencies) * p // 100)] * 1000, 3)
+                                         if latencies else None)
+        return stats
+
+    async def close(self):
+        if self._session is not None:
+            session, self._session = self._session, None
+            rval = session.close()
+            if inspect.isawaitable(rval):
+                await rval
+
+class LocationCache:
+    """LRU+TTL cache in front of one of the `get_location_from_*` functions.
+
+    Unknown locations are cached for `negative_ttl` seconds, lookups that
+    raise (e.g. `LocationUnavailable`) aren't cached at all, and lookups
+    for an ip address that is already being resolved wait for the same
+    result instead of querying the backend again."""
+
+    def __init__(self, fn, maxsize=10000, ttl=3600, negative_ttl=300):
+        self.fn = fn
+        self.negative_ttl = negative_ttl
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.inflight = {}
+        self.coalesced = 0
+
+    async def get_location(self, pool, ip_addr):
+        location = self.cache.get(ip_addr, _MISSING)
+        if location is not _MISSING:
+            return location
+
+        fut = self.inflight.get(ip_addr)
+        if fut is None:
+            fut = asyncio.ensure_future(self.fn(pool, ip_addr))
+            fut.add_done_callback(lambda f: self._resolved(ip_addr, f))
+            self.inflight[ip_addr] = fut
+        else:
+            self.coalesced += 1
+        # shielded so a cancelled caller doesn't cancel the lookup for
+        # everyone else waiting on it
+        return await asyncio.shield(fut)
+
+    def _resolved(self, ip_addr, fut):
+        self.inflight.pop(ip_addr, None)
+        # errors aren't cached so the next lookup retries
+        if fut.cancelled() or fut.exception() is not None:
+            return
+        location = fut.result()
+        self.cache.set(ip_addr, location, ttl=None if location is not None else self.negative_ttl)
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats['coalesced'] = self.coalesced
+        stats['inflight'] = len(self.inflight)
+        return stats
+
+class ReviewLocationWriter:
+    """Buffers review locations and writes them in batches, when
+    `batch_size` rows are pending or `flush_interval` seconds after the
+    first pending row.
+
+    At most `max_pending` rows are buffered. When the buffer is full new
+    rows are dropped, or if `block` is set the caller waits for the
+    buffer to be flushed."""
+
+    def __init__(self, pool, batch_size=500, flush_interval=1.0, max_pending=10000, block=False):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.block = block
+        self.rows = []
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._flushing = None
+        self._timer = None
+
+    async def add(self, reviewer_id, location):
+        while len(self.rows) >= self.max_pending:
+            if not self.block:
+                if self.dropped % 1000 == 0:
+                    log.warning("Review location buffer full, dropping locations")
+                self.dropped += 1
+                return
+            await self.flush()
+
+        # the submit time is kept so the delayed write doesn't change it
+        self.rows.append((reviewer_id, location, datetime.utcnow()))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """starts writing the pending rows if a write isn't already running,
+        returning the future of the running write"""
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.ensure_future(self._flush())
+        return self._flushing
+
+    async def _flush(self):
+        while self.rows:
+            rows, self.rows = self.rows[:self.batch_size], self.rows[self.batch_size:]
+            try:
+                await self._write(rows)
+                self.written += len(rows)
+            except Exception:
+                log.exception("Error writing {} review locations".format(len(rows)))
+                self.failed += len(rows)
+
+    async def _write(self, rows):
+        async with self.pool.acquire() as con:
+            if hasattr(con, 'copy_records_to_table'):
+                await con.copy_records_to_table(
+                    'review_locations', records=rows, columns=['reviewer_id', 'location', 'submitted'])
+            else:
+                await con.execute(
+                    "INSERT INTO review_locations (reviewer_id, location, submitted) "
+                    "SELECT * FROM unnest($1::varchar[], $2::varchar[], $3::timestamp[])",
+                    [row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows])
+
+    async def close(self):
+        """writes every pending row"""
+        while self.rows or (self._flushing is not None and not self._flushing.done()):
+            await self.flush()
+
+    def stats(self):
+        return {
+            'pending': len(self.rows),
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed
+        }
+
+async def store_review_location(fn, pool, reviewer_id, ip_addr, writer=None):
+
+    try:
+        location = await fn(pool, ip_addr)
+    except LocationUnavailable:
+        location = None
 
-    location = await fn(pool, ip_addr)
+    if writer is not None:
+        await writer.add(reviewer_id, location)
+        return
 
     async with pool.acquire() as con:
         await con.execute(
@@ -0,0 +1,292 @@
+"""Counters and histograms exposed at `/metrics` in the Prometheus text
+format.
+
+The app runs on a single event loop, so metrics are plain numbers
+updated without locks, and observing a histogram is a bisect and three
+additions. Metrics are registered in `REGISTRY` when they are created.
+"""
+import bisect
+import re
+import time
+
+# request and query latencies in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in labels) + '}'
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("{}{} {}".format(name, _format_labels(labels), _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+class _Metric:
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        if not self.labelnames:
+            self.children[()] = self._child()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        """the metric for the given label values, in the order of
+        `labelnames`"""
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("Expected labels {}".format(self.labelnames))
+            child = self.children[values] = self._child()
+        return child
+
+    def samples(self):
+        for values, child in sorted(self.children.items()):
+            for suffix, extra, value in child.samples():
+                yield self.name + suffix, tuple(zip(self.labelnames, values)) + extra, value
+
+class _CounterChild:
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield '', (), self.value
+
+class Counter(_Metric):
+    type = 'counter'
+    _child = _CounterChild
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+class _GaugeChild(_CounterChild):
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+class Gauge(_Metric):
+    type = 'gauge'
+    _child = _GaugeChild
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self.children[()].dec(amount)
+
+    def set(self, value):
+        self.children[()].set(value)
+
+class _HistogramChild:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the count of observations in each bucket, not cumulative
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            yield '_bucket', (('le', _format_value(float(bound))),), cumulative
+        yield '_sum', (), self.sum
+        yield '_count', (), self.count
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames=labelnames, registry=registry)
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+REQUEST_LATENCY = Histogram(
+    'toshirep_http_request_duration_seconds', "Time taken to handle requests",
+    ['handler', 'method'])
+REQUESTS = Counter(
+    'toshirep_http_requests_total', "Requests handled", ['handler', 'method', 'status'])
+DB_QUERY_LATENCY = Histogram(
+    'toshirep_db_query_duration_seconds', "Time taken by database queries", ['query'])
+DB_POOL_WAIT = Histogram(
+    'toshirep_db_pool_wait_seconds', "Time spent waiting for a database connection")
+DB_POOL_IN_USE = Gauge(
+    'toshirep_db_pool_connections_in_use', "Database connections acquired from the pool")
+LOCATION_LOOKUP_LATENCY = Histogram(
+    'toshirep_location_lookup_duration_seconds', "Time taken by review location lookups", ['backend'])
+QUEUE_LENGTH = Gauge(
+    'toshirep_rq_queue_length', "Jobs waiting in each rq queue", ['queue'])
+PUSH_RETRIES = Gauge(
+    'toshirep_push_retries', "Reputation pushes waiting to be retried")
+PUSH_DEAD_LETTERS = Gauge(
+    'toshirep_push_dead_letters', "Reputation pushes that ran out of attempts")
+
+def observe_request(handler):
+    """records the latency and status of a finished request"""
+    name = type(handler).__name__
+    method = handler.request.method
+    REQUEST_LATENCY.labels(name, method).observe(handler.request.request_time())
+    REQUESTS.labels(name, method, handler.get_status()).inc()
+
+_TABLE_RE = re.compile(r"\b(?:from|into|update|table)\s+(\w+)", re.IGNORECASE)
+_query_names = {}
+
+def query_name(sql):
+    """a low cardinality name for the query made of the statement type and
+    the first table it refers to, e.g. `select_reviewee_reputation`"""
+    name = _query_names.get(sql)
+    if name is None:
+        words = sql.split(None, 1)
+        name = words[0].lower() if words else 'unknown'
+        match = _TABLE_RE.search(sql)
+        if match:
+            name = "{}_{}".format(name, match.group(1).lower())
+        # the queries are built from a fixed set of strings, but don't
+        # grow without bound if they aren't
+        if len(_query_names) < 1000:
+            _query_names[sql] = name
+    return name
+
+class InstrumentedConnection:
+    """forwards to the connection, timing each query by its `query_name`
+    and passing the timings on to the `slow_queries` log if given"""
+
+    def __init__(self, con, slow_queries=None):
+        self._con = con
+        self._slow_queries = slow_queries
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+    async def _timed(self, method, query, args, kwargs):
+        start = time.perf_counter()
+        try:
+            return await method(query, *args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            DB_QUERY_LATENCY.labels(query_name(query)).observe(duration)
+            if self._slow_queries is not None:
+                self._slow_queries.record(query, args, duration)
+
+    def execute(self, query, *args, **kwargs):
+        return self._timed(self._con.execute, query, args, kwargs)
+
+    def fetch(self, query, *args, **kwargs):
+        return self._timed(self._con.fetch, query, args, kwargs)
+
+    def fetchrow(self, query, *args, **kwargs):
+        return self._timed(self._con.fetchrow, query, args, kwargs)
+
+    def fetchval(self, query, *args, **kwargs):
+        return self._timed(self._con.fetchval, query, args, kwargs)
+
+class _AcquireContext:
+
+    def __init__(self, pool, args, kwargs):
+        self.pool = pool
+        self.args = args
+        self.kwargs = kwargs
+        self.con = None
+
+    def __await__(self):
+        return self.pool._acquire(*self.args, **self.kwargs).__await__()
+
+    async def __aenter__(self):
+        self.con = await self.pool._acquire(*self.args, **self.kwargs)
+        return self.con
+
+    async def __aexit__(self, exc_type, exc, tb):
+        con, self.con = self.con, None
+        await self.pool.release(con)
+
+class InstrumentedPool:
+    """forwards to the pool, timing how long acquiring connections takes
+    and counting the connections in use. Acquired connections are wrapped
+    in `InstrumentedConnection`."""
+
+    def __init__(self, pool, slow_queries=None):
+        self._pool = pool
+        self.slow_queries = slow_queries
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    def acquire(self, *args, **kwargs):
+        return _AcquireContext(self, args, kwargs)
+
+    async def _acquire(self, *args, **kwargs):
+        start = time.perf_counter()
+        con = await self._pool.acquire(*args, **kwargs)
+        DB_POOL_WAIT.observe(time.perf_counter() - start)
+        DB_POOL_IN_USE.inc()
+        return InstrumentedConnection(con, slow_queries=self.slow_queries)
+
+    async def release(self, con):
+        DB_POOL_IN_USE.dec()
+        if isinstance(con, InstrumentedConnection):
+            con = con._con
+        return await self._pool.release(con)
+
+def timed_location_lookup(backend, get_location):
+    """wraps a location lookup function, recording its latency under the
+    backend's name"""
+
+    histogram = LOCATION_LOOKUP_LATENCY.labels(backend)
+
+    async def get_location_timed(pool, ip_addr):
+        start = time.perf_counter()
+        try:
+            return await get_location(pool, ip_addr)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    return get_location_timed
@@ -0,0 +1,234 @@
+import asyncio
+import aiohttp
+import json
+import logging
+import os
+import random
+import time
+
+from toshi.request import sign_request
+from toshi.handlers import (
+    TOSHI_TIMESTAMP_HEADER,
+    TOSHI_SIGNATURE_HEADER,
+    TOSHI_ID_ADDRESS_HEADER)
+
+log = logging.getLogger('worker.log')
+
+# the maximum number of concurrent pushes made by a reprocessing job
+PUSH_CONCURRENCY = int(os.environ.get('REPUTATION_PUSH_CONCURRENCY', 20))
+
+# failed pushes are retried through a delayed retry set in redis rather
+# than sleeping in the job, and moved to the dead letter list once they
+# run out of attempts
+MAX_PUSH_ATTEMPTS = 10
+PUSH_RETRY_BASE_DELAY = 5
+PUSH_RETRY_MAX_DELAY = 300
+PUSH_RETRY_KEY = "toshirep:push:retry"
+PUSH_DEAD_LETTER_KEY = "toshirep:push:dead"
+
+# batch mode collects the updates for each push url and sends them as a
+# single signed json array to the urls that support it
+PUSH_BATCH_ENABLED = os.environ.get('REPUTATION_PUSH_BATCH', '0').lower() in ('1', 'true', 'yes')
+PUSH_BATCH_SIZE = int(os.environ.get('REPUTATION_PUSH_BATCH_SIZE', 100))
+PUSH_BATCH_LINGER = float(os.environ.get('REPUTATION_PUSH_BATCH_LINGER', 0.5))
+
+# push urls advertise batch support by returning this header, with the
+# maximum number of updates they accept in a single request, in
+# response to an OPTIONS request
+PUSH_BATCH_HEADER = 'Toshi-Reputation-Batch-Max'
+# how long the result of checking a url for batch support is used for
+PUSH_BATCH_CAPABILITY_TTL = 600
+
+async def signed_post(session, push_url, body, address, signing_key):
+    """makes a signed POST of the body to the given url, returning True if
+    the request succeeded"""
+
+    path = '/' + push_url.split('/', 3)[-1]
+
+    method = 'POST'
+    timestamp = int(time.time())
+    signature = sign_request(signing_key, method, path, timestamp, body)
+
+    try:
+        with aiohttp.Timeout(10):
+            async with session.post(push_url,
+                                    headers={
+                                        'content-type': 'application/json',
+                                        TOSHI_SIGNATURE_HEADER: signature,
+                                        TOSHI_ID_ADDRESS_HEADER: address,
+                                        TOSHI_TIMESTAMP_HEADER: str(timestamp)},
+                                    data=body) as response:
+                if response.status == 204 or response.status == 200:
+                    return True
+                log.error("Error updating user details")
+                log.error("URL: {}".format(push_url))
+                log.error("Status: {}".format(response.status))
+    except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+        log.exception("Error updating user details: {}".format(push_url))
+
+    return False
+
+async def do_push(push_url, body, address, signing_key, reviewee_id, session=None):
+    """makes a single attempt at pushing the reputation body to the given
+    url, returning True if the push succeeded.
+
+    Failed pushes are not retried here, see `push_with_retry`"""
+
+    if session is None:
+        async with aiohttp.ClientSession() as session:
+            return await do_push(push_url, body, address, signing_key, reviewee_id, session=session)
+
+    success = await signed_post(session, push_url, body, address, signing_key)
+    if not success:
+        log.error("User Address: {}".format(reviewee_id))
+    return success
+
+def push_retry_delay(attempt):
+    """exponential backoff with jitter for the given retry attempt"""
+    delay = min(PUSH_RETRY_MAX_DELAY, PUSH_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def schedule_push_retry(redis_connection, push_url, reviewee_id, attempt, now=None):
+    """schedules another push attempt in the delayed retry set, or moves
+    the push to the dead letter list if it is out of attempts"""
+
+    if redis_connection is None:
+        log.error("Unable to schedule push retry for {} to {}: no redis connection".format(reviewee_id, push_url))
+        return
+    now = time.time() if now is None else now
+    if attempt >= MAX_PUSH_ATTEMPTS:
+        log.error("Giving up pushing {} to {} after {} attempts".format(reviewee_id, push_url, attempt))
+        redis_connection.lpush(PUSH_DEAD_LETTER_KEY, json.dumps({
+            "push_url": push_url,
+            "reviewee_id": reviewee_id,
+            "attempts": attempt,
+            "failed_at": int(now)
+        }))
+    else:
+        entry = json.dumps({
+            "push_url": push_url,
+            "reviewee_id": reviewee_id,
+            "attempt": attempt
+        }, sort_keys=True)
+        redis_connection.execute_command('ZADD', PUSH_RETRY_KEY, now + push_retry_delay(attempt), entry)
+
+async def record_push_result(resources, push_url, reviewee_id, attempt, success):
+    """counts the push in the job stats, scheduling a retry if it failed"""
+
+    resources.job_stats.incr('pushes')
+    if not success:
+        resources.job_stats.incr('pushes_failed')
+        resources.job_stats.incr('push_retries' if attempt + 1 < MAX_PUSH_ATTEMPTS else 'push_dead_letters')
+        await resources.run_redis(schedule_push_retry, resources.redis, push_url, reviewee_id, attempt + 1)
+
+async def push_with_retry(resources, push_url, body, address, signing_key, reviewee_id, attempt=0):
+    """pushes the body, scheduling a delayed retry if the push fails"""
+
+    if resources.batch_pusher is not None:
+        return await resources.batch_pusher.push(push_url, body, signing_key, reviewee_id, attempt=attempt)
+
+    with resources.job_stats.timer('push'):
+        success = await do_push(push_url, body, address, signing_key, reviewee_id,
+                                session=resources.session(push_url))
+    await record_push_result(resources, push_url, reviewee_id, attempt, success)
+    return success
+
+class BatchPusher:
+    """Collects reputation pushes per push url and sends them as a single
+    signed json array once `max_batch_size` updates are pending or the
+    oldest pending update has waited `max_linger` seconds.
+
+    Urls that don't advertise batch support are sent the updates as
+    individual POSTs."""
+
+    def __init__(self, resources, max_batch_size=PUSH_BATCH_SIZE, max_linger=PUSH_BATCH_LINGER):
+        self.resources = resources
+        self.max_batch_size = max_batch_size
+        self.max_linger = max_linger
+        self.pending = {}
+        self.timers = {}
+        self.sending = set()
+        self.capabilities = {}
+
+    def push(self, push_url, body, signing_key, reviewee_id, attempt=0):
+        """queues the push, returning a future that resolves to whether
+        the push succeeded"""
+
+        loop = asyncio.get_event_loop()
+        key = (push_url, signing_key)
+        future = loop.create_future()
+        batch = self.pending.setdefault(key, [])
+        batch.append((reviewee_id, body, attempt, future))
+        if len(batch) >= self.max_batch_size:
+            self.flush(key)
+        elif key not in self.timers:
+            self.timers[key] = loop.call_later(self.max_linger, self.flush, key)
+        return future
+
+    def flush(self, key):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(key, None)
+        if batch:
+            task = asyncio.ensure_future(self._send(key, batch))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+    async def close(self):
+        for key in list(self.pending.keys()):
+            self.flush(key)
+        if self.sending:
+            await asyncio.wait(self.sending)
+
+    async def batch_size(self, push_url, session):
+        """returns the maximum batch size the url accepts, or 0 if it
+        doesn't support batches"""
+
+        capability = self.capabilities.get(push_url)
+        if capability is not None and capability[1] > time.time():
+            return capability[0]
+
+        size = 0
+        try:
+            with aiohttp.Timeout(10):
+                async with session.options(push_url) as response:
+                    if response.status < 400 and PUSH_BATCH_HEADER in response.headers:
+                        size = int(response.headers[PUSH_BATCH_HEADER])
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError):
+            log.exception("Error checking batch support for {}".format(push_url))
+        self.capabilities[push_url] = (size, time.time() + PUSH_BATCH_CAPABILITY_TTL)
+        return size
+
+    async def _push_one(self, push_url, body, address, signing_key, reviewee_id, session):
+        with self.resources.job_stats.timer('push'):
+            return await do_push(push_url, body, address, signing_key, reviewee_id, session=session)
+
+    async def _send(self, key, batch):
+        push_url, signing_key = key
+        session = self.resources.session(push_url)
+        address = self.resources.address(signing_key)
+
+        try:
+            size = min(await self.batch_size(push_url, session), self.max_batch_size)
+            if size <= 1:
+                results = await asyncio.gather(*[
+                    self._push_one(push_url, body, address, signing_key, reviewee_id, session)
+                    for reviewee_id, body, _, _ in batch])
+            else:
+                results = []
+                for i in range(0, len(batch), size):
+                    chunk = batch[i:i + size]
+                    # the bodies are already json encoded objects
+                    body = "[{}]".format(",".join(body for _, body, _, _ in chunk))
+                    with self.resources.job_stats.timer('push'):
+                        success = await signed_post(session, push_url, body, address, signing_key)
+                    results.extend([success] * len(chunk))
+        except Exception:
+            log.exception("Error sending reputation batch to {}".format(push_url))
+            results = [False] * len(batch)
+
+        for (reviewee_id, _, attempt, future), success in zip(batch, results):
+            await record_push_result(self.resources, push_url, reviewee_id, attempt, success)
+            if not future.done():
+                future.set_result(success)
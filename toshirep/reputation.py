@@ -0,0 +1,113 @@
+"""Rebuilds and verifies the `reviewee_reputation` aggregate table.
+
+usage: python -m toshirep.reputation [verify|rebuild]
+
+`verify` recomputes the aggregates from `reviews` and reports every
+reviewee whose stored aggregate has drifted, `rebuild` does the same and
+then overwrites the stored aggregates with the recomputed values.
+"""
+import argparse
+import asyncio
+import asyncpg
+import logging
+import os
+import sys
+
+log = logging.getLogger("toshirep.reputation")
+
+AGGREGATE_COLUMNS = ['review_count', 'rating_sum', 'stars_1', 'stars_2', 'stars_3', 'stars_4', 'stars_5']
+
+# the aggregate columns computed from `reviews`, without a WHERE or GROUP BY
+AGGREGATE_SELECT_SQL = (
+    "SELECT reviewee_id, COUNT(rating) AS review_count, COALESCE(SUM(rating), 0) AS rating_sum, "
+    "COUNT(rating) FILTER (WHERE rating < 2.0) AS stars_1, "
+    "COUNT(rating) FILTER (WHERE rating >= 2.0 AND rating < 3.0) AS stars_2, "
+    "COUNT(rating) FILTER (WHERE rating >= 3.0 AND rating < 4.0) AS stars_3, "
+    "COUNT(rating) FILTER (WHERE rating >= 4.0 AND rating < 5.0) AS stars_4, "
+    "COUNT(rating) FILTER (WHERE rating >= 5.0) AS stars_5 "
+    "FROM reviews ")
+
+AGGREGATE_SQL = AGGREGATE_SELECT_SQL + "GROUP BY reviewee_id"
+
+DRIFT_SQL = (
+    "SELECT COALESCE(expected.reviewee_id, actual.reviewee_id) AS reviewee_id, "
+    "{expected_columns}, {actual_columns} "
+    "FROM ({aggregate}) AS expected "
+    "FULL OUTER JOIN reviewee_reputation AS actual ON expected.reviewee_id = actual.reviewee_id "
+    "WHERE {differences}").format(
+        aggregate=AGGREGATE_SQL,
+        expected_columns=", ".join("COALESCE(expected.{0}, 0) AS expected_{0}".format(c) for c in AGGREGATE_COLUMNS),
+        actual_columns=", ".join("COALESCE(actual.{0}, 0) AS actual_{0}".format(c) for c in AGGREGATE_COLUMNS),
+        differences=" OR ".join("COALESCE(expected.{0}, 0) != COALESCE(actual.{0}, 0)".format(c)
+                                for c in AGGREGATE_COLUMNS))
+
+async def verify_reputations(con):
+    """returns a list of dicts describing every reviewee whose stored
+    aggregate does not match the aggregate computed from `reviews`"""
+
+    rows = await con.fetch(DRIFT_SQL)
+    drift = []
+    for row in rows:
+        drift.append({
+            "reviewee_id": row['reviewee_id'],
+            "expected": {c: row['expected_{}'.format(c)] for c in AGGREGATE_COLUMNS},
+            "actual": {c: row['actual_{}'.format(c)] for c in AGGREGATE_COLUMNS}
+        })
+    return drift
+
+async def rebuild_reputations(con):
+    """recomputes every aggregate from `reviews`, returning the drift
+    that was found before the rebuild.
+
+    Writes to `reviews` are blocked while the rebuild runs so the
+    triggers cannot race with the recomputed values."""
+
+    async with con.transaction():
+        await con.execute("LOCK TABLE reviews IN SHARE MODE")
+        drift = await verify_reputations(con)
+        await con.execute(
+            "INSERT INTO reviewee_reputation (reviewee_id, {columns}) {aggregate} "
+            "ON CONFLICT (reviewee_id) DO UPDATE SET {updates}".format(
+                columns=", ".join(AGGREGATE_COLUMNS),
+                aggregate=AGGREGATE_SQL,
+                updates=", ".join("{0} = EXCLUDED.{0}".format(c) for c in AGGREGATE_COLUMNS)))
+        await con.execute(
+            "DELETE FROM reviewee_reputation rr "
+            "WHERE NOT EXISTS (SELECT 1 FROM reviews WHERE reviews.reviewee_id = rr.reviewee_id)")
+    return drift
+
+async def _run(command, database_config):
+    con = await asyncpg.connect(**database_config)
+    try:
+        if command == 'rebuild':
+            drift = await rebuild_reputations(con)
+        else:
+            drift = await verify_reputations(con)
+    finally:
+        await con.close()
+
+    for entry in drift:
+        log.warning("drift for {}: expected {} got {}".format(
+            entry['reviewee_id'], entry['expected'], entry['actual']))
+    log.info("{} reviewees with drifted reputation aggregates{}".format(
+        len(drift), ", rebuilt" if command == 'rebuild' else ""))
+    return drift
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Verify or rebuild the reviewee_reputation aggregates")
+    parser.add_argument('command', choices=['verify', 'rebuild'], nargs='?', default='verify')
+    args = parser.parse_args(argv)
+
+    if 'DATABASE_URL' not in os.environ:
+        log.error("ENVIRONMENT MISSING `DATABASE_URL`")
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    drift = loop.run_until_complete(_run(args.command, {'dsn': os.environ['DATABASE_URL']}))
+    # a non zero exit code lets verify be used in scripts/cron checks
+    if drift and args.command == 'verify':
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
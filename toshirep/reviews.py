@@ -0,0 +1,319 @@
+"""Validation of reviews and bulk import and export of reviews as NDJSON.
+
+usage: python -m toshirep.reviews import [FILE]
+       python -m toshirep.reviews export [--reviewee ADDRESS] [--reviewer ADDRESS] [--oldest DATE] [FILE]
+
+Every line of the input is a json object with `reviewer`, `reviewee`,
+`rating` and optionally `review`, `created` and `updated`. Lines are
+validated with the same rules as `/v1/review/submit`, loaded into a
+temporary staging table and merged into `reviews` with a single upsert.
+Reviews that already exist are only replaced by imported reviews that
+were updated later.
+
+Exports are read from a server-side cursor in order of `updated`, so
+they use constant memory and an interrupted export can be resumed by
+passing the `date` of the last exported review as `oldest`. `oldest` is
+inclusive, so the reviews updated at that time are exported again and
+clients resuming an export have to dedupe on (reviewer, reviewee).
+"""
+import argparse
+import asyncio
+import asyncpg
+import iso8601
+import json
+import logging
+import os
+import redis
+import sys
+
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+from rq import Queue
+
+from toshi.utils import validate_address
+from toshirep.cache import ReputationCache
+from toshirep.tasks import queue_user_reputation_updates
+from toshirep.worker import get_redis_url
+
+log = logging.getLogger("toshirep.reviews")
+
+# how many invalid lines are reported back in detail
+MAX_REPORTED_ERRORS = 100
+
+class ReviewValidationError(ValueError):
+
+    def __init__(self, id, message):
+        super().__init__(message)
+        self.id = id
+        self.message = message
+
+def render_review(review):
+    return {
+        "reviewer": review['reviewer_id'],
+        "reviewee": review['reviewee_id'],
+        "rating": float(review['rating']),
+        "review": review['review'],
+        "date": review['updated'].isoformat(),
+        "edited": review['created'] != review['updated']
+    }
+
+def validate_user_address(address, message='Invalid User Address'):
+    """returns the lowercased address"""
+    if not isinstance(address, str):
+        raise ReviewValidationError('invalid_address', message)
+    # lowercase the address
+    address = address.lower()
+    if not validate_address(address):
+        raise ReviewValidationError('invalid_address', message)
+    return address
+
+def validate_rating(rating):
+    """returns the rating as a Decimal between 0 and 5"""
+    if isinstance(rating, (dict, list, type(None))):
+        rating = Decimal(-1)
+    else:
+        try:
+            rating = Decimal(rating)
+        except (InvalidOperation, ValueError, TypeError):
+            rating = Decimal(-1)
+    if rating.is_nan() or rating.is_infinite() or rating < 0 or rating > 5:
+        raise ReviewValidationError('invalid_rating', 'Invalid Rating')
+    return rating
+
+def validate_review_message(message):
+    if message and not isinstance(message, str):
+        raise ReviewValidationError('invalid_review', 'Invalid Review')
+    return message
+
+def validate_review(reviewer, reviewee, rating, message):
+    """validates a review with the rules used by `/v1/review/submit`,
+    returning the normalized (reviewee, rating, message). The reviewer is
+    expected to be a normalized address already."""
+    reviewee = validate_user_address(reviewee)
+    if reviewer == reviewee:
+        raise ReviewValidationError('invalid_reviewee', "Cannot review yourself!")
+    return reviewee, validate_rating(rating), validate_review_message(message)
+
+def _parse_date(value, name):
+    try:
+        date = iso8601.parse_date(value)
+    except (iso8601.ParseError, TypeError):
+        raise ReviewValidationError('invalid_date', 'Invalid date for `{}`'.format(name))
+    # reviews are stored as utc without a timezone
+    return date.astimezone(timezone.utc).replace(tzinfo=None)
+
+def parse_import_record(line, now=None):
+    """returns the (reviewer, reviewee, rating, review, created, updated)
+    tuple for a line of NDJSON, raising ReviewValidationError if the line
+    isn't a valid review"""
+
+    try:
+        record = json.loads(line)
+    except ValueError:
+        raise ReviewValidationError('invalid_json', 'Invalid JSON')
+    if not isinstance(record, dict) or not all(x in record for x in ['reviewer', 'reviewee', 'rating']):
+        raise ReviewValidationError('bad_arguments', 'Bad Arguments')
+
+    reviewer = validate_user_address(record['reviewer'], 'Invalid Address for `reviewer`')
+    reviewee, rating, message = validate_review(reviewer, record['reviewee'], record['rating'], record.get('review'))
+
+    now = now or datetime.utcnow()
+    created = _parse_date(record['created'], 'created') if record.get('created') is not None else now
+    updated = _parse_date(record['updated'], 'updated') if record.get('updated') is not None else created
+    return reviewer, reviewee, rating, message, created, updated
+
+IMPORT_COLUMNS = ['reviewer_id', 'reviewee_id', 'rating', 'review', 'created', 'updated']
+
+# merges the staged reviews, keeping the latest version of each review
+MERGE_SQL = (
+    "INSERT INTO reviews (reviewer_id, reviewee_id, rating, review, created, updated) "
+    "SELECT DISTINCT ON (reviewer_id, reviewee_id) reviewer_id, reviewee_id, rating, review, created, updated "
+    "FROM review_import ORDER BY reviewer_id, reviewee_id, updated DESC "
+    "ON CONFLICT (reviewer_id, reviewee_id) DO UPDATE "
+    "SET rating = EXCLUDED.rating, review = EXCLUDED.review, "
+    "created = LEAST(reviews.created, EXCLUDED.created), updated = EXCLUDED.updated "
+    "WHERE reviews.updated <= EXCLUDED.updated "
+    "RETURNING reviewee_id")
+
+async def _stage_reviews(con, rows):
+    if hasattr(con, 'copy_records_to_table'):
+        await con.copy_records_to_table('review_import', records=rows, columns=IMPORT_COLUMNS)
+    else:
+        await con.execute(
+            "INSERT INTO review_import ({}) "
+            "SELECT * FROM unnest($1::varchar[], $2::varchar[], $3::decimal[], $4::varchar[], "
+            "$5::timestamp[], $6::timestamp[])".format(", ".join(IMPORT_COLUMNS)),
+            *[list(values) for values in zip(*rows)])
+
+async def import_reviews(con, lines, batch_size=5000):
+    """imports the reviews from an iterable of NDJSON lines, returning a
+    dict with the number of imported and invalid lines, the number of
+    reviews that were inserted or replaced, the first
+    `MAX_REPORTED_ERRORS` errors and the list of reviewees whose reviews
+    changed.
+
+    Valid lines are imported even if some lines are invalid."""
+
+    report = {'lines': 0, 'imported': 0, 'invalid': 0, 'merged': 0, 'errors': [], 'reviewees': []}
+    now = datetime.utcnow()
+
+    async with con.transaction():
+        await con.execute(
+            "CREATE TEMPORARY TABLE review_import ("
+            "reviewer_id VARCHAR, reviewee_id VARCHAR, rating DECIMAL, review VARCHAR, "
+            "created TIMESTAMP WITHOUT TIME ZONE, updated TIMESTAMP WITHOUT TIME ZONE"
+            ") ON COMMIT DROP")
+
+        batch = []
+        for line in lines:
+            report['lines'] += 1
+            if not line.strip():
+                continue
+            try:
+                if isinstance(line, bytes):
+                    try:
+                        line = line.decode('utf-8')
+                    except UnicodeDecodeError:
+                        raise ReviewValidationError('invalid_json', 'Invalid JSON')
+                batch.append(parse_import_record(line, now=now))
+            except ReviewValidationError as e:
+                report['invalid'] += 1
+                if len(report['errors']) < MAX_REPORTED_ERRORS:
+                    report['errors'].append({'line': report['lines'], 'id': e.id, 'message': e.message})
+                continue
+            if len(batch) >= batch_size:
+                await _stage_reviews(con, batch)
+                report['imported'] += len(batch)
+                batch = []
+        if batch:
+            await _stage_reviews(con, batch)
+            report['imported'] += len(batch)
+
+        if report['imported']:
+            rows = await con.fetch(MERGE_SQL)
+            report['merged'] = len(rows)
+            report['reviewees'] = sorted(set(row['reviewee_id'] for row in rows))
+
+    return report
+
+# how many reviews are fetched from the export cursor at a time
+EXPORT_CHUNK_SIZE = 1000
+
+def build_export_query(reviewee=None, reviewer=None, oldest=None):
+    """returns the (sql, args) exporting the reviews matching the filters,
+    oldest first, raising ReviewValidationError for invalid filters"""
+
+    wheres = []
+    sql_args = []
+    if reviewee is not None:
+        wheres.append("reviewee_id = ${}".format(len(sql_args) + 1))
+        sql_args.append(validate_user_address(reviewee, 'Invalid Address for `reviewee`'))
+    if reviewer is not None:
+        wheres.append("reviewer_id = ${}".format(len(sql_args) + 1))
+        sql_args.append(validate_user_address(reviewer, 'Invalid Address for `reviewer`'))
+    if oldest is not None:
+        wheres.append("updated >= ${}".format(len(sql_args) + 1))
+        sql_args.append(_parse_date(oldest, 'oldest'))
+
+    sql = "SELECT * FROM reviews {}ORDER BY updated, reviewer_id, reviewee_id".format(
+        "WHERE {} ".format(" AND ".join(wheres)) if wheres else "")
+    return sql, sql_args
+
+async def export_reviews(con, write, sql, sql_args, chunk_size=EXPORT_CHUNK_SIZE):
+    """streams the reviews returned by the query as NDJSON, calling the
+    `write` coroutine function with every chunk of lines. Returns the
+    number of reviews exported."""
+
+    count = 0
+    # cursors only exist inside a transaction
+    async with con.transaction():
+        cursor = await con.cursor(sql, *sql_args)
+        while True:
+            reviews = await cursor.fetch(chunk_size)
+            if not reviews:
+                break
+            await write("".join(json.dumps(render_review(review)) + "\n" for review in reviews))
+            count += len(reviews)
+    return count
+
+async def _run_export(database_config, output, sql, sql_args):
+    async def write(data):
+        output.write(data)
+
+    con = await asyncpg.connect(**database_config)
+    try:
+        return await export_reviews(con, write, sql, sql_args)
+    finally:
+        await con.close()
+
+async def _run_import(database_config, lines):
+    con = await asyncpg.connect(**database_config)
+    try:
+        return await import_reviews(con, lines)
+    finally:
+        await con.close()
+
+def _queue_updates(reviewees):
+    """invalidates the cached reputations of the reviewees and queues the
+    jobs pushing their new reputations, if redis is configured"""
+
+    url = get_redis_url()
+    if not url:
+        log.warning("ENVIRONMENT MISSING `REDIS_URL`, not updating reputations")
+        return None
+    conn = redis.from_url(url)
+    ReputationCache(conn).invalidate_many(reviewees)
+    if 'REPUTATION_PUSH_URL' not in os.environ or 'REPUTATION_PUSH_SIGNING_KEY' not in os.environ:
+        log.warning("Reputation pushing is not configured, not pushing reputations")
+        return None
+    return queue_user_reputation_updates(
+        Queue(connection=conn),
+        os.environ['REPUTATION_PUSH_URL'].split(','),
+        os.environ['REPUTATION_PUSH_SIGNING_KEY'],
+        reviewees)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import and export reviews")
+    subparsers = parser.add_subparsers(dest='command')
+    import_parser = subparsers.add_parser('import', help="import NDJSON reviews")
+    import_parser.add_argument('file', nargs='?', type=argparse.FileType('r'), default=sys.stdin)
+    export_parser = subparsers.add_parser('export', help="export reviews as NDJSON")
+    export_parser.add_argument('--reviewee')
+    export_parser.add_argument('--reviewer')
+    export_parser.add_argument('--oldest', help="only export reviews updated at or after this date")
+    export_parser.add_argument('file', nargs='?', type=argparse.FileType('w'), default=sys.stdout)
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+    if 'DATABASE_URL' not in os.environ:
+        log.error("ENVIRONMENT MISSING `DATABASE_URL`")
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    database_config = {'dsn': os.environ['DATABASE_URL']}
+
+    if args.command == 'export':
+        try:
+            sql, sql_args = build_export_query(args.reviewee, args.reviewer, args.oldest)
+        except ReviewValidationError as e:
+            parser.error(e.message)
+        count = loop.run_until_complete(_run_export(database_config, args.file, sql, sql_args))
+        args.file.flush()
+        log.info("Exported {} reviews".format(count))
+        return
+
+    report = loop.run_until_complete(_run_import(database_config, args.file))
+    for error in report['errors']:
+        log.warning("line {}: {}".format(error['line'], error['message']))
+    log.info("Imported {} reviews, {} invalid lines, {} reviewees updated".format(
+        report['imported'], report['invalid'], len(report['reviewees'])))
+    if report['reviewees']:
+        reprocess_id = _queue_updates(report['reviewees'])
+        if reprocess_id:
+            log.info("Queued reputation updates: {}".format(reprocess_id))
+
+if __name__ == '__main__':
+    main()
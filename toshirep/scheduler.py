@@ -0,0 +1,166 @@
+import json
+import time
+
+from toshi.log import log
+from tornado.ioloop import PeriodicCallback
+from .push import PUSH_RETRY_KEY
+from .tasks import update_user_reputation, push_user_reputation
+
+# marks the reviewee as dirty, scheduling an update after the quiet window
+# but never later than max delay after it was first marked dirty
+_MARK_DIRTY_SCRIPT = """
+local now = tonumber(ARGV[1])
+local first = redis.call('HGET', KEYS[2], ARGV[2])
+if first then
+    first = tonumber(first)
+else
+    first = now
+    redis.call('HSET', KEYS[2], ARGV[2], now)
+end
+local due = math.min(now + tonumber(ARGV[3]), first + tonumber(ARGV[4]))
+redis.call('ZADD', KEYS[1], due, ARGV[2])
+return 1
+"""
+
+# atomically moves the members that are due into the claimed set and
+# returns them, so multiple web processes can run schedulers without
+# enqueuing duplicates. Claims older than the claim timeout were never
+# acknowledged, so the scheduler that made them died before enqueuing
+# them and they are made due again first.
+_CLAIM_DUE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local stale = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now - tonumber(ARGV[3]), 'LIMIT', 0, ARGV[2])
+if #stale > 0 then
+    for _, member in ipairs(stale) do
+        redis.call('ZADD', KEYS[1], now, member)
+    end
+    redis.call('ZREM', KEYS[2], unpack(stale))
+end
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, ARGV[2])
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+    for _, member in ipairs(due) do
+        redis.call('ZADD', KEYS[2], now, member)
+    end
+    if KEYS[3] then
+        redis.call('HDEL', KEYS[3], unpack(due))
+    end
+end
+return due
+"""
+
+class ReputationScheduler:
+    """Coalesces reputation updates for the same reviewee and enqueues
+    the delayed retries of failed pushes.
+
+    Instead of enqueuing an update job for every write, reviewees are
+    marked dirty and a single job is enqueued once no new writes have
+    been seen for `quiet_window` seconds, or `max_delay` seconds after
+    the first write, whichever comes first. A `quiet_window` of 0
+    disables this and enqueues a job for every update.
+
+    Due reviewees and retries are claimed before they are enqueued and
+    only removed once they have been, claims that aren't acknowledged
+    within `claim_timeout` seconds are made due again."""
+
+    def __init__(self, queue, push_urls, signing_key, quiet_window=2, max_delay=30,
+                 prefix="toshirep:debounce", batch_size=1000, claim_timeout=60):
+        self.q = queue
+        self.redis = queue.connection
+        self.push_urls = push_urls
+        self.signing_key = signing_key
+        self.quiet_window = quiet_window
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.claim_timeout = claim_timeout
+        self.due_key = "{}:due".format(prefix)
+        self.first_key = "{}:first".format(prefix)
+        self._mark_dirty = self.redis.register_script(_MARK_DIRTY_SCRIPT)
+        self._claim_due = self.redis.register_script(_CLAIM_DUE_SCRIPT)
+        self._callback = None
+
+    def schedule_update(self, reviewee_id):
+        if self.quiet_window > 0:
+            self.mark_dirty(reviewee_id)
+        else:
+            self._enqueue_update(reviewee_id)
+
+    def mark_dirty(self, reviewee_id, now=None):
+        now = time.time() if now is None else now
+        self._mark_dirty(keys=[self.due_key, self.first_key],
+                         args=[now, reviewee_id, self.quiet_window, self.max_delay])
+
+    def pending(self):
+        return self.redis.zcard(self.due_key)
+
+    def pending_retries(self):
+        return self.redis.zcard(PUSH_RETRY_KEY)
+
+    def _enqueue_due(self, key, enqueue, now, first_key=None):
+        """claims the due members of the sorted set at `key` in batches,
+        calling `enqueue` for each of them, and returns how many were
+        enqueued"""
+
+        claimed_key = "{}:claimed".format(key)
+        keys = [key, claimed_key] + ([first_key] if first_key is not None else [])
+        count = 0
+        while True:
+            due = self._claim_due(keys=keys, args=[now, self.batch_size, self.claim_timeout])
+            for i, member in enumerate(due):
+                try:
+                    enqueue(member.decode('utf-8'))
+                except Exception:
+                    # put back what wasn't enqueued for the next tick
+                    pipe = self.redis.pipeline()
+                    for remaining in due[i:]:
+                        pipe.execute_command('ZADD', key, now, remaining)
+                    pipe.zrem(claimed_key, *due)
+                    pipe.execute()
+                    raise
+            if due:
+                self.redis.zrem(claimed_key, *due)
+            count += len(due)
+            if len(due) < self.batch_size:
+                return count
+
+    def _enqueue_update(self, reviewee_id):
+        self.q.enqueue(
+            update_user_reputation,
+            self.push_urls,
+            self.signing_key,
+            reviewee_id)
+
+    def _enqueue_retry(self, entry):
+        entry = json.loads(entry)
+        self.q.enqueue(
+            push_user_reputation,
+            entry['push_url'],
+            self.signing_key,
+            entry['reviewee_id'],
+            entry['attempt'])
+
+    def tick(self, now=None):
+        """enqueues the update jobs and push retries that are due, returning
+        how many update jobs were enqueued"""
+
+        now = time.time() if now is None else now
+        enqueued = self._enqueue_due(self.due_key, self._enqueue_update, now, first_key=self.first_key)
+        self._enqueue_due(PUSH_RETRY_KEY, self._enqueue_retry, now)
+        return enqueued
+
+    def _safe_tick(self):
+        try:
+            self.tick()
+        except Exception:
+            log.exception("Error running reputation scheduler")
+
+    def start(self, interval=None):
+        if interval is None:
+            interval = min(max(self.quiet_window / 2, 0.1), 1) if self.quiet_window > 0 else 1
+        self._callback = PeriodicCallback(self._safe_tick, interval * 1000)
+        self._callback.start()
+
+    def stop(self):
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = None
@@ -0,0 +1,172 @@
+"""Logs database statements that take longer than a threshold.
+
+Slow statements are logged with their normalized sql and argument types
+and kept in a bounded ring buffer. A sample of them are explained on a
+separate connection in the background: plain selects with
+`EXPLAIN (ANALYZE, BUFFERS)`, anything else with a plain `EXPLAIN` so
+writes aren't run again. Explains run in a transaction that is rolled back.
+
+The worker processes also write their slow statements to a capped list
+in redis, so `/v1/admin/slow_queries` can show them next to the web
+process's own.
+"""
+import asyncio
+import asyncpg
+import json
+import logging
+import os
+import random
+import re
+import redis
+
+from collections import deque
+from datetime import datetime
+
+from toshirep.metrics import Counter, query_name
+
+log = logging.getLogger("toshirep.slowqueries")
+
+# the defaults for the workers, the web process reads the same variables
+# into its config
+SLOW_QUERY_THRESHOLD = float(os.environ.get('SLOW_QUERY_THRESHOLD', 0.5))
+SLOW_QUERY_EXPLAIN_SAMPLE_RATE = float(os.environ.get('SLOW_QUERY_EXPLAIN_SAMPLE_RATE', 0.1))
+SLOW_QUERY_LOG_SIZE = int(os.environ.get('SLOW_QUERY_LOG_SIZE', 100))
+
+SLOW_QUERY_KEY = "toshirep:slow_queries"
+
+# explains are skipped while this many are still running
+MAX_PENDING_EXPLAINS = 2
+
+SLOW_QUERIES = Counter(
+    'toshirep_db_slow_queries_total', "Database queries slower than the slow query threshold", ['query'])
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"(?<![$\w.])\d+(?:\.\d+)?\b")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+def normalize_sql(query):
+    """collapses whitespace and replaces literals with `?`, so statements
+    that only differ in their literals look the same"""
+    query = _STRING_RE.sub("?", query)
+    query = _NUMBER_RE.sub("?", query)
+    return _WHITESPACE_RE.sub(" ", query).strip()
+
+def _arg_type(arg):
+    if isinstance(arg, (list, tuple)):
+        return "{}[{}]".format(type(arg).__name__, "|".join(sorted({type(a).__name__ for a in arg})))
+    return type(arg).__name__
+
+_WRITE_RE = re.compile(r"\b(?:INSERT|UPDATE|DELETE|MERGE|TRUNCATE|COPY|CREATE|ALTER|DROP|LOCK|NEXTVAL|SETVAL)\b",
+                       re.IGNORECASE)
+
+def _is_read(query):
+    """whether the statement can be run again by `EXPLAIN ANALYZE` without
+    side effects. Only plain selects count, so data modifying CTEs,
+    `SELECT ... FOR UPDATE` and sequence calls are only explained."""
+    words = query.split(None, 1)
+    if not words or words[0].upper() != 'SELECT':
+        return False
+    return _WRITE_RE.search(_STRING_RE.sub("", query)) is None
+
+class SlowQueryLog:
+    """records statements that took at least `threshold` seconds.
+
+    `explain_connection` is called to get an async context manager giving
+    the connection explains run on. It should not be instrumented with
+    this log itself."""
+
+    def __init__(self, threshold=SLOW_QUERY_THRESHOLD, sample_rate=SLOW_QUERY_EXPLAIN_SAMPLE_RATE,
+                 maxlen=SLOW_QUERY_LOG_SIZE, explain_connection=None, redis_connection=None, source='web'):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.maxlen = maxlen
+        self.explain_connection = explain_connection
+        self.redis = redis_connection
+        self.source = source
+        self.entries = deque(maxlen=maxlen)
+        self.pending = set()
+        self.slow = 0
+        self.explained = 0
+        self.explain_errors = 0
+
+    def record(self, query, args, duration):
+        if duration < self.threshold:
+            return
+
+        name = query_name(query)
+        SLOW_QUERIES.labels(name).inc()
+        self.slow += 1
+        entry = {
+            'time': datetime.utcnow().isoformat(),
+            'source': self.source,
+            'name': name,
+            'query': normalize_sql(query),
+            'arg_types': [_arg_type(arg) for arg in args],
+            'duration_ms': round(duration * 1000, 3),
+            'plan': None
+        }
+        log.warning("slow query ({}ms): {} {}".format(entry['duration_ms'], entry['query'], entry['arg_types']))
+        self.entries.append(entry)
+
+        if (self.explain_connection is not None and len(self.pending) < MAX_PENDING_EXPLAINS and
+                random.random() < self.sample_rate):
+            fut = asyncio.ensure_future(self._explain(entry, query, args))
+            self.pending.add(fut)
+            fut.add_done_callback(self.pending.discard)
+        else:
+            self._publish(entry)
+
+    async def _explain(self, entry, query, args):
+        analyze = _is_read(query)
+        try:
+            async with self.explain_connection() as con:
+                tr = con.transaction()
+                await tr.start()
+                try:
+                    row = await con.fetchrow(
+                        "EXPLAIN ({}FORMAT JSON) {}".format("ANALYZE, BUFFERS, " if analyze else "", query), *args)
+                finally:
+                    await tr.rollback()
+            plan = row[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            entry['plan'] = plan
+            entry['analyzed'] = analyze
+            self.explained += 1
+        except (asyncpg.exceptions.PostgresError, OSError, asyncio.TimeoutError) as e:
+            entry['explain_error'] = str(e)
+            self.explain_errors += 1
+        self._publish(entry)
+
+    def _publish(self, entry):
+        if self.redis is None:
+            return
+        try:
+            pipe = self.redis.pipeline()
+            pipe.lpush(SLOW_QUERY_KEY, json.dumps(entry))
+            pipe.ltrim(SLOW_QUERY_KEY, 0, self.maxlen - 1)
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            log.exception("Error publishing slow query")
+
+    def recent(self):
+        """the recorded slow queries, newest first"""
+        return list(reversed(self.entries))
+
+    def stats(self):
+        return {
+            'threshold_ms': self.threshold * 1000,
+            'slow': self.slow,
+            'explained': self.explained,
+            'explain_errors': self.explain_errors,
+            'pending_explains': len(self.pending)
+        }
+
+    async def close(self):
+        """waits for the running explains"""
+        if self.pending:
+            await asyncio.wait(list(self.pending))
+
+def published_slow_queries(redis_connection, limit=SLOW_QUERY_LOG_SIZE):
+    """the slow queries published by other processes, newest first"""
+    return [json.loads(entry.decode('utf-8')) for entry in redis_connection.lrange(SLOW_QUERY_KEY, 0, limit - 1)]
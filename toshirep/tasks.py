@@ -1,21 +1,32 @@
 import asyncio
 import asyncpg
 import aiohttp
+import inspect
 import json
-import time
 import os
 import math
 import logging
+import numpy as np
+import time
+import uuid
 
+from urllib.parse import urlparse
+
+from datetime import datetime
+from rq import get_current_connection, get_current_job
 from toshi.ethereum.utils import private_key_to_address
-from toshi.request import sign_request
-from toshi.handlers import (
-    TOSHI_TIMESTAMP_HEADER,
-    TOSHI_SIGNATURE_HEADER,
-    TOSHI_ID_ADDRESS_HEADER)
+from .metrics import InstrumentedConnection
+from .slowqueries import SlowQueryLog
+from .jobstats import JobStats
+from .push import BatchPusher, push_with_retry, PUSH_CONCURRENCY, PUSH_BATCH_ENABLED
 
 log = logging.getLogger('worker.log')
 
+# number of reviewees recomputed by each reprocessing job
+REPROCESS_CHUNK_SIZE = 1000
+# how long reprocessing progress is kept around for
+REPROCESS_STATUS_TTL = 7 * 24 * 60 * 60
+
 def starsort(ns):
     """taken from https://stackoverflow.com/a/40958702"""
     N = sum(ns)
@@ -30,12 +41,30 @@ def starsort(ns):
     fsns = f(s, ns)
     return fsns - z * math.sqrt((f(s2, ns) - fsns ** 2) / (N + K + 1))
 
-async def calculate_user_reputation(con, reviewee_id):
-    row = await con.fetchrow(
-        "SELECT AVG(rating), COUNT(rating) FROM reviews WHERE reviewee_id = $1",
-        reviewee_id)
+def starsort_batch(counts):
+    """vectorized version of `starsort` over an (N x 5) array of star counts
+    (ordered 5 stars to 1 star, like `starsort`'s input), returning the N
+    scores rounded to one decimal place the same way the scalar scores are"""
+    ns = np.asarray(counts, dtype=np.int64).reshape(-1, 5)
+    N = ns.sum(axis=1)
+    K = ns.shape[1]
+    s = np.arange(K, 0, -1, dtype=np.int64)
+    z = 1.65
+    # the sums are done with integers so they are exact, which keeps the
+    # floating point operations identical to the scalar version
+    fsns = ((ns + 1) * s).sum(axis=1) / (N + K)
+    fs2ns = ((ns + 1) * s ** 2).sum(axis=1) / (N + K)
+    score = fsns - z * np.sqrt((fs2ns - fsns ** 2) / (N + K + 1))
+    return np.round(score * 10) / 10
+
+def reputation_from_aggregate(row, score=None):
+    """converts a `reviewee_reputation` row into the
+    (score, count, avg, stars) tuple used by the api and push payloads.
 
-    if row['count'] == 0:
+    `score` can be given if the rounded starsort score for the row has
+    already been calculated (e.g. by `starsort_batch`)"""
+
+    if row is None or row['review_count'] == 0:
         count = 0
         avg = 0
         score = 0
@@ -47,96 +76,288 @@ async def calculate_user_reputation(con, reviewee_id):
             "5": 0
         }
     else:
-        count = row['count']
-        avg = row['avg']
+        count = row['review_count']
+        avg = row['rating_sum'] / count
         avg = round(avg * 10) / 10
 
-        # TODO: perhaps be smarter here (i.e. try do it in a single query)
-        star1 = await con.fetchrow(
-            "SELECT COUNT(rating) FROM reviews WHERE reviewee_id = $1 AND rating < 2.0",
-            reviewee_id)
-        star2 = await con.fetchrow(
-            "SELECT COUNT(rating) FROM reviews WHERE reviewee_id = $1 AND rating >= 2.0 AND rating < 3.0",
-            reviewee_id)
-        star3 = await con.fetchrow(
-            "SELECT COUNT(rating) FROM reviews WHERE reviewee_id = $1 AND rating >= 3.0 AND rating < 4.0",
-            reviewee_id)
-        star4 = await con.fetchrow(
-            "SELECT COUNT(rating) FROM reviews WHERE reviewee_id = $1 AND rating >= 4.0 AND rating < 5.0",
-            reviewee_id)
-        star5 = await con.fetchrow(
-            "SELECT COUNT(rating) FROM reviews WHERE reviewee_id = $1 AND rating >= 5.0",
-            reviewee_id)
-
         stars = {
-            "1": star1['count'],
-            "2": star2['count'],
-            "3": star3['count'],
-            "4": star4['count'],
-            "5": star5['count']
+            "1": row['stars_1'],
+            "2": row['stars_2'],
+            "3": row['stars_3'],
+            "4": row['stars_4'],
+            "5": row['stars_5']
         }
 
-        score = starsort((star5['count'], star4['count'], star3['count'], star2['count'], star1['count']))
-        score = round(score * 10) / 10
+        if score is None:
+            score = starsort((row['stars_5'], row['stars_4'], row['stars_3'], row['stars_2'], row['stars_1']))
+            score = round(score * 10) / 10
+        else:
+            score = float(score)
 
     return score, count, avg, stars
 
-async def _update_user_reputation(database_config, push_urls, signing_key, reviewee_id):
-    con = await asyncpg.connect(**database_config)
-    score, count, avg, _ = await calculate_user_reputation(con, reviewee_id)
-    await con.close()
+async def calculate_user_reputation(con, reviewee_id):
+    row = await con.fetchrow(
+        "SELECT * FROM reviewee_reputation WHERE reviewee_id = $1",
+        reviewee_id)
+    return reputation_from_aggregate(row)
+
+async def calculate_users_reputation(con, reviewee_ids):
+    """returns a dict mapping each of the given reviewees to their
+    (score, count, avg, stars) tuple using a single query"""
+    rows = await con.fetch(
+        "SELECT * FROM reviewee_reputation WHERE reviewee_id = ANY($1)",
+        reviewee_ids)
+    rows = {row['reviewee_id']: row for row in rows}
+    return {reviewee_id: reputation_from_aggregate(rows.get(reviewee_id))
+            for reviewee_id in reviewee_ids}
 
-    body = json.dumps({
+def reputation_push_body(reviewee_id, score, count, avg):
+    return json.dumps({
         "toshi_id": reviewee_id,
         "review_count": count,
         "average_rating": avg,
         "reputation_score": score
     })
 
-    address = private_key_to_address(signing_key)
+class _ConnectionContext:
+
+    def __init__(self, database_config, slow_queries=None):
+        self.database_config = database_config
+        self.slow_queries = slow_queries
+        self.connection = None
+
+    async def __aenter__(self):
+        self.connection = await asyncpg.connect(**self.database_config)
+        if self.slow_queries is not None:
+            self.connection = InstrumentedConnection(self.connection, slow_queries=self.slow_queries)
+        return self.connection
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.connection.close()
+
+class TaskResources:
+    """Resources used by the reputation tasks.
+
+    Database connections are opened for every use and http sessions
+    are shared per push host until `close` is called. This is what the
+    forked rq worker jobs use, see `toshirep.aioworker` for the long
+    lived pooled version.
+
+    Pushes are only batched when `batch_pushes` is set, a job pushing a
+    single update would otherwise wait for the batch to linger and send
+    a batch of one."""
+
+    def __init__(self, database_config, redis_connection=None, batch_pushes=False):
+        self.database_config = database_config
+        self.redis = redis_connection
+        self.sessions = {}
+        self.batch_pusher = BatchPusher(self) if batch_pushes and PUSH_BATCH_ENABLED else None
+        self.slow_queries = SlowQueryLog(
+            explain_connection=self.explain_connection, redis_connection=redis_connection, source='worker')
+        self.job_stats = JobStats(redis_connection)
+
+    def connection(self):
+        return _ConnectionContext(self.database_config, slow_queries=self.slow_queries)
+
+    def explain_connection(self):
+        """an uninstrumented connection for explaining slow queries"""
+        return _ConnectionContext(self.database_config)
+
+    def session(self, url):
+        host = urlparse(url).netloc
+        if host not in self.sessions:
+            self.sessions[host] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=PUSH_CONCURRENCY))
+        return self.sessions[host]
+
+    def address(self, signing_key):
+        return private_key_to_address(signing_key)
+
+    def run_redis(self, fn, *args):
+        """runs a blocking redis call in the loop's default executor, so a
+        slow redis doesn't stall the other coroutines"""
+        return asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    async def close(self):
+        if self.batch_pusher is not None:
+            await self.batch_pusher.close()
+        await self.slow_queries.close()
+        self.job_stats.flush()
+        sessions, self.sessions = self.sessions, {}
+        for session in sessions.values():
+            rval = session.close()
+            if inspect.isawaitable(rval):
+                await rval
+
+async def _update_user_reputation(resources, push_urls, signing_key, reviewee_id):
+    with resources.job_stats.timer('compute'):
+        async with resources.connection() as con:
+            score, count, avg, _ = await calculate_user_reputation(con, reviewee_id)
+
+    body = reputation_push_body(reviewee_id, score, count, avg)
+
+    address = resources.address(signing_key)
 
     futs = []
     for push_url in push_urls:
 
-        futs.append(do_push(push_url, body, address, signing_key, reviewee_id))
+        futs.append(push_with_retry(resources, push_url, body, address, signing_key, reviewee_id))
 
     await asyncio.gather(*futs)
 
-async def do_push(push_url, body, address, signing_key, reviewee_id):
-
-    path = '/' + push_url.split('/', 3)[-1]
-
-    method = 'POST'
-    backoff = 5
-    retries = 10
-
-    terminate = False
-    async with aiohttp.ClientSession() as session:
-        while not terminate:
-            timestamp = int(time.time())
-            signature = sign_request(signing_key, method, path, timestamp, body)
-
-            with aiohttp.Timeout(10):
-                async with session.post(push_url,
-                                        headers={
-                                            'content-type': 'application/json',
-                                            TOSHI_SIGNATURE_HEADER: signature,
-                                            TOSHI_ID_ADDRESS_HEADER: address,
-                                            TOSHI_TIMESTAMP_HEADER: str(timestamp)},
-                                        data=body) as response:
-                    if response.status == 204 or response.status == 200:
-                        terminate = True
-                    else:
-                        log.error("Error updating user details")
-                        log.error("URL: {}".format(push_url))
-                        log.error("User Address: {}".format(reviewee_id))
-                    retries -= 1
-                    if retries <= 0:
-                        terminate = True
-            await asyncio.sleep(backoff)
-            backoff = min(backoff + 5, 30)
+async def run_job(resources, job, fn, *args, **kwargs):
+    """runs the coroutine function for the job, recording how long the
+    job waited in the queue and how long it took in the job stats"""
 
-def update_user_reputation(push_url, signing_key, reviewee_id):
+    if job is not None and job.enqueued_at is not None:
+        # rq records the times as naive utc datetimes
+        resources.job_stats.observe('queue_wait', max(0, (datetime.utcnow() - job.enqueued_at).total_seconds()))
+    try:
+        with resources.job_stats.timer('job'):
+            return await fn(resources, *args, **kwargs)
+    except BaseException:
+        resources.job_stats.incr('jobs_failed')
+        raise
+
+def _run_rq_job(fn, *args, batch_pushes=False):
+    """runs the coroutine function for the current rq job, with resources
+    that are closed at the end of the job"""
     loop = asyncio.get_event_loop()
-    database_config = {'dsn': os.environ['DATABASE_URL']}
-    loop.run_until_complete(_update_user_reputation(database_config, push_url, signing_key, reviewee_id))
+    resources = TaskResources({'dsn': os.environ['DATABASE_URL']}, get_current_connection(),
+                              batch_pushes=batch_pushes)
+    try:
+        loop.run_until_complete(run_job(resources, get_current_job(), fn, *args))
+    finally:
+        loop.run_until_complete(resources.close())
+
+def update_user_reputation(push_url, signing_key, reviewee_id):
+    _run_rq_job(_update_user_reputation, push_url, signing_key, reviewee_id)
+
+async def _reprocess_user_reputations(resources, push_urls, signing_key, reviewee_ids, reprocess_id):
+    results = None
+    try:
+        results = await _reprocess_chunk(resources, push_urls, signing_key, reviewee_ids)
+    finally:
+        # failed chunks are counted as completed too, otherwise the
+        # reprocessing would never be reported as done
+        key = reprocess_key(reprocess_id)
+        pipe = resources.redis.pipeline()
+        pipe.hincrby(key, 'completed_chunks', 1)
+        pipe.hincrby(key, 'completed_reviewees', len(reviewee_ids))
+        if results is None:
+            pipe.hincrby(key, 'failed_chunks', 1)
+        else:
+            pushed = sum(1 for result in results if result)
+            pipe.hincrby(key, 'pushed', pushed)
+            pipe.hincrby(key, 'failed', len(results) - pushed)
+        await resources.run_redis(pipe.execute)
+
+async def _reprocess_chunk(resources, push_urls, signing_key, reviewee_ids):
+    """recomputes and pushes the reputations of the reviewees, returning
+    whether each push succeeded"""
+
+    with resources.job_stats.timer('compute'):
+        async with resources.connection() as con:
+            rows = await con.fetch(
+                "SELECT * FROM reviewee_reputation WHERE reviewee_id = ANY($1)",
+                reviewee_ids)
+
+        rows = {row['reviewee_id']: row for row in rows}
+        counts = []
+        for reviewee_id in reviewee_ids:
+            row = rows.get(reviewee_id)
+            if row is None:
+                counts.append((0, 0, 0, 0, 0))
+            else:
+                counts.append((row['stars_5'], row['stars_4'], row['stars_3'], row['stars_2'], row['stars_1']))
+        scores = starsort_batch(counts)
+
+    address = resources.address(signing_key)
+    semaphore = asyncio.Semaphore(PUSH_CONCURRENCY)
+
+    async def push(push_url, body, reviewee_id):
+        # in batch mode the pushes are only queued here, so limiting them
+        # would just stop the batches from filling up
+        if resources.batch_pusher is None:
+            await semaphore.acquire()
+        try:
+            return await push_with_retry(resources, push_url, body, address, signing_key, reviewee_id)
+        except Exception:
+            log.exception("Error pushing reputation for {}".format(reviewee_id))
+            return False
+        finally:
+            if resources.batch_pusher is None:
+                semaphore.release()
+
+    futs = []
+    for reviewee_id, score in zip(reviewee_ids, scores):
+        score, count, avg, _ = reputation_from_aggregate(rows.get(reviewee_id), score=score)
+        body = reputation_push_body(reviewee_id, score, count, avg)
+        for push_url in push_urls:
+            futs.append(push(push_url, body, reviewee_id))
+
+    return await asyncio.gather(*futs)
+
+def reprocess_key(reprocess_id):
+    return "toshirep:reprocess:{}".format(reprocess_id)
+
+def queue_user_reputation_updates(q, push_urls, signing_key, reviewee_ids):
+    """queues jobs recomputing the reputation of many reviewees in chunks
+    of `REPROCESS_CHUNK_SIZE`, returning the id their progress is
+    tracked under"""
+
+    reprocess_id = uuid.uuid4().hex
+    chunks = [reviewee_ids[i:i + REPROCESS_CHUNK_SIZE]
+              for i in range(0, len(reviewee_ids), REPROCESS_CHUNK_SIZE)]
+
+    key = reprocess_key(reprocess_id)
+    q.connection.hmset(key, {
+        'created': int(time.time()),
+        'reviewees': len(reviewee_ids),
+        'chunks': len(chunks),
+        'completed_chunks': 0,
+        'completed_reviewees': 0,
+        'failed_chunks': 0,
+        'pushed': 0,
+        'failed': 0
+    })
+    q.connection.expire(key, REPROCESS_STATUS_TTL)
+
+    for chunk in chunks:
+        q.enqueue(
+            reprocess_user_reputations,
+            push_urls,
+            signing_key,
+            chunk, reprocess_id,
+            timeout=3600)
+
+    return reprocess_id
+
+def reprocess_user_reputations(push_urls, signing_key, reviewee_ids, reprocess_id):
+    """recomputes and pushes the reputation of a chunk of reviewees,
+    recording the progress under the given reprocess id"""
+    _run_rq_job(_reprocess_user_reputations, push_urls, signing_key, reviewee_ids, reprocess_id,
+                batch_pushes=True)
+
+async def _push_user_reputation(resources, push_url, signing_key, reviewee_id, attempt):
+    with resources.job_stats.timer('compute'):
+        async with resources.connection() as con:
+            score, count, avg, _ = await calculate_user_reputation(con, reviewee_id)
+
+    body = reputation_push_body(reviewee_id, score, count, avg)
+    await push_with_retry(resources, push_url, body, resources.address(signing_key),
+                          signing_key, reviewee_id, attempt=attempt)
+
+def push_user_reputation(push_url, signing_key, reviewee_id, attempt=0):
+    """recomputes the reviewee's reputation and pushes it to a single url,
+    used for retrying failed pushes"""
+    _run_rq_job(_push_user_reputation, push_url, signing_key, reviewee_id, attempt)
+
+# maps the rq job functions to the coroutines implementing them, used by
+# `toshirep.aioworker` to run jobs on its own event loop
+ASYNC_TASKS = {
+    update_user_reputation: _update_user_reputation,
+    reprocess_user_reputations: _reprocess_user_reputations,
+    push_user_reputation: _push_user_reputation
+}
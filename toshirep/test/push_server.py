@@ -0,0 +1,75 @@
+"""Stub of the id service's reputation push endpoint.
+
+usage: python -m toshirep.test.push_server [--port PORT] [--no-batch] [--batch-max N]
+
+Verifies the signature of every push and logs the updates it receives.
+Unless started with `--no-batch` it advertises batch support, and accepts
+both single update objects and arrays of updates.
+"""
+import argparse
+import logging
+
+from collections import deque
+
+import tornado.ioloop
+import tornado.web
+
+from toshi.handlers import BaseHandler, RequestVerificationMixin
+from toshirep.push import PUSH_BATCH_HEADER
+
+log = logging.getLogger("push_server")
+
+class StubPushHandler(RequestVerificationMixin, BaseHandler):
+    """Records the pushed updates in `application.push_requests`, one
+    entry per request with the signer's address and the list of updates"""
+
+    def initialize(self, batch_max=0):
+        self.batch_max = batch_max
+
+    def options(self):
+        if self.batch_max:
+            self.set_header(PUSH_BATCH_HEADER, str(self.batch_max))
+        self.set_status(204)
+
+    def post(self):
+
+        address = self.verify_request()
+
+        updates = self.json
+        if isinstance(updates, list):
+            if not self.batch_max or len(updates) > self.batch_max:
+                self.set_status(400)
+                return
+        else:
+            updates = [updates]
+
+        self.application.push_requests.append((address, updates))
+        log.info("{} pushed {} updates".format(address, len(updates)))
+        self.set_status(204)
+
+def stub_push_urls(prefix, batch_max=100):
+    """urls serving a push endpoint with and without batch support under
+    `{prefix}/batch` and `{prefix}/single`"""
+    return [
+        ("^{}/batch/?$".format(prefix), StubPushHandler, {'batch_max': batch_max}),
+        ("^{}/single/?$".format(prefix), StubPushHandler, {'batch_max': 0})
+    ]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a stub reputation push server")
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--no-batch', action='store_true', help="don't advertise batch support")
+    parser.add_argument('--batch-max', type=int, default=100)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    app = tornado.web.Application([
+        ("^/v1/user/reputation/?$", StubPushHandler, {'batch_max': 0 if args.no_batch else args.batch_max})
+    ])
+    app.push_requests = deque(maxlen=1000)
+    app.listen(args.port)
+    log.info("Listening on http://localhost:{}/v1/user/reputation".format(args.port))
+    tornado.ioloop.IOLoop.current().start()
+
+if __name__ == '__main__':
+    main()
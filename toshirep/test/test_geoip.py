@@ -0,0 +1,126 @@
+import ipaddress
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from tornado.testing import gen_test
+from toshi.test.base import AsyncHandlerTest
+from toshi.test.database import requires_database
+
+from toshirep.app import urls
+from toshirep.geoimport import import_geolite2
+from toshirep.locations import get_location_from_geolite2
+from toshirep.geoip import (
+    GeoLite2Index, GeoIPDatabase, compile_database, IPV4_BLOCKS_CSV, IPV6_BLOCKS_CSV, LOCATIONS_CSV)
+
+LOCATIONS = """geoname_id,locale_code,continent_code,continent_name,country_iso_code,country_name
+2635167,en,EU,Europe,GB,"United Kingdom"
+3144096,en,EU,Europe,NO,Norway
+6255148,en,EU,Europe,,Europe
+"""
+
+IPV4_BLOCKS = """network,geoname_id,registered_country_geoname_id,represented_country_geoname_id,is_anonymous_proxy,is_satellite_provider
+1.0.0.0/24,2635167,2635167,,0,0
+1.0.2.0/23,3144096,3144096,,0,0
+2.0.0.0/8,6255148,6255148,,0,0
+3.0.0.0/8,,,,1,0
+"""
+
+IPV6_BLOCKS = """network,geoname_id,registered_country_geoname_id,represented_country_geoname_id,is_anonymous_proxy,is_satellite_provider
+2001:200::/32,3144096,3144096,,0,0
+2a00:1450::/32,2635167,2635167,,0,0
+"""
+
+def write_csv_files(path):
+    for filename, data in [(LOCATIONS_CSV, LOCATIONS), (IPV4_BLOCKS_CSV, IPV4_BLOCKS),
+                           (IPV6_BLOCKS_CSV, IPV6_BLOCKS)]:
+        with open(os.path.join(path, filename), 'w') as f:
+            f.write(data)
+
+class GeoLite2IndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        write_csv_files(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_lookup(self):
+
+        index = GeoLite2Index.from_csv_dir(self.path)
+        self.assertEqual(len(index), 5)
+
+        self.assertEqual(index.lookup("1.0.0.0"), "GB")
+        self.assertEqual(index.lookup("1.0.0.255"), "GB")
+        self.assertEqual(index.lookup("1.0.1.1"), None)
+        self.assertEqual(index.lookup("1.0.2.1"), "NO")
+        self.assertEqual(index.lookup("1.0.3.255"), "NO")
+        self.assertEqual(index.lookup("1.0.4.0"), None)
+        self.assertEqual(index.lookup("0.0.0.1"), None)
+        self.assertEqual(index.lookup("255.255.255.255"), None)
+        # geonames without a country and blocks without a geoname
+        self.assertEqual(index.lookup("2.1.1.1"), None)
+        self.assertEqual(index.lookup("3.1.1.1"), None)
+
+        self.assertEqual(index.ipv6_start_high.typecode, 'Q')
+        self.assertEqual(index.lookup("2001:200::1"), "NO")
+        self.assertEqual(index.lookup("2a00:1450:4001::1"), "GB")
+        self.assertEqual(index.lookup("2a00:1451::1"), None)
+        self.assertEqual(index.lookup("::ffff:1.0.0.1"), "GB")
+
+        self.assertEqual(index.lookup("not an ip"), None)
+
+    def test_compiled_database_matches_index(self):
+
+        index = GeoLite2Index.from_csv_dir(self.path)
+        output = os.path.join(self.path, "geoip.bin")
+        self.assertEqual(compile_database(self.path, output), 5)
+        database = GeoIPDatabase(output)
+        self.assertEqual(len(database), 5)
+
+        rng = random.Random(1234)
+        addresses = ["1.0.0.0", "1.0.0.255", "1.0.1.1", "1.0.3.255", "0.0.0.0", "255.255.255.255",
+                     "2001:200::", "2001:200:ffff:ffff:ffff:ffff:ffff:ffff", "2001:1ff:ffff:ffff:ffff:ffff:ffff:ffff",
+                     "2a00:1450:4001::1", "::", "::ffff:1.0.2.1", "not an ip"]
+        for _ in range(2000):
+            addresses.append(str(ipaddress.IPv4Address(rng.randint(0x01000000, 0x030fffff))))
+            addresses.append(str(ipaddress.IPv6Address(rng.choice([0x20010200, 0x2a001450, 0x2a001451]) << 96 |
+                                                       rng.getrandbits(96))))
+        for address in addresses:
+            self.assertEqual(database.lookup(address), index.lookup(address), address)
+
+class GeoImportTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    @gen_test(timeout=30)
+    @requires_database
+    async def test_import_and_swap(self):
+
+        path = tempfile.mkdtemp()
+        try:
+            write_csv_files(path)
+            async with self.pool.acquire() as con:
+                report = await import_geolite2(con, path, batch_size=2)
+                self.assertEqual(report['rows'], {'geolite2_ip_addresses': 6, 'geolite2_countries': 3,
+                                                 'geolite2_lookup': 5})
+                self.assertIn('swap', report['timings'])
+
+                self.assertEqual(await get_location_from_geolite2(self.pool, "1.0.2.1"), "NO")
+                self.assertEqual(await get_location_from_geolite2(self.pool, "1.0.3.255"), "NO")
+                self.assertEqual(await get_location_from_geolite2(self.pool, "1.0.1.1"), None)
+                self.assertEqual(await get_location_from_geolite2(self.pool, "3.1.1.1"), None)
+                self.assertEqual(await get_location_from_geolite2(self.pool, "2a00:1450:4001::1"), "GB")
+
+                # importing again replaces the tables instead of adding to them
+                await import_geolite2(con, path)
+                row = await con.fetchrow("SELECT COUNT(*) FROM geolite2_ip_addresses")
+                self.assertEqual(row['count'], 6)
+                row = await con.fetchrow("SELECT COUNT(*) FROM pg_class WHERE relname LIKE 'geolite2%_new'")
+                self.assertEqual(row['count'], 0)
+        finally:
+            shutil.rmtree(path)
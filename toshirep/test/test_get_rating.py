@@ -1,10 +1,15 @@
 import os
+import redis
 from tornado.escape import json_decode
 from tornado.testing import gen_test
 
 from toshirep.app import urls
 from toshirep.tasks import starsort
+from toshirep.cache import ReputationCache
+from toshirep.reputation import verify_reputations, rebuild_reputations
 from toshi.test.database import requires_database
+from toshi.test.redis import requires_redis
+from toshi.redis import build_redis_url
 from toshi.test.base import AsyncHandlerTest
 from toshi.ethereum.utils import data_decoder, data_encoder, private_key_to_address
 
@@ -66,3 +71,125 @@ class RatingsTest(AsyncHandlerTest):
         self.assertEqual(body['stars']["3"], 4)
         self.assertEqual(body['stars']["4"], 0)
         self.assertEqual(body['stars']["5"], 1)
+
+    @gen_test
+    @requires_database
+    async def test_reputation_aggregate_tracks_writes(self):
+
+        resp = await self.fetch_signed("/review/submit", signing_key=TEST_PRIVATE_KEY, method="POST",
+                                       body={"reviewee": TEST_ADDRESS_2, "rating": 4.5, "review": "bra"})
+        self.assertResponseCodeEqual(resp, 204)
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS_2), method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(body['review_count'], 1)
+        self.assertEqual(body['average_rating'], 4.5)
+        self.assertEqual(body['stars']["4"], 1)
+
+        resp = await self.fetch_signed("/review/submit", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body={"reviewee": TEST_ADDRESS_2, "rating": 1, "review": "ikke bra"})
+        self.assertResponseCodeEqual(resp, 204)
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS_2), method="GET")
+        body = json_decode(resp.body)
+        self.assertEqual(body['review_count'], 1)
+        self.assertEqual(body['average_rating'], 1.0)
+        self.assertEqual(body['stars']["4"], 0)
+        self.assertEqual(body['stars']["1"], 1)
+
+        async with self.pool.acquire() as con:
+            self.assertEqual(await verify_reputations(con), [])
+
+        resp = await self.fetch_signed("/review/delete", signing_key=TEST_PRIVATE_KEY, method="POST",
+                                       body={"reviewee": TEST_ADDRESS_2})
+        self.assertResponseCodeEqual(resp, 204)
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS_2), method="GET")
+        body = json_decode(resp.body)
+        self.assertEqual(body['review_count'], 0)
+        self.assertEqual(body['reputation_score'], 0)
+
+        # introduce drift and make sure rebuild detects and fixes it
+        async with self.pool.acquire() as con:
+            await con.execute("UPDATE reviewee_reputation SET review_count = 10 WHERE reviewee_id = $1", TEST_ADDRESS_2)
+            drift = await rebuild_reputations(con)
+            self.assertEqual(len(drift), 1)
+            self.assertEqual(drift[0]['reviewee_id'], TEST_ADDRESS_2)
+            self.assertEqual(await verify_reputations(con), [])
+
+    @gen_test
+    @requires_database
+    @requires_redis
+    async def test_get_user_rating_cached(self):
+
+        cache = self._app.reputation_cache = ReputationCache(
+            redis.from_url(build_redis_url(**self._app.config['redis'])))
+
+        async with self.pool.acquire() as con:
+            await con.execute(
+                "INSERT INTO reviews (reviewer_id, reviewee_id, rating, review) "
+                "VALUES ($1, $2, $3, $4)",
+                private_key_to_address(os.urandom(32)), TEST_ADDRESS_2, 2, "ok")
+
+        for _ in range(2):
+            resp = await self.fetch("/user/{}".format(TEST_ADDRESS_2), method="GET")
+            self.assertResponseCodeEqual(resp, 200)
+            body = json_decode(resp.body)
+            self.assertEqual(body['review_count'], 1)
+            self.assertEqual(body['average_rating'], 2.0)
+
+        stats = cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+
+        # writes through the api must invalidate the cached payload
+        resp = await self.fetch_signed("/review/submit", signing_key=TEST_PRIVATE_KEY, method="POST",
+                                       body={"reviewee": TEST_ADDRESS_2, "rating": 4, "review": "bra"})
+        self.assertResponseCodeEqual(resp, 204)
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS_2), method="GET")
+        body = json_decode(resp.body)
+        self.assertEqual(body['review_count'], 2)
+        self.assertEqual(body['average_rating'], 3.0)
+
+        stats = cache.stats()
+        self.assertEqual(stats['invalidations'], 1)
+        self.assertEqual(stats['misses'], 2)
+
+    @gen_test
+    @requires_database
+    async def test_get_users_ratings(self):
+
+        other = private_key_to_address(os.urandom(32))
+        async with self.pool.acquire() as con:
+            for reviewee, rating in [(TEST_ADDRESS_2, 5), (TEST_ADDRESS_2, 3), (other, 1)]:
+                await con.execute(
+                    "INSERT INTO reviews (reviewer_id, reviewee_id, rating, review) "
+                    "VALUES ($1, $2, $3, $4)",
+                    private_key_to_address(os.urandom(32)), reviewee, rating, "ok")
+
+        addresses = [TEST_ADDRESS_2, other, TEST_ADDRESS]
+
+        resp = await self.fetch("/users/ratings", method="POST", body={"reviewees": addresses})
+        self.assertResponseCodeEqual(resp, 200)
+        batch = json_decode(resp.body)['ratings']
+
+        resp = await self.fetch("/users/ratings?{}".format("&".join("reviewee={}".format(a) for a in addresses)),
+                                method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['ratings'], batch)
+
+        self.assertEqual(len(batch), 3)
+        for address in addresses:
+            resp = await self.fetch("/user/{}".format(address), method="GET")
+            self.assertEqual(batch[address], json_decode(resp.body))
+        self.assertEqual(batch[TEST_ADDRESS]['review_count'], 0)
+        self.assertEqual(batch[TEST_ADDRESS_2]['average_rating'], 4.0)
+
+        resp = await self.fetch("/users/ratings", method="POST", body={"reviewees": ["0x1234"]})
+        self.assertResponseCodeEqual(resp, 400)
+        resp = await self.fetch("/users/ratings", method="POST", body={"reviewees": [TEST_ADDRESS] * 501})
+        self.assertResponseCodeEqual(resp, 400)
+        resp = await self.fetch("/users/ratings", method="POST", body={"reviewees": []})
+        self.assertResponseCodeEqual(resp, 400)
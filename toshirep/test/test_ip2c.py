@@ -0,0 +1,134 @@
+import asyncio
+from tornado.testing import gen_test
+from tornado.web import RequestHandler
+
+from toshi.test.base import AsyncHandlerTest
+
+from toshirep.locations import Ip2cClient, LocationCache, LocationUnavailable
+
+class FakeIp2cHandler(RequestHandler):
+    """Responds like ip2c.org, failing with a 500 while the application's
+    `ip2c_failing` is set"""
+
+    async def get(self, ip_addr):
+        app = self.application
+        app.ip2c_requests += 1
+        app.ip2c_active += 1
+        app.ip2c_max_active = max(app.ip2c_max_active, app.ip2c_active)
+        try:
+            await asyncio.sleep(app.ip2c_delay)
+        finally:
+            app.ip2c_active -= 1
+
+        if app.ip2c_failing:
+            self.set_status(500)
+            return
+        if ip_addr.startswith("10."):
+            self.write("2;ZZ;ZZZ;Reserved")
+        else:
+            self.write("1;NO;NOR;Norway")
+
+class Ip2cClientTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return [("^/ip2c/(?P<ip_addr>[^/]+)$", FakeIp2cHandler)]
+
+    def setUp(self):
+        super().setUp()
+        self._app.ip2c_requests = 0
+        self._app.ip2c_active = 0
+        self._app.ip2c_max_active = 0
+        self._app.ip2c_delay = 0
+        self._app.ip2c_failing = False
+
+    def client(self, **kwargs):
+        return Ip2cClient(url=self.get_url("/ip2c/") + "{}", **kwargs)
+
+    @gen_test(timeout=30)
+    async def test_lookup(self):
+
+        client = self.client()
+        self.assertEqual(await client.get_location(None, "44.134.7.184"), "NO")
+        self.assertEqual(await client.get_location(None, "10.0.0.1"), "ZZ")
+        self.assertEqual(await client.get_location(None, "not an ip"), None)
+        stats = client.stats()
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['errors'], 0)
+        self.assertIsNotNone(stats['p50_ms'])
+        await client.close()
+
+    @gen_test(timeout=30)
+    async def test_max_in_flight_and_coalescing(self):
+
+        self._app.ip2c_delay = 0.2
+        client = self.client(max_in_flight=2, max_queued=5)
+
+        ips = ["44.134.7.{}".format(i) for i in range(8)]
+        # the duplicate lookups share the first request
+        results = await asyncio.gather(*[client.get_location(None, ip) for ip in ips + ips[:2]],
+                                       return_exceptions=True)
+
+        self.assertEqual(self._app.ip2c_max_active, 2)
+        stats = client.stats()
+        self.assertEqual(stats['coalesced'], 2)
+        # 2 in flight and 5 queued, the last lookup is shed
+        self.assertEqual(stats['shed'], 1)
+        self.assertEqual(self._app.ip2c_requests, 7)
+        self.assertEqual(results.count("NO"), 9)
+        self.assertEqual(sum(1 for result in results if isinstance(result, LocationUnavailable)), 1)
+        await client.close()
+
+    @gen_test(timeout=30)
+    async def test_circuit_breaker(self):
+
+        self._app.ip2c_failing = True
+        client = self.client(failure_threshold=3, reset_timeout=0.5)
+
+        for i in range(3):
+            with self.assertRaises(LocationUnavailable):
+                await client.get_location(None, "44.134.7.{}".format(i))
+        self.assertEqual(client.state, 'open')
+
+        # lookups are skipped while the breaker is open
+        with self.assertRaises(LocationUnavailable):
+            await client.get_location(None, "44.134.7.184")
+        self.assertEqual(self._app.ip2c_requests, 3)
+        self.assertEqual(client.stats()['short_circuited'], 1)
+
+        # a failing probe opens it again
+        await asyncio.sleep(0.5)
+        self.assertEqual(client.state, 'half_open')
+        with self.assertRaises(LocationUnavailable):
+            await client.get_location(None, "44.134.7.184")
+        self.assertEqual(self._app.ip2c_requests, 4)
+        self.assertEqual(client.state, 'open')
+
+        # and a successful probe closes it
+        self._app.ip2c_failing = False
+        await asyncio.sleep(0.5)
+        self.assertEqual(await client.get_location(None, "44.134.7.184"), "NO")
+        self.assertEqual(client.state, 'closed')
+        await client.close()
+
+    @gen_test(timeout=30)
+    async def test_outage_is_not_cached(self):
+
+        self._app.ip2c_failing = True
+        client = self.client(failure_threshold=1, reset_timeout=0.5)
+        cache = LocationCache(client.get_location, ttl=60, negative_ttl=300)
+
+        with self.assertRaises(LocationUnavailable):
+            await cache.get_location(None, "44.134.7.184")
+        self.assertEqual(client.state, 'open')
+        with self.assertRaises(LocationUnavailable):
+            await cache.get_location(None, "44.134.7.184")
+        self.assertEqual(client.stats()['short_circuited'], 1)
+
+        # the location is looked up as soon as ip2c recovers
+        self._app.ip2c_failing = False
+        await asyncio.sleep(0.5)
+        self.assertEqual(await cache.get_location(None, "44.134.7.184"), "NO")
+        self.assertEqual(client.state, 'closed')
+        self.assertEqual(await cache.get_location(None, "44.134.7.184"), "NO")
+        self.assertEqual(self._app.ip2c_requests, 2)
+        await client.close()
@@ -0,0 +1,62 @@
+import asyncio
+import unittest
+
+from toshirep.locations import LocationCache
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+class LocationCacheTest(unittest.TestCase):
+
+    def test_cache_and_coalesce_lookups(self):
+        run(self.cache_and_coalesce_lookups())
+
+    async def cache_and_coalesce_lookups(self):
+
+        lookups = []
+        release = asyncio.Event()
+
+        async def get_location(pool, ip_addr):
+            lookups.append(ip_addr)
+            await release.wait()
+            return {"1.1.1.1": "AU"}.get(ip_addr)
+
+        cache = LocationCache(get_location, maxsize=10, ttl=60, negative_ttl=60)
+
+        # concurrent lookups for the same ip share a single backend call
+        futs = [asyncio.ensure_future(cache.get_location(None, ip))
+                for ip in ["1.1.1.1", "1.1.1.1", "1.1.1.1", "10.0.0.1", "10.0.0.1"]]
+        await asyncio.sleep(0.01)
+        self.assertEqual(sorted(lookups), ["1.1.1.1", "10.0.0.1"])
+        self.assertEqual(cache.stats()['inflight'], 2)
+        release.set()
+        self.assertEqual(await asyncio.gather(*futs), ["AU", "AU", "AU", None, None])
+
+        stats = cache.stats()
+        self.assertEqual(stats['coalesced'], 3)
+        self.assertEqual(stats['inflight'], 0)
+
+        # found and unknown locations are both cached
+        self.assertEqual(await cache.get_location(None, "1.1.1.1"), "AU")
+        self.assertEqual(await cache.get_location(None, "10.0.0.1"), None)
+        self.assertEqual(len(lookups), 2)
+        self.assertEqual(cache.stats()['hits'], 2)
+
+    def test_errors_are_not_cached(self):
+        run(self.errors_are_not_cached())
+
+    async def errors_are_not_cached(self):
+
+        calls = []
+
+        async def get_location(pool, ip_addr):
+            calls.append(ip_addr)
+            if len(calls) == 1:
+                raise Exception("backend unavailable")
+            return "NO"
+
+        cache = LocationCache(get_location)
+        with self.assertRaises(Exception):
+            await cache.get_location(None, "1.1.1.1")
+        self.assertEqual(await cache.get_location(None, "1.1.1.1"), "NO")
+        self.assertEqual(len(calls), 2)
@@ -0,0 +1,88 @@
+import redis
+import unittest
+from rq import Queue
+from tornado.testing import gen_test
+
+from toshirep import metrics
+from toshirep.app import urls
+from toshi.redis import build_redis_url
+from toshi.test.database import requires_database
+from toshi.test.redis import requires_redis
+from toshi.test.base import AsyncHandlerTest
+
+class MetricsTest(unittest.TestCase):
+
+    def test_render(self):
+
+        registry = metrics.Registry()
+        counter = metrics.Counter('test_total', "A counter", ['code'], registry=registry)
+        histogram = metrics.Histogram('test_seconds', "A histogram", buckets=(0.1, 1), registry=registry)
+        counter.labels(200).inc()
+        counter.labels(200).inc(2)
+        counter.labels('say "hi"').inc()
+        for value in [0.05, 0.1, 0.5, 5]:
+            histogram.observe(value)
+
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE test_total counter', lines)
+        self.assertIn('test_total{code="200"} 3', lines)
+        self.assertIn('test_total{code="say \\"hi\\""} 1', lines)
+        self.assertIn('test_seconds_bucket{le="0.1"} 2', lines)
+        self.assertIn('test_seconds_bucket{le="1"} 3', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_sum 5.65', lines)
+        self.assertIn('test_seconds_count 4', lines)
+
+    def test_query_name(self):
+
+        self.assertEqual(metrics.query_name("SELECT * FROM reviewee_reputation WHERE reviewee_id = $1"),
+                         "select_reviewee_reputation")
+        self.assertEqual(metrics.query_name("INSERT INTO reviews (reviewer_id) SELECT * FROM unnest($1)"),
+                         "insert_reviews")
+        self.assertEqual(metrics.query_name("UPDATE reviews SET rating = $1"), "update_reviews")
+        self.assertEqual(metrics.query_name("SELECT 1"), "select")
+
+class MetricsHandlerTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    @gen_test
+    @requires_database
+    @requires_redis
+    async def test_metrics(self):
+
+        # wire the test app up the way `toshirep.app` does: the pool is
+        # instrumented, finished requests are observed and the queue
+        # lengths are read from redis
+        self._app.connection_pool = metrics.InstrumentedPool(self._app.connection_pool)
+        log_request = self._app.log_request
+
+        def observed_log_request(handler):
+            log_request(handler)
+            metrics.observe_request(handler)
+        self._app.log_request = observed_log_request
+        self._app.q = Queue(connection=redis.from_url(build_redis_url(**self._app.config['redis'])))
+
+        resp = await self.fetch("/v1/user/0x056db290f8ba3250ca64a45d16284d04bc6f5fbf")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(metrics.DB_POOL_IN_USE.children[()].value, 0)
+
+        resp = await self.fetch("/metrics")
+        self.assertResponseCodeEqual(resp, 200)
+        body = resp.body.decode('utf-8')
+        self.assertIn('toshirep_http_request_duration_seconds_count{handler="GetUserRatingHandler",method="GET"}', body)
+        self.assertIn('toshirep_db_query_duration_seconds_count{query="select_reviewee_reputation"}', body)
+        self.assertIn('# TYPE toshirep_db_pool_wait_seconds histogram', body)
+        for name in ['high', 'default', 'low']:
+            self.assertIn('toshirep_rq_queue_length{{queue="{}"}} 0'.format(name), body)
+
+        self._app.config['metrics'] = {'token': 'secret'}
+
+        resp = await self.fetch("/metrics")
+        self.assertResponseCodeEqual(resp, 404)
+        resp = await self.fetch("/metrics", headers={'Authorization': 'Bearer wrong'})
+        self.assertResponseCodeEqual(resp, 404)
+        resp = await self.fetch("/metrics", headers={'Authorization': 'Bearer secret'})
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertIn('toshirep_rq_queue_length{queue="high"}', resp.body.decode('utf-8'))
@@ -0,0 +1,154 @@
+import json
+import os
+from datetime import datetime
+from tornado.escape import json_decode
+from tornado.testing import gen_test
+
+from toshirep.app import urls
+from toshirep.reviews import parse_import_record, ReviewValidationError, build_export_query, export_reviews
+from toshi.test.database import requires_database
+from toshi.test.base import AsyncHandlerTest
+from toshi.ethereum.utils import data_decoder
+
+TEST_PRIVATE_KEY = data_decoder("0xe8f32e723decf4051aefac8e2c93c9c5b214313817cdb01a1494b917c8436b35")
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+
+TEST_ADDRESS_2 = "0x056db290f8ba3250ca64a45d16284d04bc000000"
+TEST_ADDRESS_3 = "0x056db290f8ba3250ca64a45d16284d04bc000001"
+
+def ndjson(*records):
+    return "\n".join(r if isinstance(r, str) else json.dumps(r) for r in records)
+
+class ImportReviewsTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    def get_url(self, path):
+        path = "/v1{}".format(path)
+        return super().get_url(path)
+
+    def test_parse_import_record(self):
+
+        now = datetime(2017, 1, 1)
+        record = parse_import_record(json.dumps({
+            "reviewer": TEST_ADDRESS.upper().replace('0X', '0x'), "reviewee": TEST_ADDRESS_2,
+            "rating": "4.5", "updated": "2017-06-01T12:00:00+02:00"}), now=now)
+        self.assertEqual(record[0], TEST_ADDRESS)
+        self.assertEqual(float(record[2]), 4.5)
+        self.assertEqual(record[4], now)
+        self.assertEqual(record[5], datetime(2017, 6, 1, 10, 0))
+
+        for line, error in [("{", 'invalid_json'),
+                            ('{"reviewer": "0x1"}', 'bad_arguments'),
+                            (json.dumps({"reviewer": TEST_ADDRESS, "reviewee": TEST_ADDRESS, "rating": 1}),
+                             'invalid_reviewee'),
+                            (json.dumps({"reviewer": TEST_ADDRESS, "reviewee": TEST_ADDRESS_2, "rating": 6}),
+                             'invalid_rating'),
+                            (json.dumps({"reviewer": TEST_ADDRESS, "reviewee": TEST_ADDRESS_2, "rating": 1,
+                                         "updated": "yesterday"}), 'invalid_date')]:
+            with self.assertRaises(ReviewValidationError) as cm:
+                parse_import_record(line)
+            self.assertEqual(cm.exception.id, error)
+
+    @gen_test(timeout=30)
+    @requires_database
+    async def test_import_reviews(self):
+
+        os.environ['ADMIN_ADDRESS'] = TEST_ADDRESS
+
+        async with self.pool.acquire() as con:
+            await con.execute(
+                "INSERT INTO reviews (reviewer_id, reviewee_id, rating, review, created, updated) "
+                "VALUES ($1, $2, $3, $4, $5, $5), ($1, $6, $3, $4, $5, $5)",
+                TEST_ADDRESS, TEST_ADDRESS_2, 2, "old", datetime(2017, 1, 1), TEST_ADDRESS_3)
+
+        body = ndjson(
+            # replaces the existing review
+            {"reviewer": TEST_ADDRESS, "reviewee": TEST_ADDRESS_2, "rating": 4, "review": "new",
+             "updated": "2017-02-01T00:00:00Z"},
+            # older than the existing review
+            {"reviewer": TEST_ADDRESS, "reviewee": TEST_ADDRESS_3, "rating": 5, "review": "older",
+             "updated": "2016-01-01T00:00:00Z"},
+            # the latest of duplicate reviews wins
+            {"reviewer": TEST_ADDRESS_2, "reviewee": TEST_ADDRESS_3, "rating": 1,
+             "updated": "2017-01-01T00:00:00Z"},
+            {"reviewer": TEST_ADDRESS_2, "reviewee": TEST_ADDRESS_3, "rating": 3,
+             "updated": "2017-03-01T00:00:00Z"},
+            "",
+            "not json",
+            {"reviewer": TEST_ADDRESS_2, "reviewee": TEST_ADDRESS_3, "rating": 10})
+
+        resp = await self.fetch_signed("/admin/reviews/import", signing_key=TEST_PRIVATE_KEY,
+                                       method="POST", body=body)
+        self.assertResponseCodeEqual(resp, 200)
+        report = json_decode(resp.body)
+        self.assertEqual(report['lines'], 7)
+        self.assertEqual(report['imported'], 4)
+        self.assertEqual(report['merged'], 2)
+        self.assertEqual(report['invalid'], 2)
+        self.assertEqual([(e['line'], e['id']) for e in report['errors']],
+                         [(6, 'invalid_json'), (7, 'invalid_rating')])
+        self.assertEqual(report['reviewees'], 2)
+
+        async with self.pool.acquire() as con:
+            rows = await con.fetch("SELECT * FROM reviews ORDER BY reviewer_id, reviewee_id")
+        reviews = {(row['reviewer_id'], row['reviewee_id']): row for row in rows}
+        self.assertEqual(len(reviews), 3)
+        self.assertEqual(reviews[(TEST_ADDRESS, TEST_ADDRESS_2)]['review'], "new")
+        self.assertEqual(reviews[(TEST_ADDRESS, TEST_ADDRESS_2)]['created'], datetime(2017, 1, 1))
+        self.assertEqual(reviews[(TEST_ADDRESS, TEST_ADDRESS_3)]['review'], "old")
+        self.assertEqual(reviews[(TEST_ADDRESS_2, TEST_ADDRESS_3)]['rating'], 3)
+
+    @gen_test(timeout=30)
+    @requires_database
+    async def test_export_reviews(self):
+
+        os.environ['ADMIN_ADDRESS'] = TEST_ADDRESS
+
+        reviewers = ["0x056db290f8ba3250ca64a45d16284d04bc00010{}".format(i) for i in range(5)]
+        async with self.pool.acquire() as con:
+            for i, reviewer in enumerate(reviewers):
+                await con.execute(
+                    "INSERT INTO reviews (reviewer_id, reviewee_id, rating, review, created, updated) "
+                    "VALUES ($1, $2, $3, $4, $5, $5)",
+                    reviewer, TEST_ADDRESS_2 if i % 2 == 0 else TEST_ADDRESS_3, i, "review {}".format(i),
+                    datetime(2017, 1, 1 + i))
+
+        resp = await self.fetch_signed("/admin/reviews/export", signing_key=TEST_PRIVATE_KEY, method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        reviews = [json.loads(line) for line in resp.body.decode('utf-8').splitlines()]
+        self.assertEqual([r['reviewer'] for r in reviews], reviewers)
+        self.assertEqual(reviews[0]['date'], datetime(2017, 1, 1).isoformat())
+
+        # filtered and resumed from the date of the last exported review
+        resp = await self.fetch_signed("/admin/reviews/export?reviewee={}&oldest={}".format(
+            TEST_ADDRESS_2, reviews[1]['date']), signing_key=TEST_PRIVATE_KEY, method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        reviews = [json.loads(line) for line in resp.body.decode('utf-8').splitlines()]
+        self.assertEqual([r['reviewer'] for r in reviews], [reviewers[2], reviewers[4]])
+
+        resp = await self.fetch_signed("/admin/reviews/export?reviewer=0x1234", signing_key=TEST_PRIVATE_KEY,
+                                       method="GET")
+        self.assertResponseCodeEqual(resp, 400)
+
+        # the cursor is read in chunks
+        chunks = []
+
+        async def write(data):
+            chunks.append(data)
+
+        sql, sql_args = build_export_query()
+        async with self.pool.acquire() as con:
+            count = await export_reviews(con, write, sql, sql_args, chunk_size=2)
+        self.assertEqual(count, 5)
+        self.assertEqual([len(chunk.splitlines()) for chunk in chunks], [2, 2, 1])
+
+    @gen_test
+    @requires_database
+    async def test_import_reviews_requires_admin(self):
+
+        os.environ['ADMIN_ADDRESS'] = TEST_ADDRESS_2
+        resp = await self.fetch_signed("/admin/reviews/import", signing_key=TEST_PRIVATE_KEY, method="POST",
+                                       body=ndjson({"reviewer": TEST_ADDRESS, "reviewee": TEST_ADDRESS_2, "rating": 1}))
+        self.assertResponseCodeEqual(resp, 404)
@@ -129,3 +129,93 @@ class RatingsTest(AsyncHandlerTest):
         # check that no reviewer or reviewee
         resp = await self.fetch_signed("/search/review", signing_key=TEST_PRIVATE_KEY, method="GET")
         self.assertResponseCodeEqual(resp, 400)
+
+    @gen_test
+    @requires_database
+    async def test_cursor_pagination(self):
+
+        message = "et fantastisk menneske"
+        same_time = datetime.utcnow() - timedelta(minutes=90)
+        reviews = [
+            (private_key_to_address(os.urandom(32)), TEST_ADDRESS_2,
+             random.random() * 5, message,
+             datetime.utcnow() - timedelta(minutes=60 - i),
+             datetime.utcnow() - timedelta(minutes=60 - i)) for i in range(1, 26)
+        ]
+        # reviews with identical timestamps must not be skipped or repeated
+        reviews.extend([
+            (private_key_to_address(os.urandom(32)), TEST_ADDRESS_2,
+             random.random() * 5, message, same_time, same_time) for i in range(5)
+        ])
+
+        async with self.pool.acquire() as con:
+            for rev in reviews:
+                await con.execute(
+                    "INSERT INTO reviews (reviewer_id, reviewee_id, rating, review, created, updated) "
+                    "VALUES ($1, $2, $3, $4, $5, $6)",
+                    *rev)
+
+        resp = await self.fetch("/search/review?reviewee={}&limit={}".format(TEST_ADDRESS_2, len(reviews)), method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        expected = [r['reviewer'] for r in json_decode(resp.body)['reviews']]
+        self.assertEqual(len(expected), len(reviews))
+
+        seen = []
+        cursor = None
+        while True:
+            url = "/search/review?reviewee={}&limit=7".format(TEST_ADDRESS_2)
+            if cursor:
+                url += "&cursor={}".format(cursor)
+            resp = await self.fetch(url, method="GET")
+            self.assertResponseCodeEqual(resp, 200)
+            results = json_decode(resp.body)
+            self.assertEqual(results['total'], len(reviews))
+            seen.extend(r['reviewer'] for r in results['reviews'])
+            cursor = results['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(seen, expected)
+
+        resp = await self.fetch("/search/review?reviewee={}&cursor=notacursor".format(TEST_ADDRESS_2), method="GET")
+        self.assertResponseCodeEqual(resp, 400)
+
+    @gen_test
+    @requires_database
+    async def test_include_total(self):
+
+        message = "et fantastisk menneske"
+        reviews = [
+            (private_key_to_address(os.urandom(32)), TEST_ADDRESS_2,
+             random.random() * 5, message) for i in range(15)
+        ]
+
+        async with self.pool.acquire() as con:
+            for rev in reviews:
+                await con.execute(
+                    "INSERT INTO reviews (reviewer_id, reviewee_id, rating, review) "
+                    "VALUES ($1, $2, $3, $4)",
+                    *rev)
+
+        resp = await self.fetch("/search/review?reviewee={}&include_total=exact".format(TEST_ADDRESS_2), method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['total'], len(reviews))
+
+        resp = await self.fetch("/search/review?reviewee={}&include_total=none".format(TEST_ADDRESS_2), method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        results = json_decode(resp.body)
+        self.assertIsNone(results['total'])
+        self.assertEqual(len(results['reviews']), 10)
+
+        # a reviewee only query is estimated from the reputation aggregate
+        resp = await self.fetch("/search/review?reviewee={}&include_total=estimated".format(TEST_ADDRESS_2), method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['total'], len(reviews))
+
+        # other queries fall back to the planner's estimate
+        resp = await self.fetch("/search/review?reviewer={}&include_total=estimated".format(reviews[0][0]), method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertIsInstance(json_decode(resp.body)['total'], int)
+
+        resp = await self.fetch("/search/review?reviewee={}&include_total=maybe".format(TEST_ADDRESS_2), method="GET")
+        self.assertResponseCodeEqual(resp, 400)
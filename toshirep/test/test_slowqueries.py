@@ -0,0 +1,74 @@
+import os
+from tornado.escape import json_decode
+from tornado.testing import gen_test
+
+from toshirep import metrics
+from toshirep.app import urls
+from toshirep.slowqueries import SlowQueryLog, normalize_sql, _is_read
+from toshi.test.database import requires_database
+from toshi.test.base import AsyncHandlerTest
+from toshi.ethereum.utils import data_decoder
+
+TEST_PRIVATE_KEY = data_decoder("0xe8f32e723decf4051aefac8e2c93c9c5b214313817cdb01a1494b917c8436b35")
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+
+class SlowQueriesTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    def get_url(self, path):
+        path = "/v1{}".format(path)
+        return super().get_url(path)
+
+    def test_normalize_sql(self):
+
+        self.assertEqual(
+            normalize_sql("SELECT *\n  FROM reviews WHERE review = 'it''s ok' AND rating > 4.5\n  LIMIT $1"),
+            "SELECT * FROM reviews WHERE review = ? AND rating > ? LIMIT $1")
+        self.assertEqual(normalize_sql("SELECT stars_1 FROM geolite2_lookup"), "SELECT stars_1 FROM geolite2_lookup")
+
+    def test_only_plain_selects_are_analyzed(self):
+
+        self.assertTrue(_is_read("SELECT * FROM reviews WHERE updated >= $1"))
+        self.assertTrue(_is_read("SELECT * FROM reviews WHERE review = 'delete me'"))
+        self.assertFalse(_is_read("WITH moved AS (DELETE FROM reviews RETURNING *) SELECT COUNT(*) FROM moved"))
+        self.assertFalse(_is_read("WITH r AS (SELECT * FROM reviews) SELECT * FROM r"))
+        self.assertFalse(_is_read("SELECT * FROM reviews FOR UPDATE"))
+        self.assertFalse(_is_read("SELECT nextval('review_locations_review_location_id_seq')"))
+        self.assertFalse(_is_read("UPDATE reviews SET rating = 1"))
+
+    @gen_test(timeout=30)
+    @requires_database
+    async def test_slow_queries(self):
+
+        os.environ['ADMIN_ADDRESS'] = TEST_ADDRESS
+
+        slow_queries = SlowQueryLog(threshold=0.1, sample_rate=1, maxlen=2,
+                                    explain_connection=self._app.connection_pool.acquire)
+        self._app.slow_queries = slow_queries
+        pool = metrics.InstrumentedPool(self._app.connection_pool, slow_queries=slow_queries)
+
+        async with pool.acquire() as con:
+            # fast queries aren't recorded
+            await con.fetchrow("SELECT COUNT(*) FROM reviews WHERE reviewee_id = $1", TEST_ADDRESS)
+            self.assertEqual(slow_queries.stats()['slow'], 0)
+
+            await con.fetchrow("SELECT pg_sleep(0.2), COUNT(*) FROM reviews WHERE reviewee_id = $1", TEST_ADDRESS)
+            await con.execute("UPDATE reviews SET rating = 1 WHERE reviewee_id = $1 AND pg_sleep(0.2) IS NOT NULL",
+                              TEST_ADDRESS)
+        await slow_queries.close()
+
+        stats = slow_queries.stats()
+        self.assertEqual(stats['slow'], 2)
+        self.assertEqual(stats['explained'], 2)
+
+        resp = await self.fetch_signed("/admin/slow_queries", signing_key=TEST_PRIVATE_KEY, method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        entries = json_decode(resp.body)['web']
+        self.assertEqual([entry['name'] for entry in entries], ['update_reviews', 'select_reviews'])
+        self.assertEqual(entries[0]['arg_types'], ['str'])
+        # writes are explained without running them
+        self.assertFalse(entries[0]['analyzed'])
+        self.assertTrue(entries[1]['analyzed'])
+        self.assertIn('Actual Total Time', entries[1]['plan'][0]['Plan'])
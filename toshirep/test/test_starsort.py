@@ -0,0 +1,25 @@
+import random
+import unittest
+
+from toshirep.tasks import starsort, starsort_batch
+
+class StarsortTest(unittest.TestCase):
+
+    def test_batch_matches_scalar_on_random_histograms(self):
+
+        rng = random.Random(1234)
+        histograms = [(0, 0, 0, 0, 0), (1, 0, 0, 0, 0), (0, 0, 0, 0, 1), (1, 0, 4, 3, 3)]
+        for _ in range(5000):
+            # mix of small and very large review counts
+            scale = rng.choice([1, 10, 1000, 1000000])
+            histograms.append(tuple(rng.randint(0, scale) for _ in range(5)))
+
+        scores = starsort_batch(histograms)
+
+        self.assertEqual(len(scores), len(histograms))
+        for ns, score in zip(histograms, scores):
+            expected = round(starsort(ns) * 10) / 10
+            self.assertEqual(float(score), expected, "mismatch for {}".format(ns))
+
+    def test_batch_empty(self):
+        self.assertEqual(len(starsort_batch([])), 0)
@@ -427,3 +427,43 @@ class RatingsTest(AsyncHandlerTest):
 
         self.assertEqual(len(rows), 1)
         self.assertEqual(rows[0]['location'], location)
+
+    @gen_test(timeout=30)
+    @requires_database
+    async def test_buffered_review_locations(self):
+
+        async def get_location(pool, ip_addr):
+            return 'NO'
+
+        writer = locations.ReviewLocationWriter(self._app.connection_pool, batch_size=3,
+                                                flush_interval=60, max_pending=5)
+        self._app.store_location = partial(
+            locations.store_review_location,
+            get_location, self._app.connection_pool, writer=writer)
+
+        for i in range(3):
+            resp = await self.fetch_signed("/review/submit", signing_key=TEST_PRIVATE_KEY, method="POST",
+                                           headers={'X-Forwarded-For': "44.134.7.18{}".format(i)},
+                                           body={"reviewee": TEST_ADDRESS_2, "rating": 3, "review": "ok"})
+            self.assertResponseCodeEqual(resp, 204)
+
+        # the full batch is written without waiting for the flush interval
+        await asyncio.sleep(1)
+        async with self.pool.acquire() as con:
+            rows = await con.fetch("SELECT * FROM review_locations WHERE reviewer_id = $1", TEST_ADDRESS)
+        self.assertEqual(len(rows), 3)
+        self.assertTrue(all(row['location'] == 'NO' for row in rows))
+
+        # rows past max_pending are dropped, the rest are written on close
+        for i in range(7):
+            await writer.add(TEST_ADDRESS_2, 'SE')
+        self.assertEqual(writer.stats()['pending'], 5)
+        await writer.close()
+
+        async with self.pool.acquire() as con:
+            rows = await con.fetch("SELECT * FROM review_locations WHERE reviewer_id = $1", TEST_ADDRESS_2)
+        self.assertEqual(len(rows), 5)
+        stats = writer.stats()
+        self.assertEqual(stats['written'], 8)
+        self.assertEqual(stats['dropped'], 2)
+        self.assertEqual(stats['pending'], 0)
@@ -3,16 +3,30 @@ import os
 import sys
 from toshi.handlers import BaseHandler
 from tornado.testing import gen_test
-from rq import Queue
+from rq import Queue, get_failed_queue
+from rq.job import JobStatus
+from rq.registry import StartedJobRegistry
 import redis
 import subprocess
+import time
+from tornado.escape import json_decode
 
 from toshirep.app import urls
+from toshirep.scheduler import ReputationScheduler
+from toshirep.aioworker import AsyncWorker
+from toshirep.tasks import (
+    push_user_reputation, reputation_push_body, TaskResources, run_job, _push_user_reputation,
+    _reprocess_user_reputations, queue_user_reputation_updates)
+from toshirep.jobstats import read_job_stats, summarize
+from toshirep.push import (
+    BatchPusher, schedule_push_retry, push_retry_delay, MAX_PUSH_ATTEMPTS,
+    PUSH_RETRY_BASE_DELAY, PUSH_RETRY_MAX_DELAY, PUSH_DEAD_LETTER_KEY)
 from toshi.test.database import requires_database
 from toshi.test.redis import requires_redis
 from toshi.test.base import AsyncHandlerTest
 from toshi.handlers import RequestVerificationMixin
 from toshi.redis import build_redis_url
+from toshirep.test.push_server import stub_push_urls
 
 TEST_PRIVATE_KEY = "0xe8f32e723decf4051aefac8e2c93c9c5b214313817cdb01a1494b917c8436b35"
 TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
@@ -55,7 +69,7 @@ class TestPushHandler(RequestVerificationMixin, BaseHandler):
 class RatingsTest(AsyncHandlerTest):
 
     def get_urls(self):
-        return urls + [("^/v1/__push/?$", TestPushHandler)]
+        return urls + [("^/v1/__push/?$", TestPushHandler)] + stub_push_urls("/v1/__stub", batch_max=4)
 
     def get_url(self, path):
         path = "/v1{}".format(path)
@@ -65,6 +79,15 @@ class RatingsTest(AsyncHandlerTest):
     @requires_database
     @requires_redis
     async def test_process_user_review(self):
+        await self.process_user_review(["toshirep/worker.py"])
+
+    @gen_test(timeout=30)
+    @requires_database
+    @requires_redis
+    async def test_process_user_review_async_worker(self):
+        await self.process_user_review(["-m", "toshirep.aioworker"])
+
+    async def process_user_review(self, worker_args):
 
         queue = self._app.test_request_queue = asyncio.Queue()
 
@@ -85,7 +108,7 @@ class RatingsTest(AsyncHandlerTest):
 
         self._app.q = Queue(connection=r)
 
-        p1 = subprocess.Popen([sys.executable, "toshirep/worker.py"], env=env)
+        p1 = subprocess.Popen([sys.executable] + worker_args, env=env)
 
         await asyncio.sleep(2)
 
@@ -111,3 +134,295 @@ class RatingsTest(AsyncHandlerTest):
 
         p1.terminate()
         p1.wait()
+
+    @gen_test(timeout=60)
+    @requires_database
+    @requires_redis
+    async def test_reprocess_reviews(self):
+
+        queue = self._app.test_request_queue = asyncio.Queue()
+
+        self._app.config['reputation'] = {
+            'push_url': self.get_url("/__push"),
+            'signing_key': TEST_PRIVATE_KEY
+        }
+        self._app.rep_push_urls = [self.get_url("/__push")]
+        os.environ['ADMIN_ADDRESS'] = TEST_ADDRESS
+
+        reviewees = ["0x056db290f8ba3250ca64a45d16284d04bc00000{}".format(i) for i in range(3)]
+        async with self.pool.acquire() as con:
+            for i, reviewee in enumerate(reviewees):
+                for j in range(i + 1):
+                    await con.execute(
+                        "INSERT INTO reviews (reviewer_id, reviewee_id, rating, review) "
+                        "VALUES ($1, $2, $3, $4)",
+                        "0x056db290f8ba3250ca64a45d16284d04bc10000{}".format(j), reviewee, 4, "ok")
+
+        env = os.environ.copy()
+        env['PYTHONPATH'] = '.'
+        env['REDIS_URL'] = build_redis_url(**self._app.config['redis'])
+        env['DATABASE_URL'] = build_database_url(**self._app.config['database'])
+
+        self._app.q = Queue(connection=redis.from_url(env['REDIS_URL']))
+
+        p1 = subprocess.Popen([sys.executable, "toshirep/worker.py"], env=env)
+
+        resp = await self.fetch_signed("/admin/reprocess", signing_key=TEST_PRIVATE_KEY, method="POST", body={})
+        self.assertResponseCodeEqual(resp, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(body['reviewees'], 3)
+
+        updates = {}
+        for _ in reviewees:
+            update = await queue.get()
+            updates[update['toshi_id']] = update
+        for i, reviewee in enumerate(reviewees):
+            self.assertEqual(updates[reviewee]['review_count'], i + 1)
+            self.assertEqual(updates[reviewee]['average_rating'], 4.0)
+
+        while True:
+            resp = await self.fetch_signed("/admin/reprocess/{}".format(body['reprocess_id']),
+                                           signing_key=TEST_PRIVATE_KEY, method="GET")
+            self.assertResponseCodeEqual(resp, 200)
+            status = json_decode(resp.body)
+            if status['done']:
+                break
+            await asyncio.sleep(1)
+
+        self.assertEqual(status['chunks'], 1)
+        self.assertEqual(status['completed_reviewees'], 3)
+        self.assertEqual(status['pushed'], 3)
+        self.assertEqual(status['failed'], 0)
+
+        p1.terminate()
+        p1.wait()
+
+    @gen_test(timeout=30)
+    @requires_redis
+    async def test_failed_reprocess_chunk(self):
+
+        os.environ['ADMIN_ADDRESS'] = TEST_ADDRESS
+        r = redis.from_url(build_redis_url(**self._app.config['redis']))
+        q = self._app.q = Queue(connection=r)
+        push_urls = [self.get_url("/__push")]
+        reprocess_id = queue_user_reputation_updates(q, push_urls, TEST_PRIVATE_KEY, [TEST_ADDRESS_2])
+
+        # the chunk can't connect to the database
+        resources = TaskResources({'dsn': "postgresql://localhost:1/missing"}, r)
+        with self.assertRaises(Exception):
+            await _reprocess_user_reputations(resources, push_urls, TEST_PRIVATE_KEY, [TEST_ADDRESS_2], reprocess_id)
+        await resources.close()
+
+        resp = await self.fetch_signed("/admin/reprocess/{}".format(reprocess_id),
+                                       signing_key=TEST_PRIVATE_KEY, method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        status = json_decode(resp.body)
+        self.assertTrue(status['done'])
+        self.assertEqual(status['failed_chunks'], 1)
+        self.assertEqual(status['pushed'], 0)
+
+    @gen_test(timeout=30)
+    @requires_redis
+    async def test_coalesce_user_updates(self):
+
+        r = redis.from_url(build_redis_url(**self._app.config['redis']))
+        q = Queue(connection=r)
+        scheduler = ReputationScheduler(q, [self.get_url("/__push")], TEST_PRIVATE_KEY,
+                                        quiet_window=2, max_delay=10)
+
+        now = int(time.time())
+        # a burst of writes for the same reviewee
+        for i in range(5):
+            scheduler.mark_dirty(TEST_ADDRESS_2, now=now + i)
+        scheduler.mark_dirty(TEST_ADDRESS, now=now)
+
+        self.assertEqual(scheduler.pending(), 2)
+        # nothing is due within the quiet window of the last write
+        self.assertEqual(scheduler.tick(now=now + 1), 0)
+        # TEST_ADDRESS's quiet window has ended
+        self.assertEqual(scheduler.tick(now=now + 2), 1)
+        self.assertEqual(q.count, 1)
+        self.assertEqual(scheduler.tick(now=now + 6), 1)
+        self.assertEqual(q.count, 2)
+        self.assertEqual(scheduler.pending(), 0)
+        self.assertEqual(sorted(job.args[2] for job in q.jobs), sorted([TEST_ADDRESS, TEST_ADDRESS_2]))
+
+        # continuous writes are still flushed after the max delay
+        for i in range(0, 20, 1):
+            scheduler.mark_dirty(TEST_ADDRESS_2, now=now + 100 + i)
+            enqueued = scheduler.tick(now=now + 100 + i)
+            if enqueued:
+                break
+        self.assertEqual(i, 10)
+
+    @gen_test(timeout=30)
+    @requires_redis
+    async def test_coalesced_updates_are_not_lost(self):
+
+        r = redis.from_url(build_redis_url(**self._app.config['redis']))
+        q = Queue(connection=r)
+        scheduler = ReputationScheduler(q, [self.get_url("/__push")], TEST_PRIVATE_KEY,
+                                        quiet_window=2, max_delay=10, claim_timeout=60)
+
+        now = int(time.time())
+        reviewees = ["0x056db290f8ba3250ca64a45d16284d04bc00000{}".format(i) for i in range(3)]
+        for reviewee in reviewees:
+            scheduler.mark_dirty(reviewee, now=now)
+
+        # enqueuing fails after the first job
+        enqueue = q.enqueue
+        def failing_enqueue(*args, **kwargs):
+            if q.count > 0:
+                raise redis.exceptions.ConnectionError()
+            return enqueue(*args, **kwargs)
+        q.enqueue = failing_enqueue
+        with self.assertRaises(redis.exceptions.ConnectionError):
+            scheduler.tick(now=now + 2)
+        self.assertEqual(q.count, 1)
+        self.assertEqual(scheduler.pending(), 2)
+
+        q.enqueue = enqueue
+        self.assertEqual(scheduler.tick(now=now + 3), 2)
+        self.assertEqual(sorted(job.args[2] for job in q.jobs), sorted(reviewees))
+
+        # a scheduler that dies between claiming and enqueuing
+        scheduler.mark_dirty(TEST_ADDRESS, now=now + 10)
+        scheduler._claim_due(keys=[scheduler.due_key, "{}:claimed".format(scheduler.due_key), scheduler.first_key],
+                             args=[now + 12, scheduler.batch_size, scheduler.claim_timeout])
+        self.assertEqual(scheduler.pending(), 0)
+        # the claim is only given up after the claim timeout
+        self.assertEqual(scheduler.tick(now=now + 13), 0)
+        self.assertEqual(scheduler.tick(now=now + 12 + 60), 1)
+        self.assertEqual(q.jobs[-1].args[2], TEST_ADDRESS)
+
+    @gen_test(timeout=30)
+    @requires_redis
+    async def test_push_retries_and_dead_letters(self):
+
+        r = redis.from_url(build_redis_url(**self._app.config['redis']))
+        q = self._app.q = Queue(connection=r)
+        self._app.config['reputation'] = {
+            'push_url': self.get_url("/__push"),
+            'signing_key': TEST_PRIVATE_KEY
+        }
+        self._app.rep_push_urls = [self.get_url("/__push")]
+        os.environ['ADMIN_ADDRESS'] = TEST_ADDRESS
+        scheduler = ReputationScheduler(q, self._app.rep_push_urls, TEST_PRIVATE_KEY)
+
+        now = int(time.time())
+        schedule_push_retry(r, self.get_url("/__push"), TEST_ADDRESS_2, 1, now=now)
+        self.assertEqual(scheduler.pending_retries(), 1)
+
+        # the retry isn't enqueued until its backoff has passed
+        scheduler.tick(now=now)
+        self.assertEqual(q.count, 0)
+        scheduler.tick(now=now + PUSH_RETRY_MAX_DELAY)
+        self.assertEqual(q.count, 1)
+        self.assertEqual(scheduler.pending_retries(), 0)
+        job = q.jobs[0]
+        self.assertEqual(job.func, push_user_reputation)
+        self.assertEqual(job.args[2], TEST_ADDRESS_2)
+        self.assertEqual(job.args[3], 1)
+        q.empty()
+
+        # backoff grows with each attempt and is capped
+        self.assertLessEqual(push_retry_delay(1), PUSH_RETRY_BASE_DELAY)
+        self.assertGreaterEqual(push_retry_delay(3), PUSH_RETRY_BASE_DELAY * 2)
+        self.assertLessEqual(push_retry_delay(100), PUSH_RETRY_MAX_DELAY)
+
+        # pushes that run out of attempts go to the dead letter list
+        schedule_push_retry(r, self.get_url("/__push"), TEST_ADDRESS_2, MAX_PUSH_ATTEMPTS, now=now)
+        self.assertEqual(scheduler.pending_retries(), 0)
+        self.assertEqual(r.llen(PUSH_DEAD_LETTER_KEY), 1)
+
+        for limit in [0, -1]:
+            resp = await self.fetch_signed("/admin/push/replay", signing_key=TEST_PRIVATE_KEY, method="POST",
+                                           body={"limit": limit})
+            self.assertResponseCodeEqual(resp, 400)
+        self.assertEqual(r.llen(PUSH_DEAD_LETTER_KEY), 1)
+
+        resp = await self.fetch_signed("/admin/push/replay", signing_key=TEST_PRIVATE_KEY, method="POST", body={})
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['replayed'], 1)
+        self.assertEqual(r.llen(PUSH_DEAD_LETTER_KEY), 0)
+        self.assertEqual(q.count, 1)
+        self.assertEqual(q.jobs[0].args[3], 0)
+
+    @gen_test(timeout=30)
+    async def test_batch_push(self):
+
+        self._app.push_requests = []
+        resources = TaskResources(None)
+        pusher = resources.batch_pusher = BatchPusher(resources, max_batch_size=10, max_linger=0.1)
+
+        reviewees = ["0x056db290f8ba3250ca64a45d16284d04bc00000{}".format(i) for i in range(6)]
+        futs = []
+        for push_url in [self.get_url("/__stub/batch"), self.get_url("/__stub/single")]:
+            for i, reviewee in enumerate(reviewees):
+                body = reputation_push_body(reviewee, 2.5, i, 4.0)
+                futs.append(pusher.push(push_url, body, TEST_PRIVATE_KEY, reviewee))
+        results = await asyncio.gather(*futs)
+        await resources.close()
+        self.assertTrue(all(results))
+
+        requests = self._app.push_requests
+        self.assertTrue(all(address == TEST_ADDRESS for address, _ in requests))
+        # the batch endpoint gets chunks of at most its advertised size
+        # and the other endpoint gets a request per update
+        self.assertEqual(sorted(len(updates) for _, updates in requests), [1, 1, 1, 1, 1, 1, 2, 4])
+        pushed = sorted(update['toshi_id'] for _, updates in requests for update in updates)
+        self.assertEqual(pushed, sorted(reviewees * 2))
+
+    @gen_test(timeout=30)
+    @requires_database
+    @requires_redis
+    async def test_job_stats(self):
+
+        self._app.push_requests = []
+        r = redis.from_url(build_redis_url(**self._app.config['redis']))
+        q = Queue(connection=r)
+        resources = TaskResources({'dsn': build_database_url(**self._app.config['database'])}, r)
+
+        # one push succeeds and the other is retried
+        for push_url in [self.get_url("/__stub/single"), self.get_url("/__missing")]:
+            job = q.enqueue(push_user_reputation, push_url, TEST_PRIVATE_KEY, TEST_ADDRESS_2, 0)
+            await run_job(resources, job, _push_user_reputation, *job.args)
+
+        async def fail(resources):
+            raise ValueError()
+        with self.assertRaises(ValueError):
+            await run_job(resources, None, fail)
+        await resources.close()
+
+        summary = summarize(read_job_stats(r, minutes=2))
+        self.assertEqual(summary['counts']['pushes'], 2)
+        self.assertEqual(summary['counts']['pushes_failed'], 1)
+        self.assertEqual(summary['counts']['push_retries'], 1)
+        self.assertEqual(summary['counts']['jobs_failed'], 1)
+        self.assertEqual(summary['timings']['queue_wait']['count'], 2)
+        self.assertEqual(summary['timings']['job']['count'], 3)
+        self.assertEqual(summary['timings']['compute']['count'], 2)
+        self.assertEqual(summary['timings']['push']['count'], 2)
+        self.assertEqual(summarize(read_job_stats(r))['counts']['pushes'], 2)
+
+    @gen_test(timeout=30)
+    @requires_database
+    @requires_redis
+    async def test_async_worker_job_status(self):
+
+        self._app.push_requests = []
+        r = redis.from_url(build_redis_url(**self._app.config['redis']))
+        q = Queue(connection=r)
+        resources = TaskResources({'dsn': build_database_url(**self._app.config['database'])}, r)
+        worker = AsyncWorker(r, resources)
+
+        job = q.enqueue(push_user_reputation, self.get_url("/__stub/single"), TEST_PRIVATE_KEY, TEST_ADDRESS_2, 0)
+        failing_job = q.enqueue(push_user_reputation, self.get_url("/__stub/single"), TEST_PRIVATE_KEY)
+        await worker.perform(job)
+        await worker.perform(failing_job)
+        await resources.close()
+
+        self.assertEqual(job.get_status(), JobStatus.FINISHED)
+        self.assertEqual(failing_job.get_status(), JobStatus.FAILED)
+        self.assertEqual(get_failed_queue(connection=r).job_ids, [failing_job.id])
+        self.assertEqual(StartedJobRegistry(q.name, connection=r).get_job_ids(), [])
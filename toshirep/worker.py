@@ -15,18 +15,20 @@ REDIS_UNIX_SOCKET = os.getenv('REDIS_UNIX_SOCKET', None)
 REDIS_DB = int(os.getenv('REDIS_DB', 0))
 REDIS_PASSWORD = os.getenv('REDIS_PASSWORD', None)
 
+def get_redis_url():
+    if REDIS_UNIX_SOCKET:
+        if REDIS_PASSWORD:
+            return 'unix://:{}@{}?db={}'.format(REDIS_PASSWORD, REDIS_UNIX_SOCKET, REDIS_DB)
+        else:
+            return 'unix://{}?db={}'.format(REDIS_UNIX_SOCKET, REDIS_DB)
+    return REDIS_URL
+
 if __name__ == '__main__':
     if 'DATABASE_URL' not in os.environ:
         log.error("ENVIRONMENT MISSING `DATABASE_URL`")
         sys.exit(1)
-    if REDIS_UNIX_SOCKET:
-        if REDIS_PASSWORD:
-            url = 'unix://:{}@{}?db={}'.format(REDIS_PASSWORD, REDIS_UNIX_SOCKET, REDIS_DB)
-        else:
-            url = 'unix://{}?db={}'.format(REDIS_UNIX_SOCKET, REDIS_DB)
-    elif REDIS_URL:
-        url = REDIS_URL
-    else:
+    url = get_redis_url()
+    if not url:
         log.error("ENVIROMENT MISSING `REDIS_URL`")
         sys.exit(1)
     conn = redis.from_url(url)